@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+import logging
+import threading
+import time
+from database import insert_chunk
+from gtfs_time import times_to_seconds, format_times
+from service_calendar import ServiceCalendar, DAYS, database_key, register_database_cache
+
+logger = logging.getLogger(__name__)
+
+# Chunk size used when we have to read stop_times back from the database (streaming import)
+READ_CHUNK_SIZE = 500000
+
+
+# Reduces stop_times to one row per trip with the start (first arrival) and end (last departure) in seconds.
+# It takes an iterable of dataframes so stop_times can be processed a chunk at a time: every chunk is reduced
+# on its own and then the partial results are reduced again, a trip split between two chunks ends up correct anyway.
+# Chunks can have the arrival_secs/departure_secs columns written at import, or just the time strings
+def trip_spans(stop_times_chunks):
+    partials = []
+    for chunk in stop_times_chunks:
+        if chunk.empty:
+            continue
+        chunk = chunk.copy()
+        chunk['trip_id'] = chunk['trip_id'].astype(str)
+        chunk['stop_sequence'] = pd.to_numeric(chunk['stop_sequence'], errors='coerce')
+        for column in ('arrival', 'departure'):
+            if f'{column}_secs' in chunk.columns:
+                chunk[f'{column}_secs'] = pd.to_numeric(chunk[f'{column}_secs'], errors='coerce')
+            else:
+                chunk[f'{column}_secs'] = times_to_seconds(chunk[f'{column}_time']).to_numpy()
+        chunk = chunk.sort_values(['trip_id', 'stop_sequence'])
+        grouped = chunk.groupby('trip_id', sort=False)
+        first = grouped.head(1).set_index('trip_id')
+        last = grouped.tail(1).set_index('trip_id')
+        partials.append(pd.DataFrame({
+            'first_sequence': first['stop_sequence'],
+            'start_secs': first['arrival_secs'],
+            'last_sequence': last['stop_sequence'],
+            'end_secs': last['departure_secs'],
+        }))
+
+    if not partials:
+        # Same index as a real result (string trip_id), so joining it on the trips just gives no rows
+        return pd.DataFrame({'start_secs': pd.Series(dtype=float), 'end_secs': pd.Series(dtype=float)},
+                            index=pd.Index([], dtype=object, name='trip_id'))
+
+    spans = pd.concat(partials)
+    if len(partials) > 1:
+        spans = spans.reset_index()
+        starts = spans.sort_values('first_sequence').groupby('trip_id').first()
+        ends = spans.sort_values('last_sequence').groupby('trip_id').last()
+        spans = pd.DataFrame({'start_secs': starts['start_secs'], 'end_secs': ends['end_secs']})
+    return spans[['start_secs', 'end_secs']]
+
+
+# One row per trip with its route, service, start/end (seconds) and duration (minutes), the base of every
+# network-wide number below
+def trip_table(trips, spans):
+    trips = trips[['trip_id', 'route_id', 'service_id']].copy()
+    for column in ('trip_id', 'route_id', 'service_id'):
+        trips[column] = trips[column].astype(str)
+    merged = trips.join(spans, on='trip_id', how='inner')
+    # Trips ending after midnight with times written as 00:xx instead of 24:xx
+    duration = merged['end_secs'] - merged['start_secs']
+    merged['duration'] = duration.where(duration >= 0, duration + 86400) / 60
+    return merged.reset_index(drop=True)
+
+
+# Numbers of every route of the network at once: trips by weekday (or on a single date, YYYYMMDD), average and
+# percentile trip durations in minutes, first and last departure. Only trips actually running count
+def compute_network_stats(trips, calendar, date=None, percentiles=(0.5, 0.9)):
+    service_ids = trips['service_id'].unique()
+    if date is not None:
+        active = pd.Series(calendar.active_on(service_ids, date), index=service_ids)
+        trips = trips[trips['service_id'].map(active).to_numpy(dtype=bool)]
+        counts = trips.groupby('route_id').size().to_frame('trips')
+    else:
+        weekdays = calendar.weekday_frame(service_ids)
+        per_trip = weekdays.reindex(trips['service_id']).set_axis(trips.index).astype(int)
+        trips = trips[per_trip.any(axis=1).to_numpy()]
+        counts = per_trip.loc[trips.index].groupby(trips['route_id']).sum().add_prefix('trips_')
+
+    if trips.empty:
+        return pd.DataFrame()
+
+    grouped = trips.groupby('route_id')
+    stats = counts.join(pd.DataFrame({
+        'avg_duration': grouped['duration'].mean(),
+        'first_departure_secs': grouped['start_secs'].min(),
+        'last_departure_secs': grouped['start_secs'].max(),
+    }))
+    quantiles = grouped['duration'].quantile(list(percentiles)).unstack()
+    for percentile in percentiles:
+        stats[f'duration_p{round(percentile * 100)}'] = quantiles[percentile]
+    return stats.reset_index()
+
+
+# Network stats as plain dicts, one per route, ready to be sent as JSON
+def network_stats_records(stats, routes=None):
+    if stats.empty:
+        return []
+    stats = stats.copy()
+    for column in ('first_departure', 'last_departure'):
+        seconds = stats[f'{column}_secs']
+        stats[column] = np.where(seconds.notna(), format_times(seconds.fillna(0)), None)
+    if routes is not None:
+        names = routes[['route_id', 'route_short_name', 'route_long_name']].astype({'route_id': str}).drop_duplicates('route_id')
+        stats = stats.merge(names, on='route_id', how='left')
+    duration_columns = [column for column in stats.columns if column == 'avg_duration' or column.startswith('duration_p')]
+    stats[duration_columns] = stats[duration_columns].round(2)
+    stats = stats.astype(object).where(stats.notna(), None)
+    return stats.to_dict('records')
+
+
+_trip_tables = {}
+_trip_tables_lock = threading.Lock()
+register_database_cache(_trip_tables, _trip_tables_lock)
+
+
+# trip_table of a database, stop_times is scanned once (a chunk at a time) and the result kept until the file changes
+def get_trip_table(engine):
+    key = database_key(engine)
+    with _trip_tables_lock:
+        table = _trip_tables.get(key)
+    if table is None:
+        start = time.perf_counter()
+        has_seconds = 'arrival_secs' in pd.read_sql('SELECT * FROM stop_times LIMIT 0', engine).columns
+        columns = ['trip_id', 'arrival_secs', 'departure_secs', 'stop_sequence'] if has_seconds else \
+                  ['trip_id', 'arrival_time', 'departure_time', 'stop_sequence']
+        chunks = pd.read_sql(f'SELECT {", ".join(columns)} FROM stop_times', engine, chunksize=READ_CHUNK_SIZE)
+        table = trip_table(pd.read_sql('SELECT trip_id, route_id, service_id FROM trips', engine), trip_spans(chunks))
+        with _trip_tables_lock:
+            for old_key in [old_key for old_key in _trip_tables if old_key[0] == key[0]]:
+                del _trip_tables[old_key]
+            _trip_tables[key] = table
+        logger.info(f"Trip table of {key[0]} built in {time.perf_counter() - start:.2f}s ({len(table)} trips)")
+    return table
+
+
+# Trips by weekday and average trip duration (minutes) by weekday for every route and direction, in one pass.
+# Same numbers /route_info used to compute for a single route on every request
+def compute_route_stats(trips, spans, weekdays):
+    trips = trips[['trip_id', 'route_id', 'direction_id', 'service_id']].copy()
+    for column in ('trip_id', 'route_id', 'service_id'):
+        trips[column] = trips[column].astype(str)
+    trips['direction_id'] = pd.to_numeric(trips['direction_id'], errors='coerce')
+    trips = trips.dropna(subset=['direction_id'])
+
+    merged = trips.join(spans, on='trip_id', how='inner').join(weekdays, on='service_id', how='inner')
+
+    # Trips ending after midnight with times written as 00:xx instead of 24:xx
+    duration = merged['end_secs'] - merged['start_secs']
+    duration = duration.where(duration >= 0, duration + 86400)
+    merged['duration'] = duration / 60
+
+    columns = {}
+    for day in DAYS:
+        active = merged[day].astype(bool)
+        timed = active & merged['duration'].notna()
+        columns[f'trips_{day}'] = active.astype(int)
+        columns[f'_time_{day}'] = merged['duration'].where(timed, 0.0)
+        columns[f'_count_{day}'] = timed.astype(int)
+
+    per_trip = pd.DataFrame(columns, index=merged.index)
+    per_trip['route_id'] = merged['route_id']
+    per_trip['direction_id'] = merged['direction_id'].astype(int)
+    totals = per_trip.groupby(['route_id', 'direction_id']).sum()
+
+    stats = pd.DataFrame(index=totals.index)
+    for day in DAYS:
+        stats[f'trips_{day}'] = totals[f'trips_{day}']
+    for day in DAYS:
+        counts = totals[f'_count_{day}']
+        stats[f'avg_time_{day}'] = (totals[f'_time_{day}'] / counts.where(counts > 0)).fillna(0.0)
+    return stats.reset_index()
+
+
+# Analytics stage of the conversion: fills the route_stats table so /route_info only has to look up a row.
+# If the dataframes are not available (streaming import) the tables are read back from the database,
+# stop_times a chunk at a time
+def build_route_stats(engine, dataframes=None):
+    start = time.perf_counter()
+    dataframes = dataframes or {}
+
+    def load(table_name, columns):
+        df = dataframes.get(table_name)
+        if df is not None:
+            return df if set(columns).issubset(df.columns) else None
+        try:
+            return pd.read_sql(f'SELECT {", ".join(columns)} FROM {table_name}', engine)
+        except Exception as e:
+            logger.warning(f"Can't read {table_name} for route statistics: {e}")
+            return None
+
+    stop_time_columns = ['trip_id', 'arrival_secs', 'departure_secs', 'stop_sequence']
+    if 'stop_times' in dataframes:
+        stop_times_chunks = [dataframes['stop_times'][stop_time_columns]]
+    else:
+        stop_times_chunks = pd.read_sql(f'SELECT {", ".join(stop_time_columns)} FROM stop_times', engine,
+                                        chunksize=READ_CHUNK_SIZE)
+
+    trips = load('trips', ['trip_id', 'route_id', 'direction_id', 'service_id'])
+    calendar = load('calendar', ['service_id'] + DAYS + ['start_date', 'end_date'])
+    calendar_dates = load('calendar_dates', ['service_id', 'date', 'exception_type'])
+    if trips is None:
+        logger.warning("No trips found, route statistics not created")
+        return 0
+
+    stats = compute_route_stats(trips, trip_spans(stop_times_chunks),
+                                  ServiceCalendar(calendar, calendar_dates).weekday_frame())
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM route_stats")
+        rows = insert_chunk(conn, 'route_stats', stats)
+
+    logger.info(f"Route statistics computed for {rows} routes/directions in {time.perf_counter() - start:.2f}s")
+    return rows
@@ -0,0 +1,113 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from benchmarks.common import SIZES, PeakMemory, environment, write_results, load_results, print_comparison
+from benchmarks.synthetic_feed import write_feed
+from gtfs_processor import process_gtfs_file
+from instrumentation import profiling
+
+logger = logging.getLogger(__name__)
+
+# Conversion benchmark: generates a synthetic feed and converts it with process_gtfs_file, recording the time of
+# every stage it runs (extract, parse, insert, route_stats, ..., indexes, hashes), rows/s and peak RSS.
+# The results go in a json file, pass an older one with --compare to see the difference between two commits:
+#   python -m benchmarks.bench_conversion --size medium
+#   python -m benchmarks.bench_conversion --size medium --compare bench_results/conversion-abc1234-....json
+
+# Stages going through every row of the feed, they get a rows/s
+ROW_STAGES = ('parse', 'insert', 'stream')
+
+
+def run_conversion(zip_path, db_path, args, feed_rows):
+    # The undecorated function inside a profile of our own, @profiled would only log the stages
+    with profiling() as profile:
+        converted = process_gtfs_file.__wrapped__(
+            zip_path, db_path, streaming=args.streaming, chunk_size=args.chunk_size, parse_backend=args.backend,
+            workers=args.workers, csv_engine=args.csv_engine, headways=args.headways, compact=args.compact)
+    if not converted:
+        raise RuntimeError(f"Conversion of {zip_path} failed, see the log")
+
+    total_rows = sum(feed_rows.values())
+    stages = {}
+    for name, seconds in profile.stages.items():
+        stages[name] = {'seconds': round(seconds, 4)}
+        if name in ROW_STAGES:
+            stages[name].update(rows=total_rows, rows_per_sec=round(total_rows / seconds) if seconds > 0 else None)
+    stages['sql'] = {'seconds': round(profile.sql_seconds, 4), 'statements': profile.sql_count}
+    return stages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_conversion', description="Benchmark the GTFS conversion")
+    parser.add_argument('--size', choices=SIZES, default='small', help="synthetic feed size (default: %(default)s)")
+    parser.add_argument('--routes', type=int, help="override the routes of --size")
+    parser.add_argument('--trips', type=int, help="override the trips per route and direction of --size")
+    parser.add_argument('--stops', type=int, help="override the stops per trip of --size")
+    parser.add_argument('--repeat', type=int, default=1, help="runs, the fastest one is kept for every stage")
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--backend', choices=['threads', 'processes'], default='threads')
+    parser.add_argument('--csv-engine', choices=['c', 'pyarrow'])
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--headways', action='store_true', help="also build stop_headways")
+    parser.add_argument('--compact', action='store_true', help="store stop_times compacted")
+    parser.add_argument('--output', help="results file (default: bench_results/conversion-<commit>-<time>.json)")
+    parser.add_argument('--compare', help="older results file to compare with")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    routes, trips, stops = SIZES[args.size]
+    routes, trips, stops = args.routes or routes, args.trips or trips, args.stops or stops
+
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        zip_path = os.path.join(work_dir, 'feed.zip')
+        feed_rows = write_feed(zip_path, routes, trips, stops)
+
+        runs = []
+        for run in range(args.repeat):
+            db_path = os.path.join(work_dir, f'feed_{run}.db')
+            start = time.perf_counter()
+            with PeakMemory() as memory:
+                stages = run_conversion(zip_path, db_path, args, feed_rows)
+            runs.append({'stages': stages, 'total_seconds': round(time.perf_counter() - start, 4),
+                         'peak_rss_mb': memory.peak_mb, 'db_size_mb': round(os.path.getsize(db_path) / 1024 ** 2, 2)})
+            print(f"run {run + 1}/{args.repeat}: {runs[-1]['total_seconds']:.2f}s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    best = min(runs, key=lambda run: run['total_seconds'])
+    stages = {name: min((run['stages'][name] for run in runs), key=lambda stage: stage['seconds']) for name in best['stages']}
+    results = {
+        'benchmark': 'conversion',
+        'environment': environment(),
+        'params': {'size': args.size, 'routes': routes, 'trips': trips, 'stops': stops, 'streaming': args.streaming,
+                   'chunk_size': args.chunk_size, 'backend': args.backend, 'csv_engine': args.csv_engine,
+                   'workers': args.workers, 'headways': args.headways, 'compact': args.compact, 'repeat': args.repeat},
+        'feed_rows': feed_rows,
+        'stages': stages,
+        'total_seconds': best['total_seconds'],
+        'peak_rss_mb': max(run['peak_rss_mb'] or 0 for run in runs),
+        'db_size_mb': best['db_size_mb'],
+    }
+
+    print(f"\n{'stage':15} {'seconds':>9} {'rows/s':>12}")
+    for name, stage in stages.items():
+        rate = f"{stage['rows_per_sec']:,}" if stage.get('rows_per_sec') else ''
+        print(f"{name:15} {stage['seconds']:>9.3f} {rate:>12}")
+    print(f"{'total':15} {results['total_seconds']:>9.3f}")
+    print(f"peak RSS {results['peak_rss_mb']:.1f} MB, database {results['db_size_mb']} MB")
+
+    output = write_results(results, args.output, prefix='conversion')
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        print_comparison(load_results(args.compare), results, 'stages', ['seconds'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import shutil
+import threading
+import time
+import numpy as np
+from benchmarks.common import SIZES, environment, write_results, load_results, print_comparison
+from benchmarks.synthetic_feed import write_feed
+
+# Load test of the flask endpoints, offline: every database size gets its own process that imports server.py
+# and drives /search, /stops, /route_info and /routes through the flask test client, counting the SQL
+# statements of every request. The endpoints run with the response cache off, so every request does its real work
+# (N+1 queries and full scans show up), then the cached ones run again with it on ('<endpoint> cached').
+# Latency percentiles, throughput and statements per request go in a json file:
+#   python -m benchmarks.bench_server --sizes tiny small medium
+#   python -m benchmarks.bench_server --sizes small --compare bench_results/server-<commit>-<time>.json
+
+ENDPOINTS = ['search', 'stops', 'route_info', 'routes']
+# Endpoints behind the response cache, measured a second time with it
+CACHED_ENDPOINTS = ['stops', 'route_info']
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 3) if values else None
+
+
+# Request arguments for every endpoint, picked from what's actually in the database
+def sample_requests(db_path, count, seed=42):
+    import sqlite3
+    rng = random.Random(seed)
+    with sqlite3.connect(db_path) as conn:
+        route_ids = [row[0] for row in conn.execute("SELECT route_id FROM routes")]
+        stop_names = [row[0] for row in conn.execute("SELECT stop_name FROM stops LIMIT 1000")]
+    words = [name.split()[0] for name in stop_names if name] or ['Stop']
+    return {
+        'search': [{'json': {'query': rng.choice(words + [str(rng.randint(1, 9))])}} for _ in range(count)],
+        'stops': [{'query_string': {'route_id': rng.choice(route_ids)}} for _ in range(count)],
+        'route_info': [{'query_string': {'route_id': rng.choice(route_ids)}} for _ in range(count)],
+        'routes': [{} for _ in range(max(1, count // 10))],
+    }
+
+
+# Runs inside the child process: DATABASE_URL is set before server.py is imported
+def measure(db_path, count, threads):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    import server
+
+    statements = threading.local()
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.count = getattr(statements, 'count', 0) + 1
+
+    requests = sample_requests(db_path, count)
+    cache_type = server.app.config['CACHE_TYPE']
+    results = {}
+    server.cache.init_app(server.app, config={'CACHE_TYPE': 'NullCache'})
+    for endpoint in ENDPOINTS:
+        results[endpoint] = measure_endpoint(server.app, endpoint, requests[endpoint], threads, statements)
+    server.cache.init_app(server.app, config={'CACHE_TYPE': cache_type})
+    for endpoint in CACHED_ENDPOINTS:
+        results[f'{endpoint} cached'] = measure_endpoint(server.app, endpoint, requests[endpoint], threads, statements)
+    return results
+
+
+def measure_endpoint(app, endpoint, requests, threads, statements):
+    method = 'post' if endpoint == 'search' else 'get'
+    latencies, sql_counts, errors = [], [], 0
+    lock = threading.Lock()
+    pending = list(requests)
+
+    def worker():
+        nonlocal errors
+        client = app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                kwargs = pending.pop()
+            statements.count = 0
+            start = time.perf_counter()
+            response = getattr(client, method)(f'/{endpoint}', **kwargs)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                sql_counts.append(statements.count)
+                if response.status_code >= 500:
+                    errors += 1
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': percentile(latencies, 100),
+        'throughput_rps': round(len(latencies) / wall, 1) if wall > 0 else None,
+        'sql_per_request_avg': round(float(np.mean(sql_counts)), 2) if sql_counts else None,
+        'sql_per_request_max': int(max(sql_counts)) if sql_counts else None,
+    }
+
+
+def build_database(work_dir, size):
+    from gtfs_processor import process_gtfs_file
+    routes, trips, stops = SIZES[size]
+    zip_path = os.path.join(work_dir, f'{size}.zip')
+    db_path = os.path.join(work_dir, f'{size}.db')
+    write_feed(zip_path, routes, trips, stops)
+    if not process_gtfs_file(zip_path, db_path):
+        raise RuntimeError(f"Could not convert the {size} feed")
+    return db_path
+
+
+def run_size(db_path, count, threads):
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}')
+    command = [sys.executable, '-m', 'benchmarks.bench_server', '--measure', db_path,
+               '--requests', str(count), '--threads', str(threads)]
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark process failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_server', description="Benchmark the flask endpoints")
+    parser.add_argument('--sizes', nargs='+', choices=SIZES, default=['tiny', 'small'])
+    parser.add_argument('--requests', type=int, default=200, help="requests per endpoint (/routes gets a tenth)")
+    parser.add_argument('--threads', type=int, default=1, help="concurrent clients")
+    parser.add_argument('--output', help="results file (default: bench_results/server-<commit>-<time>.json)")
+    parser.add_argument('--compare', help="older results file to compare with")
+    parser.add_argument('--measure', metavar='DB', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(measure(args.measure, args.requests, args.threads)))
+        return 0
+
+    logging.disable(logging.INFO)
+    work_dir = tempfile.mkdtemp(prefix='bench_server_')
+    results = {'benchmark': 'server', 'environment': environment(),
+               'params': {'sizes': args.sizes, 'requests': args.requests, 'threads': args.threads}, 'sizes': {}}
+    try:
+        for size in args.sizes:
+            db_path = build_database(work_dir, size)
+            results['sizes'][size] = run_size(db_path, args.requests, args.threads)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    flat = {'endpoints': {}}
+    for size, endpoints in results['sizes'].items():
+        print(f"\n{size}")
+        print(f"{'endpoint':18} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'sql/req':>8} {'errors':>7}")
+        for endpoint, stats in endpoints.items():
+            print(f"{endpoint:18} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9} "
+                  f"{stats['throughput_rps']:>9} {stats['sql_per_request_avg']:>8} {stats['errors']:>7}")
+            flat['endpoints'][f'{size} {endpoint}'] = stats
+
+    output = write_results(results, args.output, prefix='server')
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        base = load_results(args.compare)
+        base_flat = {'endpoints': {f'{size} {endpoint}': stats for size, endpoints in base.get('sizes', {}).items()
+                                   for endpoint, stats in endpoints.items()}}
+        print_comparison(base_flat, flat, 'endpoints', ['p95_ms', 'throughput_rps', 'sql_per_request_avg'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Helpers shared by the benchmark scripts: memory sampling, stage timing and the results files
+
+RESULTS_DIR = 'bench_results'
+
+# Feed sizes used by the benchmarks: (routes, trips per route and direction, stops per trip)
+SIZES = {
+    'tiny': (5, 10, 10),
+    'small': (50, 40, 25),
+    'medium': (200, 100, 30),
+    'large': (600, 200, 40),
+}
+
+
+# Current resident memory of this process in MB, psutil when installed, /proc on linux, None elsewhere
+def current_rss_mb():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Samples the RSS in a background thread while the block runs and keeps the highest value
+class PeakMemory:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = current_rss_mb()
+            if rss is not None:
+                self.peak_mb = rss if self.peak_mb is None else max(self.peak_mb, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak_mb = rss if self.peak_mb is None else max(self.peak_mb, rss)
+        return False
+
+
+# Times a named stage: with stages.run('parse', rows=...) as stage: ...
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, rows=None):
+        return _Stage(self, name, rows)
+
+
+class _Stage:
+    def __init__(self, timer, name, rows):
+        self.timer = timer
+        self.name = name
+        self.rows = rows
+        self.memory = PeakMemory()
+
+    def __enter__(self):
+        self.memory.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.memory.__exit__(*exc)
+        result = {'seconds': round(seconds, 4), 'peak_rss_mb': round(self.memory.peak_mb, 1) if self.memory.peak_mb else None}
+        if self.rows is not None:
+            result['rows'] = self.rows
+            result['rows_per_sec'] = round(self.rows / seconds) if seconds > 0 else None
+        self.timer.stages[self.name] = result
+        return False
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def write_results(results, output=None, prefix='results'):
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{prefix}-{results['environment']['commit'] or 'nogit'}-{datetime.now():%Y%m%d%H%M%S}.json")
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    return output
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+# Prints old vs new for every numeric value found in both results, under the given key
+def print_comparison(base, current, key, metrics):
+    print(f"\n{'':30} {'base':>12} {'current':>12} {'change':>9}")
+    for name, values in current.get(key, {}).items():
+        base_values = base.get(key, {}).get(name)
+        if not base_values:
+            continue
+        for metric in metrics:
+            old, new = base_values.get(metric), values.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else ''
+            print(f"{name + ' ' + metric:30} {old:>12.4g} {new:>12.4g} {change:>9}")
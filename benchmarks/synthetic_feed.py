@@ -0,0 +1,127 @@
+import argparse
+import io
+import zipfile
+import numpy as np
+import pandas as pd
+
+# Deterministic synthetic GTFS feeds for the benchmarks: same arguments, same zip (byte for byte content).
+# Every route has its own stops and `trips` trips per direction, every trip calls `stops` stops.
+# Services: weekdays, weekends and a calendar_dates only service, plus some removed/added dates,
+# and the late trips go over 24:00:00 like in real feeds
+
+SERVICES = ['WEEKDAY', 'WEEKEND', 'SPECIAL']
+
+
+def gtfs_time(seconds):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    return pd.Series(hours).astype(str).str.zfill(2) + ':' + pd.Series(minutes).astype(str).str.zfill(2) + ':' + pd.Series(secs).astype(str).str.zfill(2)
+
+
+def build_feed(routes=10, trips=50, stops=20, seed=42):
+    rng = np.random.default_rng(seed)
+
+    agency = pd.DataFrame({'agency_id': ['BENCH'], 'agency_name': ['Benchmark Transit'],
+                           'agency_url': ['https://example.com'], 'agency_timezone': ['Europe/Rome']})
+
+    stop_count = routes * stops
+    stop_ids = np.array([f'S{i}' for i in range(stop_count)])
+    stops_df = pd.DataFrame({
+        'stop_id': stop_ids,
+        'stop_name': [f'Stop {i} Città' for i in range(stop_count)],
+        'stop_lat': np.round(45.0 + rng.random(stop_count) * 0.5, 6),
+        'stop_lon': np.round(9.0 + rng.random(stop_count) * 0.5, 6),
+    })
+
+    routes_df = pd.DataFrame({
+        'route_id': [f'R{i}' for i in range(routes)],
+        'agency_id': 'BENCH',
+        'route_short_name': [str(i + 1) for i in range(routes)],
+        'route_long_name': [f'Route {i + 1}' for i in range(routes)],
+        'route_type': 3,
+    })
+
+    # trips: routes x directions x trips
+    route_index = np.repeat(np.arange(routes), 2 * trips)
+    direction = np.tile(np.repeat([0, 1], trips), routes)
+    trip_number = np.tile(np.arange(trips), 2 * routes)
+    trip_count = len(route_index)
+    trips_df = pd.DataFrame({
+        'route_id': [f'R{i}' for i in route_index],
+        'service_id': np.array(SERVICES)[trip_number % len(SERVICES)],
+        'trip_id': [f'T{r}_{d}_{n}' for r, d, n in zip(route_index, direction, trip_number)],
+        'trip_headsign': [f'Route {r + 1} direction {d}' for r, d in zip(route_index, direction)],
+        'direction_id': direction,
+    })
+
+    # First departures spread from 05:00 to about 25:00, stops 1-4 minutes apart
+    first_departure = 5 * 3600 + (trip_number * (20 * 3600 // max(trips, 1))) + rng.integers(0, 300, trip_count)
+    hops = rng.integers(60, 240, (trip_count, stops))
+    hops[:, 0] = 0
+    times = first_departure[:, None] + np.cumsum(hops, axis=1)
+    dwell = rng.integers(0, 30, (trip_count, stops))
+
+    sequence = np.tile(np.arange(stops), trip_count)
+    forward = route_index[:, None] * stops + np.arange(stops)[None, :]
+    stop_index = np.where(direction[:, None] == 0, forward, forward[:, ::-1]).ravel()
+    stop_times_df = pd.DataFrame({
+        'trip_id': np.repeat(trips_df['trip_id'].to_numpy(), stops),
+        'arrival_time': gtfs_time(times.ravel()),
+        'departure_time': gtfs_time((times + dwell).ravel()),
+        'stop_id': stop_ids[stop_index],
+        'stop_sequence': sequence + 1,
+    })
+
+    calendar_df = pd.DataFrame({
+        'service_id': ['WEEKDAY', 'WEEKEND'],
+        'monday': [1, 0], 'tuesday': [1, 0], 'wednesday': [1, 0], 'thursday': [1, 0], 'friday': [1, 0],
+        'saturday': [0, 1], 'sunday': [0, 1],
+        'start_date': ['20240101', '20240101'], 'end_date': ['20241231', '20241231'],
+    })
+    calendar_dates_df = pd.DataFrame({
+        'service_id': ['SPECIAL', 'SPECIAL', 'SPECIAL', 'WEEKDAY', 'WEEKEND'],
+        'date': [20240105, 20240106, 20240415, 20240101, 20241225],
+        'exception_type': [1, 1, 1, 2, 1],
+    })
+
+    return {
+        'agency.txt': agency,
+        'stops.txt': stops_df,
+        'routes.txt': routes_df,
+        'trips.txt': trips_df,
+        'stop_times.txt': stop_times_df,
+        'calendar.txt': calendar_df,
+        'calendar_dates.txt': calendar_dates_df,
+    }
+
+
+# Writes the feed to zip_path and returns the number of rows of every file
+def write_feed(zip_path, routes=10, trips=50, stops=20, seed=42):
+    feed = build_feed(routes, trips, stops, seed)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_name, df in feed.items():
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False)
+            # Fixed timestamp so the same feed always gives the same zip
+            info = zipfile.ZipInfo(file_name, date_time=(2024, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(info, buffer.getvalue())
+    return {file_name: len(df) for file_name, df in feed.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.synthetic_feed', description="Generate a synthetic GTFS zip")
+    parser.add_argument('output', help="zip file to write")
+    parser.add_argument('--routes', type=int, default=10)
+    parser.add_argument('--trips', type=int, default=50, help="trips per route and direction")
+    parser.add_argument('--stops', type=int, default=20, help="stops per trip")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    rows = write_feed(args.output, args.routes, args.trips, args.stops, args.seed)
+    for file_name, count in rows.items():
+        print(f"{file_name}: {count} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zipfile
+from datetime import datetime
+from sqlalchemy import text
+from database import insert_chunk, log_insert_rate
+from instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+# Progress ledger of a conversion, kept inside the database being written: one row per table (rows committed so far)
+# and per step after the inserts (indexes, route_stats...), every row tagged with the fingerprint of the feed.
+# It is dropped when the conversion ends, a database that still has it is an unfinished conversion
+LEDGER_TABLE = 'conversion_progress'
+
+CREATE_LEDGER = f"""
+    CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+        step TEXT PRIMARY KEY,
+        feed TEXT NOT NULL,
+        rows INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )
+"""
+
+
+# Identity of a conversion: crc and size of every member (from the zip directory, nothing is read) and the options
+# changing what ends up in the tables. Another zip, another selection of files or another mode means starting over
+def feed_fingerprint(zip_path, files, streaming=False, compact=False):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = {}
+        for info in zip_ref.infolist():
+            file_name = os.path.basename(info.filename)
+            if file_name in files and file_name not in members:
+                members[file_name] = [info.CRC, info.file_size]
+    identity = {'files': sorted(files), 'members': members, 'streaming': bool(streaming), 'compact': bool(compact)}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+# True if db_path is an unfinished conversion of the same feed, read without opening an engine on it
+def can_resume(db_path, fingerprint):
+    if not os.path.exists(db_path):
+        return False
+    try:
+        with sqlite3.connect(f'file:{db_path}?mode=ro', uri=True) as conn:
+            feeds = {feed for feed, in conn.execute(f"SELECT DISTINCT feed FROM {LEDGER_TABLE}")}
+    except sqlite3.Error:
+        return False
+    return feeds == {fingerprint}
+
+
+# Slices of a dataframe already in memory, so it is committed chunk_size rows at a time like a streamed file
+def frame_chunks(dataframe, chunk_size):
+    for start in range(0, len(dataframe), chunk_size):
+        yield dataframe.iloc[start:start + chunk_size]
+
+
+class ConversionLedger:
+    def __init__(self, engine, fingerprint):
+        self.engine = engine
+        self.fingerprint = fingerprint
+        with engine.begin() as conn:
+            conn.exec_driver_sql(CREATE_LEDGER)
+            rows = conn.execute(text(f"SELECT step, rows, done FROM {LEDGER_TABLE} WHERE feed = :feed"),
+                                {'feed': fingerprint}).all()
+        self.progress = {step: (rows, bool(done)) for step, rows, done in rows}
+        if self.progress:
+            logger.info(f"Resuming the conversion: {self.describe()}")
+
+    def describe(self):
+        return ', '.join(f"{step} done" if done else f"{step} at {rows} rows" for step, (rows, done) in self.progress.items())
+
+    def rows(self, step):
+        return self.progress.get(step, (0, False))[0]
+
+    def done(self, step):
+        return self.progress.get(step, (0, False))[1]
+
+    # Saved with conn, in the same transaction as the rows it counts
+    def record(self, conn, step, rows=0, done=False):
+        conn.execute(text(f"""
+            INSERT INTO {LEDGER_TABLE} (step, feed, rows, done, updated_at) VALUES (:step, :feed, :rows, :done, :updated_at)
+            ON CONFLICT (step) DO UPDATE SET rows = excluded.rows, done = excluded.done, updated_at = excluded.updated_at
+        """), {'step': step, 'feed': self.fingerprint, 'rows': rows, 'done': int(done),
+               'updated_at': datetime.now().isoformat(timespec='seconds')})
+        self.progress[step] = (rows, done)
+
+    # Inserts the chunks of a table one transaction each, together with the number of rows of the file committed so
+    # far. Rows committed by a previous run are skipped, prepare (if any) only runs on the chunks actually inserted.
+    # A chunk that fails raises: it rolls back with its ledger row and the conversion stops, the next run retries it
+    def insert(self, table_name, chunks, prepare=None):
+        if self.done(table_name):
+            logger.info(f"{table_name} already inserted, skipping it")
+            return 0
+        committed = self.rows(table_name)
+        position = inserted = 0
+        start = time.perf_counter()
+        for chunk in chunks:
+            end = position + len(chunk)
+            if end > committed:
+                if committed > position:
+                    chunk = chunk.iloc[committed - position:].copy()
+                if prepare:
+                    prepare(chunk)
+                with self.engine.begin() as conn:
+                    inserted += insert_chunk(conn, table_name, chunk, strict=True)
+                    self.record(conn, table_name, end)
+            position = end
+        with self.engine.begin() as conn:
+            self.record(conn, table_name, position, done=True)
+        log_insert_rate(table_name, inserted, time.perf_counter() - start)
+        return inserted
+
+    # Runs a step after the inserts as a stage of the conversion, unless a previous run already finished it.
+    # Steps are rebuilt from scratch when they run, one that failed halfway just runs again
+    def run(self, step, function, *args, **kwargs):
+        if self.done(step):
+            logger.info(f"{step} already done, skipping it")
+            return None
+        with stage(step):
+            result = function(*args, **kwargs)
+        with self.engine.begin() as conn:
+            self.record(conn, step, done=True)
+        return result
+
+    def finish(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {LEDGER_TABLE}")
+        self.progress = {}
@@ -0,0 +1,210 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import pandas as pd
+from sqlalchemy import Integer, Float, create_engine, inspect
+from database import define_tables, metadata
+from analytics import trip_spans, compute_route_stats, trip_table
+from service_calendar import ServiceCalendar, DAYS
+
+logger = logging.getLogger(__name__)
+
+# pyarrow is optional like in gtfs_processor.py, duckdb too: without it the queries run on pyarrow + pandas
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+try:
+    import duckdb
+    HAS_DUCKDB = True
+except ImportError:
+    HAS_DUCKDB = False
+
+# Rows per parquet file: every table is a folder of part-NNNNN.parquet files of at most this many rows,
+# written one at a time so the export never needs a whole stop_times in memory
+PART_ROWS = 1000000
+READ_CHUNK_SIZE = 500000
+MANIFEST = 'feed.json'
+
+# Bookkeeping and compact storage tables, a compact stop_times is exported through its view like a normal one
+SKIPPED_TABLES = {'feed_files', 'patterns', 'pattern_times', 'pattern_trips'}
+
+
+def require_pyarrow():
+    if not HAS_PYARROW:
+        raise RuntimeError("pyarrow is needed for the parquet backend, install it with: pip install pyarrow")
+
+
+# Arrow schema of a table from its definition in database.py, so every part file of a table has the same types
+# whatever pandas guessed for that chunk
+def table_schema(table_name):
+    define_tables()
+    types = {Integer: pa.int64(), Float: pa.float64()}
+    return pa.schema([(column.name, types.get(type(column.type), pa.string()))
+                      for column in metadata.tables[table_name].columns])
+
+
+def to_arrow(df, schema):
+    df = df.copy()
+    for field in schema:
+        if field.name not in df.columns:
+            df[field.name] = None
+        elif pa.types.is_string(field.type):
+            # Categoricals and numbers read where strings are expected (ids like 123) are written as text
+            values = df[field.name].astype(object)
+            df[field.name] = values.where(values.isna(), values.astype(str))
+    return pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+
+def write_parts(table_name, chunks, output_dir):
+    schema = table_schema(table_name)
+    table_dir = os.path.join(output_dir, table_name)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    os.makedirs(table_dir)
+
+    rows = parts = 0
+    for chunk in chunks:
+        for start in range(0, len(chunk), PART_ROWS):
+            part = chunk.iloc[start:start + PART_ROWS]
+            pq.write_table(to_arrow(part, schema), os.path.join(table_dir, f'part-{parts:05d}.parquet'), compression='zstd')
+            rows += len(part)
+            parts += 1
+    if not parts:
+        pq.write_table(schema.empty_table(), os.path.join(table_dir, 'part-00000.parquet'))
+    return rows
+
+
+# Output backend next to SQLite: writes every table as parquet under output_dir/<table>/, from the dataframes of the
+# conversion when we have them, otherwise from the database (read a chunk at a time, compact stop_times works too)
+def export_parquet(output_dir, engine=None, dataframes=None, tables=None):
+    require_pyarrow()
+    start = time.perf_counter()
+    define_tables()
+    dataframes = dataframes or {}
+    existing = set(inspect(engine).get_table_names()) | set(inspect(engine).get_view_names()) if engine is not None else set()
+    tables = tables or [name for name in metadata.tables
+                        if name not in SKIPPED_TABLES and (name in dataframes or name in existing)]
+    os.makedirs(output_dir, exist_ok=True)
+
+    counts = {}
+    for table_name in tables:
+        if table_name in dataframes:
+            chunks = [dataframes[table_name]]
+        elif table_name in existing:
+            chunks = pd.read_sql(f'SELECT * FROM "{table_name}"', engine, chunksize=READ_CHUNK_SIZE)
+        else:
+            continue
+        table_start = time.perf_counter()
+        counts[table_name] = write_parts(table_name, chunks, output_dir)
+        logger.info(f"Exported {counts[table_name]} rows of {table_name} to parquet in {time.perf_counter() - table_start:.2f}s")
+
+    with open(os.path.join(output_dir, MANIFEST), 'w') as f:
+        json.dump({'tables': counts, 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+    logger.info(f"Parquet export of {len(counts)} tables done in {time.perf_counter() - start:.2f}s")
+    return counts
+
+
+# Read side: a folder written by export_parquet. Tables are read column by column with pyarrow (only the columns
+# asked for, filters pushed down to the files); with duckdb installed query() also runs SQL straight on the files
+class ColumnarFeed:
+    def __init__(self, path):
+        require_pyarrow()
+        self.path = path
+        self._route_stats = None
+        self._trip_table = None
+        self._lock = threading.Lock()
+
+    def has_table(self, table_name):
+        return os.path.isdir(os.path.join(self.path, table_name))
+
+    def dataset(self, table_name):
+        return ds.dataset(os.path.join(self.path, table_name), format='parquet')
+
+    def read(self, table_name, columns=None, filter=None):
+        if not self.has_table(table_name):
+            return None
+        return self.dataset(table_name).to_table(columns=columns, filter=filter).to_pandas()
+
+    def query(self, sql):
+        if not HAS_DUCKDB:
+            raise RuntimeError("duckdb is needed for SQL queries on the parquet files, install it with: pip install duckdb")
+        with duckdb.connect() as conn:
+            for table_name in os.listdir(self.path):
+                if self.has_table(table_name):
+                    conn.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{os.path.join(self.path, table_name)}/*.parquet')")
+            return conn.execute(sql).df()
+
+    # Same numbers as the route_stats table (analytics.py) for every route, computed once per feed
+    def route_stats(self):
+        with self._lock:
+            if self._route_stats is None:
+                start = time.perf_counter()
+                stop_times = self.read('stop_times', ['trip_id', 'arrival_secs', 'departure_secs', 'stop_sequence'])
+                calendar = self.read('calendar', ['service_id'] + DAYS + ['start_date', 'end_date'])
+                calendar_dates = self.read('calendar_dates', ['service_id', 'date', 'exception_type'])
+                stats = compute_route_stats(self.read('trips', ['trip_id', 'route_id', 'direction_id', 'service_id']),
+                                            trip_spans([stop_times]),
+                                            ServiceCalendar(calendar, calendar_dates).weekday_frame())
+                self._route_stats = stats.set_index(['route_id', 'direction_id'])
+                logger.info(f"Route statistics computed from {self.path} in {time.perf_counter() - start:.2f}s")
+            return self._route_stats
+
+    # analytics.trip_table of the whole feed, for the network-wide numbers
+    def trip_table(self):
+        with self._lock:
+            if self._trip_table is None:
+                stop_times = self.read('stop_times', ['trip_id', 'arrival_secs', 'departure_secs', 'stop_sequence'])
+                self._trip_table = trip_table(self.read('trips', ['trip_id', 'route_id', 'service_id']), trip_spans([stop_times]))
+            return self._trip_table
+
+    def service_calendar(self):
+        return ServiceCalendar(self.read('calendar'), self.read('calendar_dates'))
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+# One ColumnarFeed per folder, replaced when the folder is exported again
+def get_columnar_feed(path):
+    manifest = os.path.join(path, MANIFEST)
+    key = (os.path.abspath(path), os.path.getmtime(manifest) if os.path.exists(manifest) else None)
+    with _feeds_lock:
+        feed = _feeds.get(key)
+        if feed is None:
+            for old_key in [old_key for old_key in _feeds if old_key[0] == key[0]]:
+                del _feeds[old_key]
+            feed = _feeds[key] = ColumnarFeed(path)
+    return feed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m columnar', description="Export a converted GTFS database to parquet")
+    parser.add_argument('db_path', help="sqlite database created by the conversion")
+    parser.add_argument('output_dir', help="folder for the parquet files (one subfolder per table)")
+    parser.add_argument('--tables', help="comma separated tables to export (default: all)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(f'sqlite:///{args.db_path}')
+    try:
+        export_parquet(args.output_dir, engine, tables=args.tables.split(',') if args.tables else None)
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        return 1
+    finally:
+        engine.dispose()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import json
+import numpy as np
+import pandas as pd
+import logging
+import time
+from sqlalchemy import inspect
+from database import metadata, insert_chunk
+from gtfs_time import times_to_seconds
+from route_patterns import whole_trip_chunks, READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Everything a stop_times row has apart from the trip and its times, a pattern is a sequence of rows equal in
+# all of these. Times are kept per trip apart, as offsets from the trip start (TIME_COLUMNS)
+PATTERN_COLUMNS = ['stop_id', 'stop_sequence', 'stop_headsign', 'pickup_type', 'drop_off_type',
+                   'shape_dist_traveled', 'timepoint']
+TIME_COLUMNS = ['arrival_offsets', 'departure_offsets']
+
+
+def is_compact(engine):
+    return 'stop_times' in inspect(engine).get_view_names()
+
+
+# Seconds column of a chunk, from the secs columns written at import or parsing the time strings
+def chunk_seconds(chunk, column):
+    if f'{column}_secs' in chunk.columns:
+        return pd.to_numeric(chunk[f'{column}_secs'], errors='coerce').astype(float)
+    if f'{column}_time' in chunk.columns:
+        return times_to_seconds(chunk[f'{column}_time'].astype(object)).set_axis(chunk.index)
+    return pd.Series(np.nan, index=chunk.index)
+
+
+# Offsets of a trip as a JSON array (null for a missing time), read back by the view with json_extract
+def offsets_json(offsets):
+    return json.dumps(offsets, separators=(',', ':'))
+
+
+# Splits stop_times into (patterns, pattern_times, pattern_trips) rows. Every row is reduced to a row id shared by
+# all the rows with the same stop and flags, a trip is then the sequence of its row ids and every distinct sequence
+# is a pattern, stored once whatever the times of its trips. The times of a trip are its offsets from the first
+# arrival, one array per trip, and trips with the same offsets (same running times at another hour) share them
+def compact_trips(stop_times_chunks):
+    row_ids, rows = {}, []
+    pattern_ids, pattern_rows = {}, []
+    times_ids, times_rows = {}, []
+    trip_ids, trip_pattern_ids, trip_times_ids, trip_starts = [], [], [], []
+
+    for chunk in whole_trip_chunks(stop_times_chunks):
+        for column in PATTERN_COLUMNS:
+            if column not in chunk.columns:
+                chunk[column] = None
+        arrivals, departures = chunk_seconds(chunk, 'arrival'), chunk_seconds(chunk, 'departure')
+        trips = chunk['trip_id']
+        start = arrivals.groupby(trips, sort=False).transform('first')
+        start = start.fillna(departures.groupby(trips, sort=False).transform('first'))
+        for column, seconds in (('arrival_offsets', arrivals), ('departure_offsets', departures)):
+            offsets = pd.array((seconds - start).round(), dtype='Int64').astype(object)
+            chunk[column] = np.where(pd.isna(offsets), None, offsets)
+
+        # Row ids local to the chunk, mapped to the global ones through the values of one row per id
+        local = chunk.groupby(PATTERN_COLUMNS, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+        unique_local, first_positions = np.unique(local, return_index=True)
+        values = chunk[PATTERN_COLUMNS].iloc[first_positions].astype(object)
+        values = values.where(values.notna(), None).itertuples(index=False, name=None)
+        to_global = np.empty(len(unique_local), dtype=np.int64)
+        for position, row in enumerate(values):
+            row_id = row_ids.get(row)
+            if row_id is None:
+                row_id = row_ids[row] = len(rows)
+                rows.append(row)
+            to_global[position] = row_id
+        chunk['row_id'] = to_global[np.searchsorted(unique_local, local)]
+
+        grouped = chunk.groupby('trip_id', sort=False)
+        sequences = grouped['row_id'].agg(tuple)
+        times = zip(grouped['arrival_offsets'].agg(list), grouped['departure_offsets'].agg(list))
+        for sequence, (arrival_offsets, departure_offsets) in zip(sequences, times):
+            pattern_id = pattern_ids.get(sequence)
+            if pattern_id is None:
+                pattern_id = pattern_ids[sequence] = len(pattern_rows)
+                pattern_rows.append(sequence)
+            trip_pattern_ids.append(pattern_id)
+            times_row = (offsets_json(arrival_offsets), offsets_json(departure_offsets))
+            times_id = times_ids.get(times_row)
+            if times_id is None:
+                times_id = times_ids[times_row] = len(times_rows)
+                times_rows.append(times_row)
+            trip_times_ids.append(times_id)
+        trip_ids.extend(sequences.index)
+        trip_starts.append(start.groupby(trips, sort=False).first().to_numpy())
+
+    lengths = np.array([len(sequence) for sequence in pattern_rows], dtype=np.int64)
+    flat_rows = [rows[row_id] for sequence in pattern_rows for row_id in sequence]
+    patterns = pd.DataFrame(flat_rows, columns=PATTERN_COLUMNS)
+    patterns.insert(0, 'pattern_id', np.repeat(np.arange(len(pattern_rows)), lengths))
+    patterns.insert(1, 'position', np.concatenate([np.arange(length) for length in lengths]) if len(lengths) else [])
+    for column in ('stop_sequence', 'pickup_type', 'drop_off_type', 'timepoint'):
+        patterns[column] = pd.to_numeric(patterns[column], errors='coerce').round().astype('Int64')
+
+    pattern_times = pd.DataFrame(times_rows, columns=TIME_COLUMNS)
+    pattern_times.insert(0, 'times_id', np.arange(len(times_rows), dtype=np.int64))
+
+    starts = np.concatenate(trip_starts) if trip_starts else np.zeros(0)
+    pattern_trips = pd.DataFrame({
+        'trip_id': pd.Series(trip_ids, dtype=object),
+        'pattern_id': np.array(trip_pattern_ids, dtype=np.int64),
+        'times_id': np.array(trip_times_ids, dtype=np.int64),
+        'start_secs': pd.array(np.round(starts), dtype='Int64'),
+    })
+    return patterns, pattern_times, pattern_trips
+
+
+# HH:MM:SS in SQL, same as gtfs_time.format_times
+def format_time_sql(seconds):
+    return (f"CASE WHEN {seconds} IS NULL THEN NULL "
+            f"ELSE printf('%02d:%02d:%02d', {seconds} / 3600, {seconds} % 3600 / 60, {seconds} % 60) END")
+
+
+# Offset of the row at its position in the pattern, out of the JSON array of the trip
+def offset_sql(column):
+    return f"json_extract(pattern_times.{column}, '$[' || patterns.position || ']')"
+
+
+# stop_times rebuilt from the three tables, with the same columns in the same order as the original table
+def stop_times_view_sql():
+    arrival = f"(pattern_trips.start_secs + {offset_sql('arrival_offsets')})"
+    departure = f"(pattern_trips.start_secs + {offset_sql('departure_offsets')})"
+    computed = {
+        'trip_id': 'pattern_trips.trip_id',
+        'arrival_time': format_time_sql(arrival),
+        'departure_time': format_time_sql(departure),
+        'arrival_secs': arrival,
+        'departure_secs': departure,
+    }
+    columns = [f'{computed.get(column.name, f"patterns.{column.name}")} AS {column.name}'
+               for column in metadata.tables['stop_times'].columns]
+    return (f"CREATE VIEW stop_times AS SELECT {', '.join(columns)} "
+            f"FROM pattern_trips JOIN patterns ON patterns.pattern_id = pattern_trips.pattern_id "
+            f"JOIN pattern_times ON pattern_times.times_id = pattern_trips.times_id")
+
+
+# Optional last stage of the conversion: replaces the stop_times table with patterns, pattern_times and
+# pattern_trips and a
+# stop_times view on top of them, so everything reading stop_times keeps working. Times come back normalized
+# (5:00:00 is read back as 05:00:00, invalid times as NULL).
+# With the dataframes stop_times doesn't need to be inserted at all, otherwise it is read back, dropped and the
+# file vacuumed
+def compact_stop_times(engine, dataframes=None):
+    start = time.perf_counter()
+    dataframes = dataframes or {}
+    if 'stop_times' in dataframes:
+        stop_times_chunks = [dataframes['stop_times']]
+    else:
+        stop_times_chunks = pd.read_sql('SELECT * FROM stop_times ORDER BY trip_id, stop_sequence', engine,
+                                        chunksize=READ_CHUNK_SIZE)
+    patterns, pattern_times, pattern_trips = compact_trips(stop_times_chunks)
+
+    with engine.begin() as conn:
+        for table_name in ('patterns', 'pattern_times', 'pattern_trips'):
+            conn.exec_driver_sql(f"DELETE FROM {table_name}")
+        pattern_count = insert_chunk(conn, 'patterns', patterns)
+        times_count = insert_chunk(conn, 'pattern_times', pattern_times)
+        trip_count = insert_chunk(conn, 'pattern_trips', pattern_trips)
+        conn.exec_driver_sql("DROP TABLE IF EXISTS stop_times")
+        conn.exec_driver_sql("DROP VIEW IF EXISTS stop_times")
+        conn.exec_driver_sql(stop_times_view_sql())
+
+    if 'stop_times' not in dataframes and engine.dialect.name == 'sqlite':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql("VACUUM")
+
+    rows = int(pattern_trips['pattern_id'].map(patterns.groupby('pattern_id').size()).sum()) if trip_count else 0
+    stored = pattern_count + times_count + trip_count
+    ratio = f"{rows / stored:.1f}:1" if stored else "n/a"
+    logger.info(f"stop_times compacted: {rows} rows stored as {pattern_count} pattern rows "
+                f"({patterns['pattern_id'].nunique()} patterns), {times_count} time profiles and {trip_count} trips, "
+                f"compaction ratio {ratio} in {time.perf_counter() - start:.2f}s")
+    return pattern_count
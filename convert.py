@@ -0,0 +1,143 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from gtfs_processor import process_gtfs_file, is_resumable, select_files, STREAM_CHUNK_SIZE, GTFS_FILES
+
+logger = logging.getLogger(__name__)
+
+# Command line and library entry point for the conversion, no tkinter involved:
+#   python -m convert feed.zip -o feed.db
+#   python -m convert feed1.zip feed2.zip feed3.zip --output-dir databases --jobs 3
+# From python: convert_feed('feed.zip', 'feed.db') or convert_feeds([('a.zip', 'a.db'), ('b.zip', 'b.db')])
+
+
+def log_progress(percentage):
+    logger.info(f"Progress: {percentage}%")
+
+
+# Parquet folder written next to a database with parquet=True (--parquet)
+def parquet_path(db_path):
+    return os.path.splitext(db_path)[0] + '_parquet'
+
+
+# Converts a single feed, raises if it fails. options are the keyword arguments of process_gtfs_file
+# (streaming, chunk_size, parse_backend, workers, csv_engine, incremental, tables, compact, parquet_dir, headways, resume).
+# An unfinished conversion of the same feed at db_path is resumed, it doesn't need overwrite
+def convert_feed(zip_path, db_path, progress_callback=log_progress, overwrite=False, parquet=False, **options):
+    if (os.path.exists(db_path) and not overwrite and not options.get('incremental')
+            and not (options.get('resume', True) and is_resumable(zip_path, db_path, **options))):
+        raise FileExistsError(f"{db_path} already exists, use overwrite=True (--overwrite) to replace it")
+    if parquet and not options.get('parquet_dir'):
+        options['parquet_dir'] = parquet_path(db_path)
+
+    start = time.perf_counter()
+    if not process_gtfs_file(zip_path, db_path, progress_callback, **options):
+        raise RuntimeError(f"Conversion of {zip_path} failed, check the log for details")
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"{zip_path} converted into {db_path} in {elapsed:.2f}s")
+    return {'zip_path': zip_path, 'db_path': db_path, 'seconds': elapsed}
+
+
+# Converts many feeds at the same time, one process per feed. jobs is a list of (zip_path, db_path).
+# progress_callback runs in the worker processes, so it has to be a module level function.
+# Returns one result per job, the failed ones have an 'error' instead of 'seconds'
+def convert_feeds(jobs, max_workers=None, progress_callback=log_progress, overwrite=False, **options):
+    if options.get('parse_backend') == 'processes':
+        # Pool workers can't start a pool of their own
+        logger.warning("parse_backend='processes' is not available when converting many feeds, using threads")
+        options['parse_backend'] = 'threads'
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_feed, zip_path, db_path, progress_callback, overwrite, **options): (zip_path, db_path)
+                   for zip_path, db_path in jobs}
+        for future in as_completed(futures):
+            zip_path, db_path = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Error converting {zip_path}: {e}")
+                results.append({'zip_path': zip_path, 'db_path': db_path, 'error': str(e)})
+    return results
+
+
+def parse_args(argv=None):
+    table_names = [file.split('.')[0] for file in GTFS_FILES]
+    parser = argparse.ArgumentParser(prog='python -m convert', description="Convert GTFS zip files into SQLite databases")
+    parser.add_argument('zip_paths', nargs='+', metavar='ZIP', help="GTFS zip file(s) to convert")
+    parser.add_argument('-o', '--output', help="database file to create (only with a single zip)")
+    parser.add_argument('--output-dir', help="folder for the databases, named after the zip files (default: next to them)")
+    parser.add_argument('--overwrite', action='store_true', help="replace databases that already exist")
+    parser.add_argument('--incremental', action='store_true', help="update existing databases with only what changed")
+    parser.add_argument('--restart', action='store_true', help="start over instead of resuming an unfinished conversion of the same feed")
+    parser.add_argument('--streaming', action='store_true', help="read the files in chunks straight from the zip (low memory)")
+    parser.add_argument('--chunk-size', type=int, default=STREAM_CHUNK_SIZE, help="rows inserted and committed at a time (default: %(default)s)")
+    parser.add_argument('--backend', choices=['threads', 'processes'], default='threads', help="how the files are parsed (default: %(default)s)")
+    parser.add_argument('--csv-engine', choices=['c', 'pyarrow'], help="pandas csv parser (default: pyarrow when installed)")
+    parser.add_argument('--workers', type=int, help="parsing threads/processes per feed (default: cpu count)")
+    parser.add_argument('--jobs', type=int, default=1, help="feeds converted at the same time (default: %(default)s)")
+    parser.add_argument('--compact', action='store_true', help="store stop_times as trip patterns (smaller file, stop_times becomes a view)")
+    parser.add_argument('--headways', action='store_true', help="precompute the headways of every stop by route, weekday and hour")
+    parser.add_argument('--parquet', action='store_true', help="also write every table as parquet files, in <database>_parquet/")
+    parser.add_argument('--tables', help=f"comma separated tables to load (default: all of {', '.join(table_names)})")
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.zip_paths) > 1:
+        parser.error("--output can only be used with a single zip, use --output-dir")
+    if args.tables:
+        args.tables = [table.strip() for table in args.tables.split(',') if table.strip()]
+        try:
+            select_files(args.tables)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+def output_path(zip_path, args):
+    if args.output:
+        return args.output
+    folder = args.output_dir or os.path.dirname(os.path.abspath(zip_path))
+    return os.path.join(folder, os.path.splitext(os.path.basename(zip_path))[0] + '.db')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    options = {
+        'streaming': args.streaming,
+        'chunk_size': args.chunk_size,
+        'parse_backend': args.backend,
+        'workers': args.workers,
+        'csv_engine': args.csv_engine,
+        'incremental': args.incremental,
+        'tables': args.tables,
+        'compact': args.compact,
+        'parquet': args.parquet,
+        'headways': args.headways,
+        'resume': not args.restart,
+    }
+    jobs = [(zip_path, output_path(zip_path, args)) for zip_path in args.zip_paths]
+
+    if len(jobs) == 1 or args.jobs <= 1:
+        results = []
+        for zip_path, db_path in jobs:
+            try:
+                results.append(convert_feed(zip_path, db_path, overwrite=args.overwrite, **options))
+            except Exception as e:
+                logger.error(f"Error converting {zip_path}: {e}")
+                results.append({'zip_path': zip_path, 'db_path': db_path, 'error': str(e)})
+    else:
+        results = convert_feeds(jobs, max_workers=args.jobs, overwrite=args.overwrite, **options)
+
+    failed = [result for result in results if 'error' in result]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
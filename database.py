@@ -1,8 +1,9 @@
-from sqlalchemy import Table, Column, Integer, String, MetaData, create_engine, PrimaryKeyConstraint
+from sqlalchemy import Table, Column, Integer, Float, String, MetaData, create_engine, PrimaryKeyConstraint, event, inspect
 from sqlalchemy.pool import QueuePool
 from sqlalchemy.exc import SQLAlchemyError
 import pandas as pd
 import logging
+import time
 
 
 
@@ -16,10 +17,19 @@ metadata = MetaData()
 #At the moment you also have to add the needed txt files in the list you can find in gtfs_processor.py
 # but I'll modify that soon
 
-def create_tables(engine):
+# Strings repeated a lot in the big files (the ids in stop_times and trips), with this info the csv readers
+# keep them as pandas categoricals: every distinct value is stored once and the rows only hold a small code
+CATEGORY = {'pandas_dtype': 'category'}
+
+
+# Declares every table in metadata, the csv readers also need it (for the column types) before any database exists.
+# Calling it more than once is fine, the tables are only declared the first time
+def define_tables():
     global metadata
 
-    
+    if metadata.tables:
+        return metadata
+
     agency = Table('agency', metadata,
         Column('agency_id', String, primary_key=True),
         Column('agency_name', String),
@@ -37,8 +47,8 @@ def create_tables(engine):
         Column('stop_name', String),
         Column('tts_stop_name', String),
         Column('stop_desc', String),
-        Column('stop_lat', String),
-        Column('stop_lon', String),
+        Column('stop_lat', Float),
+        Column('stop_lon', Float),
         Column('zone_id', String),
         Column('stop_url', String),
         Column('wheelchair_boarding', Integer),
@@ -62,29 +72,32 @@ def create_tables(engine):
     )
 
     trips = Table('trips', metadata,
-        Column('route_id', String),
-        Column('service_id', String),
+        Column('route_id', String, info=CATEGORY),
+        Column('service_id', String, info=CATEGORY),
         Column('trip_id', String, primary_key=True),
-        Column('trip_headsign', String),
+        Column('trip_headsign', String, info=CATEGORY),
         Column('trip_short_name', String),
         Column('direction_id', Integer),
-        Column('block_id', String),
-        Column('shape_id', String),
+        Column('block_id', String, info=CATEGORY),
+        Column('shape_id', String, info=CATEGORY),
         Column('wheelchair_accessible', Integer),
         Column('exceptional', Integer)
     )
 
     stop_times = Table('stop_times', metadata,
-        Column('trip_id', String, primary_key=True),
+        Column('trip_id', String, primary_key=True, info=CATEGORY),
         Column('arrival_time', String),
         Column('departure_time', String),
-        Column('stop_id', String),
+        Column('stop_id', String, info=CATEGORY),
         Column('stop_sequence', Integer, primary_key=True),
-        Column('stop_headsign', String),
+        Column('stop_headsign', String, info=CATEGORY),
         Column('pickup_type', Integer),
         Column('drop_off_type', Integer),
         Column('shape_dist_traveled', String),
         Column('timepoint', Integer),
+        # Not in the GTFS file, arrival/departure converted to seconds from the start of the service day (gtfs_time.py)
+        Column('arrival_secs', Integer),
+        Column('departure_secs', Integer),
         PrimaryKeyConstraint('trip_id', 'stop_sequence')
     )
 
@@ -102,48 +115,277 @@ def create_tables(engine):
     )
     
     calendar_dates = Table('calendar_dates', metadata,
-        Column('service_id', String, primary_key=True),
+        Column('service_id', String, primary_key=True, info=CATEGORY),
         Column('date', Integer, primary_key=True),
         Column('exception_type', Integer)
     )
 
-    
+    # Tables below are not in the GTFS files, they are computed at the end of the conversion (see analytics.py)
+    days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+    route_stats = Table('route_stats', metadata,
+        Column('route_id', String, primary_key=True),
+        Column('direction_id', Integer, primary_key=True),
+        *[Column(f'trips_{day}', Integer) for day in days],
+        *[Column(f'avg_time_{day}', Float) for day in days]
+    )
+
+    # Stops of the most common stop pattern of every route/direction in order (route_patterns.py), drawn on the map
+    route_shapes = Table('route_shapes', metadata,
+        Column('route_id', String, primary_key=True),
+        Column('direction_id', Integer, primary_key=True),
+        Column('position', Integer, primary_key=True),
+        Column('stop_id', String),
+        Column('stop_name', String),
+        Column('stop_lat', Float),
+        Column('stop_lon', Float)
+    )
+
+    # Optional (headways.py): minutes between consecutive departures by stop, route, weekday and hour
+    stop_headways = Table('stop_headways', metadata,
+        Column('stop_id', String, primary_key=True),
+        Column('route_id', String, primary_key=True),
+        Column('day', String, primary_key=True),
+        Column('hour', Integer, primary_key=True),
+        Column('departures', Integer),
+        Column('avg_headway', Float),
+        Column('min_headway', Float),
+        Column('max_headway', Float)
+    )
+
+    # Compact storage of stop_times (compact_storage.py, optional): every distinct sequence of stops is stored once
+    # as a pattern, every distinct set of times relative to the trip start once as JSON arrays of offsets, a trip is
+    # its pattern, its times and its start time. stop_times becomes a view over these three
+    patterns = Table('patterns', metadata,
+        Column('pattern_id', Integer, primary_key=True),
+        Column('position', Integer, primary_key=True),
+        Column('stop_id', String),
+        Column('stop_sequence', Integer),
+        Column('stop_headsign', String),
+        Column('pickup_type', Integer),
+        Column('drop_off_type', Integer),
+        Column('shape_dist_traveled', String),
+        Column('timepoint', Integer)
+    )
+
+    pattern_times = Table('pattern_times', metadata,
+        Column('times_id', Integer, primary_key=True),
+        Column('arrival_offsets', String),
+        Column('departure_offsets', String)
+    )
+
+    pattern_trips = Table('pattern_trips', metadata,
+        Column('trip_id', String, primary_key=True),
+        Column('pattern_id', Integer),
+        Column('times_id', Integer),
+        Column('start_secs', Integer)
+    )
+
+    # Hash of every file of the feed the database was built from, used by the incremental update (feed_update.py)
+    feed_files = Table('feed_files', metadata,
+        Column('file_name', String, primary_key=True),
+        Column('sha256', String),
+        Column('updated_at', String)
+    )
+
+    return metadata
+
+
+def create_tables(engine):
+    define_tables()
     metadata.create_all(engine)
 
+
+# pandas dtypes for the columns of a table, so the csv files can be read without letting pandas guess.
+# Integers are read as nullable Int64 (most GTFS integer columns are optional) and downcast after reading,
+# reading them straight into a smaller type would silently overflow on bad values.
+# Floats stay float64, coordinates need the precision
+PANDAS_DTYPES = {Integer: 'Int64', Float: 'float64', String: 'str'}
+
+
+def table_dtypes(table_name):
+    define_tables()
+    if table_name not in metadata.tables:
+        return {}
+    return {column.name: column.info.get('pandas_dtype', PANDAS_DTYPES.get(type(column.type), 'str'))
+            for column in metadata.tables[table_name].columns}
+
+
 # Before inserting the data we filter it to only get the tables/rows listed above here
 # The processing speed of this part can probably be enhanced  with some optimizations
 
-def insert_data(engine, dataframes):
+def insert_data(engine, dataframes, bulk=True):
     global metadata
     
     with engine.begin() as conn:
         for table_name, dataframe in dataframes.items():
-            if table_name in metadata.tables:
-                table = metadata.tables[table_name]
-                
-                # Filter dataframe columns to match the table columns
-                table_columns = set(column.name for column in table.columns)
-                df_columns = set(dataframe.columns)
-                valid_columns = list(table_columns.intersection(df_columns))
-                
-                filtered_df = dataframe[valid_columns]
-                
-                # Converting dataframe to a list of dicts and then splitting the data insertion in chunks to speed up.
-                # Chuck_size can be modified as needed, raising or lowering it will (should) impact the time needed to complete the inserts
-                try:
-                    
-                    data = filtered_df.to_dict('records')
-                    
-                    chunk_size = 50000  
-                    for i in range(0, len(data), chunk_size):
-                        chunk = data[i:i+chunk_size]
-                        result = conn.execute(table.insert(), chunk)
-                    
-                    logger.info(f"Inserted {len(data)} rows into {table_name}")
-                except SQLAlchemyError as e:
-                    logger.error(f"Error inserting data into {table_name}: {str(e)}")
-            else:
-                logger.warning(f"Table '{table_name}' not found in metadata.")
+            start = time.perf_counter()
+            rows = insert_chunk(conn, table_name, dataframe, bulk)
+            log_insert_rate(table_name, rows, time.perf_counter() - start)
+
+
+# Inserts a single dataframe (a whole file or just one chunk of it) into its table using an already open connection,
+# this is shared by insert_data and by the streaming import in gtfs_processor.py
+# With bulk=True (and a sqlite database) it goes through the bulk loader below, otherwise through the SQLAlchemy insert.
+# Errors are logged and the chunk skipped (0 rows), with strict=True they are raised so the caller's transaction
+# rolls back with them
+def insert_chunk(conn, table_name, dataframe, bulk=True, strict=False):
+    global metadata
+
+    if table_name not in metadata.tables:
+        logger.warning(f"Table '{table_name}' not found in metadata.")
+        return 0
+
+    table = metadata.tables[table_name]
+
+    # Filter dataframe columns to match the table columns, keeping the table order
+    valid_columns = [column.name for column in table.columns if column.name in dataframe.columns]
+
+    filtered_df = dataframe[valid_columns]
+
+    if bulk and conn.dialect.name == 'sqlite':
+        return bulk_insert_chunk(conn, table_name, filtered_df, strict)
+
+    # Converting dataframe to a list of dicts and then splitting the data insertion in chunks to speed up.
+    # Chuck_size can be modified as needed, raising or lowering it will (should) impact the time needed to complete the inserts
+    try:
+
+        data = filtered_df.to_dict('records')
+
+        chunk_size = 50000
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i+chunk_size]
+            result = conn.execute(table.insert(), chunk)
+
+        return len(data)
+    except SQLAlchemyError as e:
+        logger.error(f"Error inserting data into {table_name}: {str(e)}")
+        if strict:
+            raise
+        return 0
+
+
+# SQLite bulk loader: no dicts and no SQLAlchemy statement compilation, the rows are plain tuples sent
+# to the driver executemany with a single INSERT, which sqlite3 prepares once and reuses for every row.
+# The dataframe is converted in slices so we never have a second full copy of a big table as python objects
+def bulk_insert_chunk(conn, table_name, dataframe, strict=False):
+    if dataframe.empty:
+        return 0
+
+    columns = ', '.join(f'"{column}"' for column in dataframe.columns)
+    placeholders = ', '.join('?' for _ in dataframe.columns)
+    statement = f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})'
+
+    chunk_size = 50000
+    try:
+        for i in range(0, len(dataframe), chunk_size):
+            chunk = dataframe.iloc[i:i+chunk_size].astype(object)
+            # NaN/NA are not understood by sqlite3, they have to become None (NULL)
+            chunk = chunk.where(chunk.notna(), None)
+            conn.exec_driver_sql(statement, list(chunk.itertuples(index=False, name=None)))
+        return len(dataframe)
+    except SQLAlchemyError as e:
+        logger.error(f"Error inserting data into {table_name}: {str(e)}")
+        if strict:
+            raise
+        return 0
+
+
+def log_insert_rate(table_name, rows, elapsed):
+    rate = rows / elapsed if elapsed > 0 else 0
+    logger.info(f"Inserted {rows} rows into {table_name} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+
+# Settings used only on the connections of the engine that writes a new database.
+# sqlite never waits for the disk (synchronous OFF), only a crash of the whole machine can lose the last commits.
+# The rollback journal stays on disk though: conversions are committed chunk by chunk and resumed after a failure
+# (see checkpoint.py), a process killed in the middle of a commit must not leave a corrupt file behind. Appending to
+# new tables journals very few pages, it costs the same as keeping it in memory. cache_size is in KiB when negative (~256MB).
+# Secondary indexes are not declared in create_tables, they get built after all the inserts are done.
+INGEST_PRAGMAS = {
+    'journal_mode': 'TRUNCATE',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+}
+
+
+def enable_ingest_pragmas(engine):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_ingest_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in INGEST_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+# Secondary indexes for the queries the flask server runs, name -> (table, columns).
+# They are built after insert_data so the inserts don't have to keep them updated row by row.
+# trips by route/direction: /route_info and /stops
+# stop_times by trip and calendar_dates by service are covered by their primary keys, nothing to add for them.
+# The ilike('%...%') in /search can't use a normal index because of the leading wildcard, so nothing here for it
+QUERY_INDEXES = {
+    'idx_trips_route_direction': ('trips', ('route_id', 'direction_id')),
+}
+
+
+# True if an index (primary keys included) already starts with those columns
+def is_indexed(inspector, table_name, columns):
+    candidates = [index['column_names'] for index in inspector.get_indexes(table_name)]
+    candidates.append(inspector.get_pk_constraint(table_name)['constrained_columns'])
+    return any(tuple(candidate[:len(columns)]) == tuple(columns) for candidate in candidates)
+
+
+# QUERY_INDEXES a database doesn't have yet, name -> (table, columns). Tables or columns the file doesn't have are
+# skipped, so it works on databases that were not converted from here too
+def missing_indexes(inspector):
+    existing_tables = set(inspector.get_table_names())
+    missing = {}
+    for index_name, (table_name, columns) in QUERY_INDEXES.items():
+        if table_name not in existing_tables:
+            continue
+        table_columns = set(column['name'] for column in inspector.get_columns(table_name))
+        if not set(columns).issubset(table_columns):
+            logger.warning(f"Skipping index {index_name}, {table_name} has no {', '.join(columns)} columns")
+            continue
+        if not is_indexed(inspector, table_name, columns):
+            missing[index_name] = (table_name, columns)
+    return missing
+
+
+# True if ANALYZE ran on the file (sqlite_stat1 is left out by the inspector)
+def has_statistics(conn):
+    return conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").first() is not None
+
+
+# Creates the missing indexes listed above and refreshes the planner statistics with ANALYZE, only if an index was
+# created, the file has no statistics yet or analyze is set (the rows changed), so opening a database is cheap.
+# Running it again on the same file does nothing new.
+def build_indexes(engine, analyze=False):
+    created = 0
+    with engine.begin() as conn:
+        for index_name, (table_name, columns) in missing_indexes(inspect(engine)).items():
+            start = time.perf_counter()
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_list})')
+            created += 1
+            logger.info(f"Created index {index_name} in {time.perf_counter() - start:.2f}s")
+
+        if engine.dialect.name == 'sqlite' and (created or analyze or not has_statistics(conn)):
+            conn.exec_driver_sql("ANALYZE")
+
+    logger.info(f"Indexes ready ({created} created)")
+    return created
+
+
+# True if the table exists and isn't empty
+def has_rows(engine, table_name):
+    if not inspect(engine).has_table(table_name):
+        return False
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f'SELECT 1 FROM "{table_name}" LIMIT 1').first() is not None
 
 
 #Pooling should give a better performance in this context
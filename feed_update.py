@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import time
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import text, Float
+from database import metadata, table_dtypes, insert_chunk
+from gtfs_time import add_seconds_columns
+
+logger = logging.getLogger(__name__)
+
+# Tables the route statistics/shapes are computed from, if one of them changes route_stats/route_shapes have to be rebuilt
+ROUTE_STATS_SOURCES = {'trips', 'stop_times', 'calendar', 'calendar_dates'}
+ROUTE_SHAPES_SOURCES = {'trips', 'stop_times', 'stops'}
+
+
+# sha256 of every member, read straight out of the zip in blocks
+def hash_zip_members(zip_ref, members):
+    hashes = {}
+    for file, member in members.items():
+        digest = hashlib.sha256()
+        with zip_ref.open(member) as source:
+            for block in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(block)
+        hashes[file] = digest.hexdigest()
+    return hashes
+
+
+def load_file_hashes(conn):
+    rows = conn.execute(text("SELECT file_name, sha256 FROM feed_files")).all()
+    return {file_name: sha256 for file_name, sha256 in rows}
+
+
+# Saved at the end of every conversion/update, the next update compares against these.
+# Only the given files are replaced (and the removed ones deleted), a partial update keeps the other hashes
+def save_file_hashes(conn, hashes, removed=()):
+    replaced = list(hashes) + list(removed)
+    if replaced:
+        conn.execute(text("DELETE FROM feed_files WHERE file_name = :file_name"), [{'file_name': file} for file in replaced])
+    if not hashes:
+        return
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    conn.execute(text("INSERT INTO feed_files (file_name, sha256, updated_at) VALUES (:file_name, :sha256, :updated_at)"),
+                 [{'file_name': file, 'sha256': sha256, 'updated_at': updated_at} for file, sha256 in hashes.items()])
+
+
+# Values are compared as text on both sides: the file is read as strings and the table is selected with
+# CAST(... AS TEXT), so 1 and '1' are the same value and NULL/empty are both ''
+def as_text(df, float_columns=()):
+    df = df.copy()
+    # '45.10' in the file and 45.1 in the table are the same coordinate
+    for column in float_columns:
+        numbers = pd.to_numeric(df[column], errors='coerce')
+        df[column] = numbers.map(repr, na_action='ignore').where(numbers.notna(), df[column])
+    return df.astype('string').fillna('')
+
+
+def read_member(zip_ref, member, table_name):
+    columns = table_dtypes(table_name)
+    with zip_ref.open(member) as source:
+        try:
+            df = pd.read_csv(source, dtype=str, encoding='utf-8-sig', usecols=lambda column: column in columns)
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame(columns=[column for column in columns if column in ('arrival_time', 'departure_time')])
+    if table_name == 'stop_times':
+        add_seconds_columns(df)
+    return df
+
+
+# Keyed diff between the rows of a table and the new file, by primary key:
+# keys only in the table are deleted, keys only in the file inserted, keys in both with any different value updated.
+# The keys to delete are the values stored in the table (RAW_KEY columns, selected as they are next to the text
+# ones), so the DELETE compares the raw columns and uses the primary key index
+RAW_KEY = '_raw_'
+
+
+def diff_table(conn, table, new_df):
+    key = [column.name for column in table.primary_key.columns]
+    columns = [column.name for column in table.columns if column.name in new_df.columns]
+    if not set(key).issubset(columns):
+        raise ValueError(f"{table.name} file is missing the primary key columns {', '.join(key)}")
+
+    new_df = new_df[columns].drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+    select_list = ', '.join([f'CAST("{column}" AS TEXT) AS "{column}"' for column in columns] +
+                            [f'"{column}" AS "{RAW_KEY}{column}"' for column in key])
+    float_columns = [column.name for column in table.columns if column.name in columns and isinstance(column.type, Float)]
+    old = pd.read_sql(text(f'SELECT {select_list} FROM "{table.name}"'), conn)
+    raw_key = [f'{RAW_KEY}{column}' for column in key]
+    old = pd.concat([as_text(old[columns], float_columns), old[raw_key]], axis=1)
+    new = as_text(new_df, float_columns)
+    new['_row'] = range(len(new))
+
+    merged = old.merge(new, on=key, how='outer', suffixes=('_old', ''), indicator=True)
+    deleted = merged.loc[merged['_merge'] == 'left_only', raw_key]
+    inserted = merged.loc[merged['_merge'] == 'right_only', '_row']
+
+    both = merged[merged['_merge'] == 'both']
+    changed = pd.Series(False, index=both.index)
+    for column in columns:
+        if column not in key:
+            changed |= both[f'{column}_old'] != both[column]
+    updated = both.loc[changed]
+
+    return {
+        'delete': pd.concat([deleted, updated[raw_key]]),
+        'insert': new_df.iloc[pd.concat([inserted, updated['_row']]).astype(int).sort_values()],
+        'counts': (len(inserted), len(updated), len(deleted)),
+    }
+
+
+# Applies the diff: changed rows are deleted and inserted again with the new values
+def apply_diff(conn, table, diff):
+    key = [column.name for column in table.primary_key.columns]
+    if not diff['delete'].empty:
+        condition = ' AND '.join(f'"{column}" = ?' for column in key)
+        # object dtype, sqlite3 can't bind numpy integers
+        conn.exec_driver_sql(f'DELETE FROM "{table.name}" WHERE {condition}',
+                             list(diff['delete'].astype(object).itertuples(index=False, name=None)))
+    if not diff['insert'].empty:
+        # strict: a failed insert raises and rolls back the deletes with it
+        insert_chunk(conn, table.name, diff['insert'], strict=True)
+
+
+# Incremental update of an existing database: members with the same hash as last time are skipped entirely,
+# every changed table gets a keyed diff (insert/update/delete by primary key). Everything happens in a single
+# transaction, if something fails the database stays as it was.
+# Only the given files are considered (all the GTFS files we know by default).
+# Returns the names of the tables that changed, so the caller knows what needs to be recomputed
+def update_gtfs_database(zip_ref, members, engine, progress_callback, files=None):
+    hashes = hash_zip_members(zip_ref, members)
+    progress_callback(25)
+
+    changed_tables = set()
+    with engine.begin() as conn:
+        previous = load_file_hashes(conn)
+
+        # Files we had last time and that are not in the new feed anymore
+        considered = set(previous) if files is None else set(previous) & set(files)
+        removed = considered - set(hashes)
+        for file in removed:
+            table_name = file.split('.')[0]
+            if table_name in metadata.tables:
+                conn.execute(text(f'DELETE FROM "{table_name}"'))
+                changed_tables.add(table_name)
+                logger.info(f"{file} removed from the feed, {table_name} emptied")
+
+        to_update = [file for file in members if previous.get(file) != hashes[file]]
+        for file in members:
+            if file not in to_update:
+                logger.info(f"{file} unchanged, skipped")
+
+        for i, file in enumerate(to_update):
+            table_name = file.split('.')[0]
+            if table_name not in metadata.tables:
+                continue
+            start = time.perf_counter()
+            table = metadata.tables[table_name]
+            diff = diff_table(conn, table, read_member(zip_ref, members[file], table_name))
+            apply_diff(conn, table, diff)
+            inserted, updated, deleted = diff['counts']
+            logger.info(f"{table_name}: {inserted} inserted, {updated} updated, {deleted} deleted in {time.perf_counter() - start:.2f}s")
+            if inserted or updated or deleted:
+                changed_tables.add(table_name)
+            progress_callback(25 + int(65 * (i + 1) / len(to_update)))
+
+        save_file_hashes(conn, hashes, removed)
+
+    return changed_tables
@@ -1,21 +1,161 @@
 import os
+import sys
+import io
+import csv
+import shutil
+import tempfile
 import zipfile
 import pandas as pd
-from sqlalchemy import create_engine
-from database import create_tables, insert_data, create_engine_with_pool
+from database import create_tables, table_dtypes, insert_chunk, log_insert_rate, enable_ingest_pragmas, build_indexes, create_engine_with_pool, has_rows
+from analytics import build_route_stats
+from route_patterns import build_route_shapes
+from compact_storage import compact_stop_times, is_compact
+from columnar import export_parquet
+from headways import build_stop_headways, HEADWAY_SOURCES
+from search_index import build_search_index, SEARCH_SOURCES
+from spatial import build_stop_index, SPATIAL_SOURCES
+from gtfs_time import add_seconds_columns
+from instrumentation import profiled, stage
+from checkpoint import ConversionLedger, feed_fingerprint, can_resume, frame_chunks
+from feed_update import update_gtfs_database, hash_zip_members, save_file_hashes, ROUTE_STATS_SOURCES, ROUTE_SHAPES_SOURCES
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import tkinter as tk
-from tkinter import filedialog, messagebox
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 
 logger = logging.getLogger(__name__)
 
+# pyarrow is optional, when it's installed pandas can use its multithreaded csv parser
+try:
+    import pyarrow
+    import pyarrow.csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
-# Setting low_memory to False it's not the BEST solution, but it works and should be enough for this context
-def read_csv_file(file_path, file_name):
+GTFS_FILES = ["agency.txt", "stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt"]
+
+# Number of rows read (and inserted) at a time by the streaming import, peak memory depends on this and not on the feed size
+STREAM_CHUNK_SIZE = 100000
+
+
+# With the 'processes' backend, files bigger than this are split in byte ranges parsed by different processes
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+
+# 'c' is the default pandas parser, 'pyarrow' is used when available unless asked otherwise
+def get_csv_engine(engine=None):
+    if engine == 'pyarrow' and not HAS_PYARROW:
+        logger.warning("pyarrow is not installed, using the default csv parser")
+        return 'c'
+    return engine or ('pyarrow' if HAS_PYARROW else 'c')
+
+
+# The dtype plan comes from the tables declared in database.py: only the columns we keep are read (usecols),
+# with their declared types so pandas doesn't have to guess them (and ids like "0012" stay strings),
+# the repeated ids as categoricals. Integers are downcast after reading (see apply_dtype_plan)
+def read_options(file_name, engine, columns):
+    dtypes = table_dtypes(file_name.split('.')[0])
+    options = {'dtype': dtypes, 'engine': engine, 'encoding': 'utf-8-sig'}
+    if dtypes:
+        options['usecols'] = [column for column in columns if column in dtypes]
+    if engine == 'c':
+        options['low_memory'] = False
+    return options
+
+
+def read_header(file_path):
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+    return [column.strip() for column in next(csv.reader([header.decode('utf-8-sig')]), [])]
+
+
+# Columns of a file read as text given their declared types back, one at a time. A column with a value that
+# doesn't fit stays text: ids like "0012" are never turned into numbers like type inference would do
+def restore_declared_types(df, dtypes, file_name):
+    for column in df.columns:
+        dtype = dtypes.get(column, 'str')
+        if dtype == 'str':
+            continue
+        try:
+            if dtype == 'category':
+                df[column] = df[column].astype('category')
+            else:
+                df[column] = pd.to_numeric(df[column]).astype(dtype)
+        except (ValueError, TypeError):
+            logger.warning(f"{file_name}: {column} has values that are not {dtype}, kept as text")
+    return df
+
+
+# pyarrow types of the dtype plan, given to the parser itself: pandas' pyarrow engine infers the types first and
+# casts after, "0012" would already be 12 by then. A value that doesn't fit raises ArrowInvalid (a ValueError)
+ARROW_TYPES = {'Int64': 'int64', 'float64': 'float64', 'str': 'string'}
+
+
+def read_with_pyarrow(source, dtypes, columns):
+    if not columns:
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    column_types = {column: pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if dtypes.get(column) == 'category'
+                    else pyarrow.type_for_alias(ARROW_TYPES.get(dtypes.get(column, 'str'), 'string'))
+                    for column in columns}
+    convert_options = pyarrow.csv.ConvertOptions(column_types=column_types, include_columns=columns,
+                                                 strings_can_be_null=True)
+    table = pyarrow.csv.read_csv(source, convert_options=convert_options)
+    return table.to_pandas(types_mapper={pyarrow.int64(): pd.Int64Dtype()}.get)
+
+
+def read_with_options(source, file_name, engine, columns, **extra):
+    options = read_options(file_name, engine, columns)
     try:
-        df = pd.read_csv(file_path, low_memory=False)
+        if engine == 'pyarrow' and not extra:
+            return read_with_pyarrow(source, options['dtype'], options.get('usecols', columns))
+        return pd.read_csv(source, **options, **extra)
+    except pd.errors.EmptyDataError:
+        raise
+    except ValueError as e:
+        # Some value doesn't fit the declared type: the file is read again as text (with the c parser, pyarrow would
+        # infer the types first) and the columns that fit get their type back, the others stay text
+        logger.warning(f"{file_name} doesn't match the declared column types ({e}), reading it as text")
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        df = pd.read_csv(source, **dict(options, dtype=str, engine='c', low_memory=False), **extra)
+        return restore_declared_types(df, options['dtype'], file_name)
+
+
+# Integers are downcast to the smallest type holding their values (direction_id ends up in 1 byte instead of 8),
+# categoricals are restored if a concat turned them back into strings
+def apply_dtype_plan(df, table_name):
+    dtypes = table_dtypes(table_name)
+    for column in df.columns:
+        if dtypes.get(column) == 'category' and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+        elif pd.api.types.is_integer_dtype(df[column].dtype):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+
+# Memory used by the dataframe of a file, plus the peak of the whole process where the OS tells us
+def log_memory(file_name, df):
+    frame_size = df.memory_usage(deep=True).sum() / 1024 ** 2
+    peak = peak_memory_mb()
+    peak_text = f", process peak {peak:.1f} MB" if peak is not None else ""
+    logger.info(f"{file_name}: {len(df)} rows, {frame_size:.1f} MB in memory{peak_text}")
+
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def read_csv_file(file_path, file_name, engine=None):
+    try:
+        df = read_with_options(file_path, file_name, get_csv_engine(engine), read_header(file_path))
+        apply_dtype_plan(df, file_name.split('.')[0])
         logger.info(f"Successfully read {file_name}")
         return df
     except pd.errors.EmptyDataError:
@@ -25,87 +165,334 @@ def read_csv_file(file_path, file_name):
         logger.error(f"Error reading file {file_name}: {e}")
         return None
 
-# Before creating the file we ask for a name and check if there's one already
-def get_database_engine():
-    root = tk.Tk()
-    root.withdraw()  # Hide the main window
 
-   
-    db_path = filedialog.asksaveasfilename(defaultextension=".db", filetypes=[("SQLite database files", "*.db")])
-    
-    if not db_path:
-        print("Operation cancelled.")
-        return None
-    
-    if os.path.exists(db_path):
-     
-        if not messagebox.askyesno("Overwrite Confirmation", f"The file '{db_path}' already exists. Do you want to replace it?"):
-            print("Operation cancelled.")
-            return None
-        else:
-            os.remove(db_path)
-    
-    db_url = f"sqlite:///{db_path}"
-    engine = create_engine_with_pool(db_url)
-    print(f"Database engine created for {db_path}")
-    return engine
+# Splits a csv file in about `parts` byte ranges, every range starts at the beginning of a line.
+# Fields with a newline inside quotes would be split in two, GTFS files don't have them in practice
+def split_byte_ranges(file_path, parts):
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        file.readline()
+        boundaries = [file.tell()]
+        for i in range(1, parts):
+            file.seek(max(boundaries[-1], size * i // parts))
+            file.readline()
+            if boundaries[-1] < file.tell() < size:
+                boundaries.append(file.tell())
+        boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+# Runs in a worker process, parses only the lines between start and end.
+# The header line is put in front of them so the range reads exactly like a whole file
+def read_csv_range(file_path, file_name, start, end, engine=None):
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+        file.seek(start)
+        data = io.BytesIO(header + file.read(end - start))
+    return read_with_options(data, file_name, get_csv_engine(engine), read_header(file_path))
+
+
+# 'threads' backend: one file per thread. Fine for small feeds, but the parsing holds the GIL most of the time
+def read_files_in_threads(temp_dir, files, workers, engine=None):
+    dataframes = {}
+    with ThreadPoolExecutor(max_workers=min(len(files), workers * 2)) as executor:
+        future_to_file = {executor.submit(read_csv_file, os.path.join(temp_dir, file), file, engine): file for file in files}
+        for future in as_completed(future_to_file):
+            file = future_to_file[future]
+            try:
+                df = future.result()
+                if df is not None:
+                    dataframes[file.split('.')[0]] = df
+                    logger.info(f"Processed {file}: {len(df)} rows")
+                    log_memory(file, df)
+                else:
+                    logger.warning(f"Skipping {file} due to reading error")
+            except Exception as e:
+                logger.error(f"Error processing file {file}: {e}")
+    return dataframes
 
 
+# 'processes' backend: every file is parsed in a process pool (no GIL), the big ones split in byte ranges
+# so even a single huge stop_times.txt uses all the cores
+def read_files_in_processes(temp_dir, files, workers, engine=None):
+    dataframes = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for file in files:
+            file_path = os.path.join(temp_dir, file)
+            if os.path.exists(file_path) and os.path.getsize(file_path) >= PARALLEL_MIN_SIZE:
+                ranges = split_byte_ranges(file_path, workers)
+                futures[file] = [executor.submit(read_csv_range, file_path, file, start, end, engine) for start, end in ranges]
+            else:
+                futures[file] = [executor.submit(read_csv_file, file_path, file, engine)]
 
+        for file, parts in futures.items():
+            try:
+                frames = [part.result() for part in parts]
+                if any(frame is None for frame in frames):
+                    logger.warning(f"Skipping {file} due to reading error")
+                    continue
+                df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+                dataframes[file.split('.')[0]] = apply_dtype_plan(df, file.split('.')[0])
+                logger.info(f"Processed {file}: {len(df)} rows ({len(parts)} parts)")
+                log_memory(file, df)
+            except Exception as e:
+                logger.error(f"Error processing file {file}: {e}")
+    return dataframes
+
+
+# Some feeds are zipped with a top folder, so we look for the members by name instead of expecting them in the root
+def find_zip_members(zip_ref, files):
+    members = {}
+    for info in zip_ref.infolist():
+        file_name = os.path.basename(info.filename)
+        if file_name in files and file_name not in members:
+            members[file_name] = info
+    return members
+
+
+# Reads a single member straight out of the zip in chunks of chunk_size rows, nothing gets extracted on disk.
+# Every column is read as a string so all the chunks of a file agree on the types, sqlite will convert them on insert
+def iter_csv_chunks(zip_ref, member, chunk_size):
+    # Like the other readers we skip the columns not declared in database.py
+    columns = table_dtypes(os.path.basename(member.filename).split('.')[0])
+    usecols = (lambda column: column in columns) if columns else None
+    with zip_ref.open(member) as file:
+        try:
+            for chunk in pd.read_csv(file, chunksize=chunk_size, dtype=str, encoding='utf-8-sig', usecols=usecols):
+                yield chunk
+        except pd.errors.EmptyDataError:
+            logger.warning(f"File {member.filename} is empty. Skipping it.")
+
+
+# Hashes of the files we just converted, so the next incremental update knows what changed
+def save_feed_hashes(zip_path, engine, files=GTFS_FILES):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        hashes = hash_zip_members(zip_ref, find_zip_members(zip_ref, files))
+    with engine.begin() as conn:
+        save_file_hashes(conn, hashes)
+
+
+# Streaming version of the import, every file is read and inserted one chunk at a time
+# so we never hold a whole table in memory. Slower than the default mode on small feeds but it can handle huge ones.
+# With a ledger every chunk is committed on its own and the chunks committed by a previous run are skipped
+def stream_gtfs_to_database(zip_path, engine, progress_callback, chunk_size=STREAM_CHUNK_SIZE, files=GTFS_FILES, ledger=None):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = find_zip_members(zip_ref, files)
+        for file in files:
+            if file not in members:
+                logger.warning(f"File {file} not found in {zip_path}")
+
+        # Progress goes from 25 to 100 based on how much uncompressed data we went through
+        total_size = sum(member.file_size for member in members.values()) or 1
+        done_size = 0
+
+        for file, member in members.items():
+            table_name = file.split('.')[0]
+            chunks = iter_csv_chunks(zip_ref, member, chunk_size)
+            prepare = add_seconds_columns if table_name == 'stop_times' else None
+            if ledger is not None:
+                ledger.insert(table_name, chunks, prepare)
+            else:
+                rows = 0
+                start = time.perf_counter()
+                with engine.begin() as conn:
+                    for chunk in chunks:
+                        if prepare:
+                            prepare(chunk)
+                        rows += insert_chunk(conn, table_name, chunk)
+                log_insert_rate(table_name, rows, time.perf_counter() - start)
+
+            done_size += member.file_size
+            progress_callback(25 + int(75 * done_size / total_size))
+
+
+# Only the files of the tables asked for, all of them by default
+def select_files(tables=None):
+    if not tables:
+        return GTFS_FILES
+    known = {file.split('.')[0] for file in GTFS_FILES}
+    unknown = set(tables) - known
+    if unknown:
+        raise ValueError(f"Unknown tables: {', '.join(sorted(unknown))} (available: {', '.join(sorted(known))})")
+    return [file for file in GTFS_FILES if file.split('.')[0] in tables]
+
+
+# Only the members we need are extracted, flat in temp_dir even if the zip has them inside a folder
+def extract_members(zip_path, files, temp_dir):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for file, member in find_zip_members(zip_ref, files).items():
+            with zip_ref.open(member) as source, open(os.path.join(temp_dir, file), 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def ignore_progress(percentage):
+    pass
+
+
+# Converts the GTFS zip at zip_path into the sqlite database at db_path (an existing file gets replaced),
+# it doesn't need any UI so it can run on servers and batch jobs too (see convert.py for the command line).
 # Right now if you want to grab more files you have to add it manually here and also in the database.py file
 # I'll update this part with logic to get the file list during the zip extraction instead of expliciting it
-def process_gtfs_file(zip_path, progress_callback):
-    temp_dir = "temp_gtfs"
+# With streaming=True the files are read straight from the zip in chunks, use it for feeds that don't fit in memory.
+# Otherwise parse_backend chooses how the extracted files are parsed: 'threads' (one file per thread)
+# or 'processes' (see read_files_in_processes), csv_engine can force 'c' or 'pyarrow'.
+# Tables are committed chunk_size rows at a time and every step is recorded in a progress ledger (see checkpoint.py):
+# if db_path is an unfinished conversion of the same zip with the same options, it goes on from the last committed
+# chunk instead of starting over. resume=False always starts over.
+# With incremental=True an existing database is updated in place with only what changed (see feed_update.py).
+# tables limits the conversion to some tables only (['stops', 'routes']...).
+# With compact=True stop_times is stored as trip patterns, with a stop_times view on top (see compact_storage.py).
+# With parquet_dir every table is also written there as parquet files (see columnar.py).
+# With headways=True the headways of every stop are precomputed in stop_headways (see headways.py).
+# progress_callback gets the percentage, -1 on errors. Returns True if everything went fine
+@profiled
+def process_gtfs_file(zip_path, db_path, progress_callback=None, streaming=False, chunk_size=STREAM_CHUNK_SIZE,
+                      parse_backend='threads', workers=None, csv_engine=None, incremental=False, tables=None,
+                      compact=False, parquet_dir=None, headways=False, resume=True):
+    progress_callback = progress_callback or ignore_progress
+    temp_dir = None
+    engine = None
     
     try:
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        files = select_files(tables)
+        compact = compact and 'stop_times.txt' in files
 
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        progress_callback(25)
+        if not incremental:
+            fingerprint = feed_fingerprint(zip_path, files, streaming, compact)
+            if os.path.exists(db_path) and not (resume and can_resume(db_path, fingerprint)):
+                os.remove(db_path)
+        engine = create_engine_with_pool(f"sqlite:///{db_path}")
+        logger.info(f"Database engine created for {db_path}")
 
-        files = ["agency.txt", "stops.txt", "routes.txt", "trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt"]
-        dataframes = {}
-
-        # Use ThreadPoolExecutor for parallel file reading
-        with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() * 2)) as executor:
-            future_to_file = {executor.submit(read_csv_file, os.path.join(temp_dir, file), file): file for file in files}
-            for future in as_completed(future_to_file):
-                file = future_to_file[future]
-                try:
-                    df = future.result()
-                    if df is not None:
-                        table_name = file.split('.')[0]
-                        dataframes[table_name] = df
-                        logger.info(f"Processed {file}: {len(df)} rows")
-                    else:
-                        logger.warning(f"Skipping {file} due to reading error")
-                except Exception as e:
-                    logger.error(f"Error processing file {file}: {e}")
+        if incremental:
+            if os.path.exists(db_path) and is_compact(engine):
+                raise ValueError("Compact databases can't be updated incrementally, convert the feed again")
+            # No ingest PRAGMAs here, the file already has data we don't want to lose if something goes wrong
+            create_tables(engine)
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                members = find_zip_members(zip_ref, files)
+                with stage('update'):
+                    changed_tables = update_gtfs_database(zip_ref, members, engine, progress_callback, files)
 
-        progress_callback(75)
+            if changed_tables & ROUTE_STATS_SOURCES:
+                with stage('route_stats'):
+                    build_route_stats(engine)
+            if changed_tables & ROUTE_SHAPES_SOURCES:
+                with stage('route_shapes'):
+                    build_route_shapes(engine)
+            if changed_tables & SEARCH_SOURCES:
+                with stage('search_index'):
+                    build_search_index(engine)
+            if changed_tables & SPATIAL_SOURCES:
+                with stage('spatial_index'):
+                    build_stop_index(engine)
+            # Rebuilt only if the database was converted with them
+            if changed_tables & HEADWAY_SOURCES and (headways or has_rows(engine, 'stop_headways')):
+                with stage('headways'):
+                    build_stop_headways(engine)
+            with stage('indexes'):
+                build_indexes(engine, analyze=True)
+            if parquet_dir:
+                with stage('parquet'):
+                    export_parquet(parquet_dir, engine)
 
-        
+            progress_callback(100)
+            return True
 
-        # Use the new create_engine_with_pool function
-        engine = get_database_engine()
-        
+        enable_ingest_pragmas(engine)
         create_tables(engine)
         logger.info(f"tables created")
-        insert_data(engine, dataframes)
+        ledger = ConversionLedger(engine, fingerprint)
+
+        if streaming:
+            progress_callback(25)
+
+            with stage('stream'):
+                stream_gtfs_to_database(zip_path, engine, progress_callback, chunk_size, files, ledger)
+            ledger.run('route_stats', build_route_stats, engine)
+            ledger.run('route_shapes', build_route_shapes, engine)
+            ledger.run('search_index', build_search_index, engine)
+            ledger.run('spatial_index', build_stop_index, engine)
+            if headways:
+                ledger.run('headways', build_stop_headways, engine)
+            if compact:
+                ledger.run('compact', compact_stop_times, engine)
+            # Last, so ANALYZE sees the derived tables filled too
+            ledger.run('indexes', build_indexes, engine, analyze=True)
+            ledger.run('hashes', save_feed_hashes, zip_path, engine, files)
+            if parquet_dir:
+                ledger.run('parquet', export_parquet, parquet_dir, engine)
+            ledger.finish()
+
+            progress_callback(100)
+            return True
+
+        # Tables committed by a previous run are read back from the database by the steps that need them,
+        # in compact mode stop_times is only needed until it has been compacted
+        pending = [file for file in files
+                   if not ledger.done(file.split('.')[0]) and not (compact and file == 'stop_times.txt' and ledger.done('compact'))]
+
+        temp_dir = tempfile.mkdtemp(prefix='temp_gtfs_')
+        with stage('extract'):
+            extract_members(zip_path, pending, temp_dir)
+        
+        progress_callback(25)
+
+        workers = workers or os.cpu_count()
+
+        with stage('parse'):
+            if not pending:
+                dataframes = {}
+            elif parse_backend == 'processes':
+                dataframes = read_files_in_processes(temp_dir, pending, workers, csv_engine)
+            else:
+                dataframes = read_files_in_threads(temp_dir, pending, workers, csv_engine)
+
+        if 'stop_times' in dataframes:
+            with stage('seconds_columns'):
+                add_seconds_columns(dataframes['stop_times'])
+
+        progress_callback(75)
+
+        # In compact mode stop_times never goes in the table, compact_stop_times stores it from the dataframe
+        compact = compact and 'stop_times' in dataframes
+        with stage('insert'):
+            for table_name, dataframe in dataframes.items():
+                if not (compact and table_name == 'stop_times'):
+                    ledger.insert(table_name, frame_chunks(dataframe, chunk_size))
+        ledger.run('route_stats', build_route_stats, engine, dataframes)
+        ledger.run('route_shapes', build_route_shapes, engine, dataframes)
+        ledger.run('search_index', build_search_index, engine)
+        ledger.run('spatial_index', build_stop_index, engine)
+        if headways:
+            ledger.run('headways', build_stop_headways, engine, dataframes)
+        if compact:
+            ledger.run('compact', compact_stop_times, engine, dataframes)
+        # Last, so ANALYZE sees the derived tables filled too
+        ledger.run('indexes', build_indexes, engine, analyze=True)
+        ledger.run('hashes', save_feed_hashes, zip_path, engine, files)
+        if parquet_dir:
+            ledger.run('parquet', export_parquet, parquet_dir, engine, dataframes)
+        ledger.finish()
 
         progress_callback(100)
+        return True
 
     except Exception as e:
         logger.error(f"Error processing GTFS file: {e}")
         progress_callback(-1)  # Indicate error to the caller
+        return False
 
     finally:
+        if engine is not None:
+            engine.dispose()
         # Clean up temporary directory
-        for file in os.listdir(temp_dir):
-            os.remove(os.path.join(temp_dir, file))
-        os.rmdir(temp_dir)
+        if temp_dir and os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
 
+# True if db_path is an unfinished conversion of zip_path with these options, process_gtfs_file would resume it
+def is_resumable(zip_path, db_path, streaming=False, tables=None, compact=False, **options):
+    files = select_files(tables)
+    return can_resume(db_path, feed_fingerprint(zip_path, files, streaming, compact and 'stop_times.txt' in files))
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+# GTFS times are HH:MM:SS (H:MM:SS is allowed too) counted from the start of the service day,
+# so trips running after midnight have hours of 24 and more. Everything here works on whole columns with numpy:
+# the strings are right aligned in a fixed width byte matrix and the digits are read by position.
+TIME_WIDTH = 9  # up to 3 digits for the hours
+COLON_POSITIONS = (TIME_WIDTH - 6, TIME_WIDTH - 3)
+
+
+# Returns (seconds, valid): seconds since the start of the service day as int64 and a boolean mask,
+# missing or malformed values are False in the mask and 0 in seconds
+def parse_times(values):
+    values = np.asarray(values, dtype=object)
+    if values.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    missing = pd.isna(values)
+    text = np.char.strip(np.where(missing, '', values).astype(str))
+    too_long = np.char.str_len(text) > TIME_WIDTH
+    text = np.char.encode(np.char.rjust(text, TIME_WIDTH), 'ascii', 'replace').astype(f'S{TIME_WIDTH}')
+    codes = np.frombuffer(text.tobytes(), dtype=np.uint8).reshape(-1, TIME_WIDTH)
+
+    digits = codes.astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_blank = codes == ord(' ')
+    digits[~is_digit] = 0
+
+    hour_columns = slice(0, COLON_POSITIONS[0])
+    hour_digits = is_digit[:, hour_columns]
+    # Hours are blank padded on the left and at least one digit long, no blanks in the middle
+    hours_ok = (hour_digits | is_blank[:, hour_columns]).all(axis=1) & hour_digits[:, -1]
+    hours_ok &= (np.diff(hour_digits.astype(np.int8), axis=1) >= 0).all(axis=1)
+
+    minute_tens, minute_units = COLON_POSITIONS[0] + 1, COLON_POSITIONS[0] + 2
+    second_tens, second_units = COLON_POSITIONS[1] + 1, COLON_POSITIONS[1] + 2
+    valid = (
+        ~missing & ~too_long & hours_ok
+        & (codes[:, COLON_POSITIONS[0]] == ord(':')) & (codes[:, COLON_POSITIONS[1]] == ord(':'))
+        & is_digit[:, [minute_tens, minute_units, second_tens, second_units]].all(axis=1)
+        & (digits[:, minute_tens] < 6) & (digits[:, second_tens] < 6)
+    )
+
+    powers = 10 ** np.arange(COLON_POSITIONS[0] - 1, -1, -1)
+    hours = digits[:, hour_columns] @ powers
+    minutes = digits[:, minute_tens] * 10 + digits[:, minute_units]
+    seconds = digits[:, second_tens] * 10 + digits[:, second_units]
+
+    total = np.where(valid, hours * 3600 + minutes * 60 + seconds, 0).astype(np.int64)
+    return total, valid
+
+
+# Same as parse_times but as a float series with NaN for the invalid values, handy for pandas arithmetic
+def times_to_seconds(times):
+    seconds, valid = parse_times(times)
+    index = times.index if isinstance(times, pd.Series) else None
+    return pd.Series(np.where(valid, seconds, np.nan), index=index)
+
+
+# Back to HH:MM:SS, hours are not wrapped (25:10:00 stays 25:10:00)
+def format_times(seconds):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, secs = np.divmod(rest, 60)
+    return [f'{h:02d}:{m:02d}:{s:02d}' for h, m, s in zip(hours, minutes, secs)]
+
+
+# Adds arrival_secs/departure_secs (nullable integers) next to the original time strings of a stop_times dataframe,
+# so nothing downstream has to parse strings again
+def add_seconds_columns(stop_times):
+    for column in ('arrival_time', 'departure_time'):
+        if column not in stop_times.columns:
+            continue
+        seconds, valid = parse_times(stop_times[column].to_numpy())
+        # Blank times are allowed by GTFS on non timepoint stops, we only complain about the rest
+        blank = stop_times[column].isna().to_numpy()
+        invalid = (~valid & ~blank).sum()
+        if invalid:
+            logger.warning(f"{invalid} invalid values found in stop_times.{column}")
+        target = column.replace('_time', '_secs')
+        stop_times[target] = pd.arrays.IntegerArray(seconds.astype(np.int32), ~valid)
+    return stop_times
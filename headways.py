@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+import logging
+import threading
+import time
+from sqlalchemy import inspect
+from database import insert_chunk
+from gtfs_time import times_to_seconds
+from service_calendar import ServiceCalendar, DAYS, database_key, register_database_cache
+
+logger = logging.getLogger(__name__)
+
+# Chunk size used when we have to read stop_times back from the database (streaming import, server)
+READ_CHUNK_SIZE = 500000
+
+# Tables the headways are computed from, if one of them changes stop_headways has to be rebuilt
+HEADWAY_SOURCES = {'trips', 'stop_times', 'calendar', 'calendar_dates'}
+
+HEADWAY_COLUMNS = ['stop_id', 'route_id', 'hour', 'departures', 'avg_headway', 'min_headway', 'max_headway']
+
+
+# The stop_times columns Departures needs, read from the database a chunk at a time
+def read_stop_times(engine):
+    has_seconds = 'departure_secs' in pd.read_sql('SELECT * FROM stop_times LIMIT 0', engine).columns
+    columns = ['trip_id', 'stop_id'] + (['departure_secs', 'arrival_secs'] if has_seconds else ['departure_time', 'arrival_time'])
+    return pd.read_sql(f'SELECT {", ".join(columns)} FROM stop_times', engine, chunksize=READ_CHUNK_SIZE)
+
+
+# Every departure of the feed as three int32 arrays (stop index, trip index, seconds), a few bytes per stop_times row.
+# Headways for a day are then: keep the departures of the trips running that day, sort them by stop, route and
+# time, and diff the neighbours. No python loop over stops or trips
+class Departures:
+    def __init__(self, stop_ids, trips, stop_codes, trip_codes, seconds):
+        self.stop_ids = np.asarray(stop_ids, dtype=object)
+        self.trips = trips.reset_index(drop=True)
+        self.stop_codes = stop_codes
+        self.trip_codes = trip_codes
+        self.seconds = seconds
+        self.route_ids, self.trip_routes = np.unique(self.trips['route_id'].to_numpy(dtype=object).astype(str), return_inverse=True)
+
+    # stop_times chunks need trip_id, stop_id and departure_secs/arrival_secs (or the time strings).
+    # Departures with no time are skipped (GTFS allows them on non timepoint stops), arrival is used when
+    # departure is missing
+    @classmethod
+    def from_frames(cls, stop_times_chunks, trips, stops):
+        trips = trips[['trip_id', 'route_id', 'service_id']].astype(str).drop_duplicates('trip_id')
+        stop_index = pd.Index(stops['stop_id'].astype(str).unique())
+        trip_index = pd.Index(trips['trip_id'])
+
+        stop_codes, trip_codes, seconds = [], [], []
+        for chunk in stop_times_chunks:
+            secs = None
+            for column in ('departure', 'arrival'):
+                if f'{column}_secs' in chunk.columns:
+                    values = pd.to_numeric(chunk[f'{column}_secs'], errors='coerce').to_numpy(dtype=float)
+                elif f'{column}_time' in chunk.columns:
+                    values = times_to_seconds(chunk[f'{column}_time'].astype(object)).to_numpy()
+                else:
+                    continue
+                secs = values if secs is None else np.where(np.isnan(secs), values, secs)
+            if secs is None:
+                continue
+            stops_found = stop_index.get_indexer(chunk['stop_id'].astype(str))
+            trips_found = trip_index.get_indexer(chunk['trip_id'].astype(str))
+            keep = (stops_found >= 0) & (trips_found >= 0) & ~np.isnan(secs)
+            stop_codes.append(stops_found[keep].astype(np.int32))
+            trip_codes.append(trips_found[keep].astype(np.int32))
+            seconds.append(secs[keep].astype(np.int32))
+
+        concat = lambda arrays: np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+        return cls(stop_index.to_numpy(), trips, concat(stop_codes), concat(trip_codes), concat(seconds))
+
+    @classmethod
+    def from_engine(cls, engine):
+        return cls.from_frames(read_stop_times(engine), pd.read_sql('SELECT trip_id, route_id, service_id FROM trips', engine),
+                               pd.read_sql('SELECT stop_id FROM stops', engine))
+
+    # Boolean per trip: running on day, a weekday name ('monday') or a date (YYYYMMDD).
+    # A weekday counts every service running on at least one date with that weekday, like route_stats does
+    def active_trips(self, calendar, day):
+        service_ids = self.trips['service_id'].to_numpy(dtype=object)
+        unique_services, inverse = np.unique(service_ids.astype(str), return_inverse=True)
+        if str(day).lower() in DAYS:
+            active = calendar.active_weekdays(unique_services)[:, DAYS.index(str(day).lower())]
+        else:
+            active = calendar.active_on(unique_services, day)
+        return active[inverse]
+
+    # Headways in minutes by stop, route and hour of the day (hour of the departure starting the gap, 24 and more
+    # after midnight like in GTFS). by_route=False pools the departures of all the routes of a stop (route_id '*').
+    # departures is the number of departures in that hour, the gap after the last departure of the day is not a headway
+    def headways(self, calendar, day, by_route=True, stop_id=None, route_id=None):
+        keep = self.active_trips(calendar, day)[self.trip_codes]
+        if stop_id is not None:
+            position = np.flatnonzero(self.stop_ids == str(stop_id))
+            keep &= np.isin(self.stop_codes, position)
+        routes = self.trip_routes[self.trip_codes]
+        if route_id is not None:
+            keep &= np.isin(routes, np.flatnonzero(self.route_ids == str(route_id)))
+        if not by_route:
+            routes = np.zeros_like(routes)
+
+        stops, routes, seconds = self.stop_codes[keep], routes[keep], self.seconds[keep]
+        if stops.size == 0:
+            return pd.DataFrame(columns=HEADWAY_COLUMNS)
+
+        order = np.lexsort((seconds, routes, stops))
+        stops, routes, seconds = stops[order], routes[order], seconds[order]
+        hours = seconds // 3600
+
+        same_group = (stops[1:] == stops[:-1]) & (routes[1:] == routes[:-1])
+        gaps = pd.DataFrame({
+            'stop': stops[:-1][same_group], 'route': routes[:-1][same_group], 'hour': hours[:-1][same_group],
+            'gap': (seconds[1:] - seconds[:-1])[same_group] / 60,
+        }).groupby(['stop', 'route', 'hour'])['gap'].agg(['mean', 'min', 'max'])
+        counts = pd.DataFrame({'stop': stops, 'route': routes, 'hour': hours}).groupby(['stop', 'route', 'hour']).size()
+
+        result = counts.to_frame('departures').join(gaps).reset_index()
+        result.insert(0, 'stop_id', self.stop_ids[result['stop'].to_numpy()])
+        result.insert(1, 'route_id', self.route_ids[result['route'].to_numpy()] if by_route else '*')
+        result = result.rename(columns={'mean': 'avg_headway', 'min': 'min_headway', 'max': 'max_headway'})
+        return result[HEADWAY_COLUMNS]
+
+
+_departures = {}
+_departures_lock = threading.Lock()
+register_database_cache(_departures, _departures_lock)
+
+
+# Departures of a database, stop_times is scanned once and the arrays kept until the file changes
+def get_departures(engine):
+    key = database_key(engine)
+    with _departures_lock:
+        departures = _departures.get(key)
+    if departures is None:
+        start = time.perf_counter()
+        departures = Departures.from_engine(engine)
+        with _departures_lock:
+            for old_key in [old_key for old_key in _departures if old_key[0] == key[0]]:
+                del _departures[old_key]
+            _departures[key] = departures
+        logger.info(f"Departures of {key[0]} loaded in {time.perf_counter() - start:.2f}s ({departures.seconds.size} rows)")
+    return departures
+
+
+# Optional ingest stage: headways by stop, route and hour for every weekday in the stop_headways table,
+# so the server can answer with a lookup. Every table missing from the dataframes (streaming import, tables
+# committed by a previous run of a resumed conversion) is read back from the database
+def build_stop_headways(engine, dataframes=None, days=DAYS):
+    start = time.perf_counter()
+    dataframes = dataframes or {}
+    tables = set(inspect(engine).get_table_names())
+
+    def load(table_name, columns):
+        df = dataframes.get(table_name)
+        if df is None and table_name in tables:
+            df = pd.read_sql(f'SELECT {", ".join(columns)} FROM {table_name}', engine)
+        return df
+
+    stop_times_chunks = [dataframes['stop_times']] if 'stop_times' in dataframes else read_stop_times(engine)
+    departures = Departures.from_frames(stop_times_chunks, load('trips', ['trip_id', 'route_id', 'service_id']),
+                                        load('stops', ['stop_id']))
+    calendar = ServiceCalendar(load('calendar', ['service_id'] + DAYS + ['start_date', 'end_date']),
+                               load('calendar_dates', ['service_id', 'date', 'exception_type']))
+
+    rows = 0
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM stop_headways")
+        for day in days:
+            headways = departures.headways(calendar, day)
+            headways.insert(2, 'day', day)
+            rows += insert_chunk(conn, 'stop_headways', headways)
+
+    logger.info(f"Stop headways computed for {len(days)} days ({rows} rows) in {time.perf_counter() - start:.2f}s")
+    return rows
@@ -0,0 +1,248 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from flask import request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this (milliseconds) are logged with their EXPLAIN QUERY PLAN, off when not set
+SLOW_QUERY_MS = float(os.getenv('GTFS_SLOW_QUERY_MS', 0)) or None
+
+ENVIRON_KEY = 'gtfs.profile'
+# Request duration buckets in seconds, for the Prometheus histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Where the time of one request (or one conversion) went: SQL statements (count and time, from the engine
+# events) and named stages, each with the seconds spent in it and how many times it ran
+class Profile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.stages = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] += seconds
+        self.stage_calls[name] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    # Server-Timing header value, milliseconds: sql, every stage, then the total so far
+    def server_timing(self):
+        metrics = [f'sql;dur={self.sql_seconds * 1000:.2f};desc="{self.sql_count} statements"']
+        metrics += [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items()]
+        metrics.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(metrics)
+
+    def summary(self):
+        stages = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.stages.items())
+        return f"{self.elapsed():.2f}s total, {self.sql_count} SQL statements in {self.sql_seconds:.2f}s" + (f" ({stages})" if stages else "")
+
+
+# Profile outside of requests (a conversion), see profiling()
+_profile = contextvars.ContextVar('profile', default=None)
+
+
+def current_profile():
+    if has_request_context():
+        return request.environ.get(ENVIRON_KEY)
+    return _profile.get()
+
+
+@contextlib.contextmanager
+def profiling():
+    profile = Profile()
+    token = _profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+
+
+# Runs every call of function in its own profile and logs where its time went
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with profiling() as profile:
+            try:
+                return function(*args, **kwargs)
+            finally:
+                logger.info(f"{function.__name__}: {profile.summary()}")
+
+    return wrapper
+
+
+# Times a block as a named stage of the current profile (if any) and in the stage metrics
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        profile = current_profile()
+        if profile is not None:
+            profile.add_stage(name, seconds)
+        metrics.add_stage(name, seconds)
+
+
+# Counters and histograms in the Prometheus text format, kept in this process (with several gunicorn workers
+# every worker has its own)
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.request_buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.request_seconds = defaultdict(float)
+        self.request_count = defaultdict(int)
+        self.sql_count = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.slow_queries = 0
+
+    def add_request(self, endpoint, status, profile):
+        seconds = profile.elapsed()
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            buckets = self.request_buckets[endpoint]
+            for position, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[position] += 1
+            self.request_seconds[endpoint] += seconds
+            self.request_count[endpoint] += 1
+            self.sql_count[endpoint] += profile.sql_count
+            self.sql_seconds[endpoint] += profile.sql_seconds
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stage_seconds[name] += seconds
+            self.stage_calls[name] += 1
+
+    def add_slow_query(self):
+        with self.lock:
+            self.slow_queries += 1
+
+    def render(self):
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def sample(name, labels, value):
+            label_text = ','.join(f'{key}="{escape(label)}"' for key, label in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        with self.lock:
+            header('gtfs_requests_total', 'counter', 'Requests by endpoint and status')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                sample('gtfs_requests_total', {'endpoint': endpoint, 'status': status}, count)
+
+            name = 'gtfs_request_duration_seconds'
+            header(name, 'histogram', 'Request duration, streamed responses included')
+            for endpoint in sorted(self.request_count):
+                for bound, count in zip(BUCKETS, self.request_buckets[endpoint]):
+                    sample(f'{name}_bucket', {'endpoint': endpoint, 'le': bound}, count)
+                sample(f'{name}_bucket', {'endpoint': endpoint, 'le': '+Inf'}, self.request_count[endpoint])
+                sample(f'{name}_sum', {'endpoint': endpoint}, round(self.request_seconds[endpoint], 6))
+                sample(f'{name}_count', {'endpoint': endpoint}, self.request_count[endpoint])
+
+            header('gtfs_sql_statements_total', 'counter', 'SQL statements run by endpoint')
+            for endpoint, count in sorted(self.sql_count.items()):
+                sample('gtfs_sql_statements_total', {'endpoint': endpoint}, count)
+            header('gtfs_sql_duration_seconds_total', 'counter', 'Time spent executing SQL statements by endpoint')
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                sample('gtfs_sql_duration_seconds_total', {'endpoint': endpoint}, round(seconds, 6))
+
+            header('gtfs_stage_duration_seconds_total', 'counter', 'Time spent in named stages')
+            for stage_name, seconds in sorted(self.stage_seconds.items()):
+                sample('gtfs_stage_duration_seconds_total', {'stage': stage_name}, round(seconds, 6))
+            header('gtfs_stage_calls_total', 'counter', 'Times every named stage ran')
+            for stage_name, count in sorted(self.stage_calls.items()):
+                sample('gtfs_stage_calls_total', {'stage': stage_name}, count)
+
+            header('gtfs_slow_queries_total', 'counter', 'Statements slower than GTFS_SLOW_QUERY_MS')
+            sample('gtfs_slow_queries_total', {}, self.slow_queries)
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+# Every statement of every engine of the process is timed: added to the profile of the request (or conversion)
+# running it and, over SLOW_QUERY_MS, logged with its query plan. Only the execute is timed, rows fetched later
+# (streamed responses) count in the request time
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    profile = current_profile()
+    if profile is not None:
+        profile.sql_count += 1
+        profile.sql_seconds += seconds
+    if SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS and not executemany:
+        log_slow_query(conn, statement, parameters, seconds)
+
+
+def log_slow_query(conn, statement, parameters, seconds):
+    metrics.add_slow_query()
+    plan = []
+    if conn.dialect.name == 'sqlite' and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        # Straight on the DBAPI connection, so the EXPLAIN is not timed and logged itself
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters or ())
+            plan = [row[-1] for row in cursor.fetchall()]
+        except Exception as e:
+            plan = [f'no plan: {e}']
+        finally:
+            cursor.close()
+    endpoint = request.path if has_request_context() else '-'
+    plan_text = ''.join(f'\n    {line}' for line in plan)
+    logger.warning(f"Slow query ({seconds * 1000:.1f} ms, {endpoint}): {' '.join(statement.split())} {parameters}{plan_text}")
+
+
+# Registers the profiling on a Flask app: a profile per request, the Server-Timing header on every response
+# (stages and SQL up to the moment the response is returned) and the metrics once the response is closed,
+# after the last line of streamed responses. /metrics serves them
+def init_app(app):
+    @app.before_request
+    def start_profile():
+        request.environ[ENVIRON_KEY] = Profile()
+
+    @app.after_request
+    def add_server_timing(response):
+        profile = request.environ.get(ENVIRON_KEY)
+        if profile is None:
+            return response
+        response.headers['Server-Timing'] = profile.server_timing()
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        status = response.status_code
+        response.call_on_close(lambda: metrics.add_request(endpoint, status, profile))
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
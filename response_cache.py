@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from cachelib import FileSystemCache
+from cachelib.serializers import SimpleSerializer
+from flask_caching.backends.base import BaseCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 1024
+DEFAULT_DISK_SIZE = 10000
+
+
+# The sqlite file behind an engine (absolute path), what every fingerprint of it starts with
+def database_identity(engine):
+    path = engine.url.database
+    if not path or path == ':memory:':
+        return f'{engine.url}:{id(engine)}'
+    return os.path.abspath(path)
+
+
+# Path, modification time and size of the sqlite file behind an engine: responses are keyed with it,
+# so a converted/updated/reloaded database never gets the answers computed for the previous one
+def database_fingerprint(engine):
+    identity = database_identity(engine)
+    try:
+        stat = os.stat(identity)
+    except OSError:
+        return identity
+    return f'{identity}:{stat.st_mtime_ns}:{stat.st_size}'
+
+
+# Flask-Caching backend (CACHE_TYPE = 'response_cache.LRUCache'): a bounded in-memory LRU,
+# optionally backed by a FileSystemCache in CACHE_DIR so the answers survive a server restart.
+# Values are pickled like cachelib's SimpleCache does, every hit gets its own copy of the response.
+class LRUCache(BaseCache):
+    serializer = SimpleSerializer()
+
+    def __init__(self, threshold=DEFAULT_SIZE, default_timeout=0, cache_dir=None, disk_threshold=DEFAULT_DISK_SIZE,
+                 ignore_delete_many_errors=False):
+        super().__init__(default_timeout=default_timeout, ignore_delete_many_errors=ignore_delete_many_errors)
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.disk = None
+        if cache_dir:
+            self.disk = FileSystemCache(cache_dir, threshold=disk_threshold, default_timeout=default_timeout)
+            logger.info(f"Response cache persisted in {cache_dir}")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(threshold=config['CACHE_THRESHOLD'], cache_dir=config.get('CACHE_DIR'))
+        return cls(*args, **kwargs)
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else 0
+
+    def _remember(self, key, expires, data):
+        with self._lock:
+            self._entries[key] = (expires, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, data = entry
+                if expires == 0 or expires > time.time():
+                    self._entries.move_to_end(key)
+                    return self.serializer.loads(data)
+                del self._entries[key]
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._remember(key, 0, self.serializer.dumps(value))
+            return value
+        return None
+
+    def set(self, key, value, timeout=None):
+        self._remember(key, self._expires(timeout), self.serializer.dumps(value))
+        if self.disk is not None:
+            self.disk.set(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] == 0 or entry[0] > time.time()):
+                return True
+        return self.disk is not None and self.disk.has(key)
+
+    def delete(self, key):
+        with self._lock:
+            deleted = self._entries.pop(key, None) is not None
+        if self.disk is not None:
+            deleted = self.disk.delete(key) or deleted
+        return deleted
+
+    # Only the memory: the files are keyed by database fingerprint, they stay valid for when that database comes back
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+    # Memory entries of one database, any version of the file (keys end with @<fingerprint>), the other feeds keep theirs
+    def clear_database(self, engine):
+        marker = f'@{database_identity(engine)}'
+        with self._lock:
+            keys = [key for key in self._entries if key.endswith(marker) or f'{marker}:' in key]
+            for key in keys:
+                del self._entries[key]
+        logger.info(f"{len(keys)} cached responses of {marker[1:]} dropped")
+        return True
+
+    def clear(self):
+        self.clear_memory()
+        if self.disk is not None:
+            self.disk.clear()
+        return True
@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import logging
+import time
+from itertools import chain
+from database import insert_chunk
+
+logger = logging.getLogger(__name__)
+
+# Chunk size used when we have to read stop_times back from the database (streaming import)
+READ_CHUNK_SIZE = 500000
+
+
+# Re-chunks stop_times so no trip is split between two chunks, every chunk sorted by trip_id and stop_sequence.
+# Chunks must come ordered by trip_id: the rows of the last trip of a chunk are carried over to the next one
+def whole_trip_chunks(stop_times_chunks):
+    carry = None
+    for chunk in chain(stop_times_chunks, [None]):
+        if chunk is None:
+            chunk, carry = carry, None
+        else:
+            chunk = chunk.copy()
+            chunk['trip_id'] = chunk['trip_id'].astype(str)
+            chunk['stop_sequence'] = pd.to_numeric(chunk['stop_sequence'], errors='coerce')
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            if chunk.empty:
+                continue
+            chunk = chunk.sort_values(['trip_id', 'stop_sequence'], kind='stable')
+            is_last = (chunk['trip_id'] == chunk['trip_id'].iat[-1]).to_numpy()
+            carry, chunk = chunk[is_last], chunk[~is_last]
+        if chunk is not None and not chunk.empty:
+            yield chunk
+
+
+# Reduces stop_times to the stop pattern of every trip: trips of a route share a handful of stop sequences,
+# every distinct sequence gets a pattern id. Returns (one row per trip with its pattern_id, list of patterns
+# as tuples of stop_ids indexed by pattern_id)
+def trip_patterns(stop_times_chunks):
+    pattern_ids = {}
+    trip_ids, trip_pattern_ids = [], []
+
+    for chunk in whole_trip_chunks(chunk[['trip_id', 'stop_sequence', 'stop_id']] for chunk in stop_times_chunks):
+        chunk['stop_id'] = chunk['stop_id'].astype(str)
+        sequences = chunk.groupby('trip_id', sort=False)['stop_id'].agg(tuple)
+        trip_ids.extend(sequences.index)
+        trip_pattern_ids.extend(pattern_ids.setdefault(stops, len(pattern_ids)) for stops in sequences)
+
+    patterns = list(pattern_ids)
+    # object trip_id even without trips, it's joined on the string trip_id of the trips
+    trips = pd.DataFrame({'trip_id': pd.Series(trip_ids, dtype=object), 'pattern_id': np.array(trip_pattern_ids, dtype=np.int64)})
+    return trips, patterns
+
+
+# The pattern most trips of every route/direction follow (ties go to the pattern of the first trip_id,
+# the trip /stops used to pick), one row per stop in order with its name and coordinates
+def representative_shapes(trips, trip_pattern, patterns, stops):
+    trips = trips[['trip_id', 'route_id', 'direction_id']].copy()
+    for column in ('trip_id', 'route_id'):
+        trips[column] = trips[column].astype(str)
+    # direction_id is optional in GTFS, trips without it are drawn as direction 0
+    trips['direction_id'] = pd.to_numeric(trips['direction_id'], errors='coerce').fillna(0).astype(int)
+    merged = trips.merge(trip_pattern, on='trip_id', how='inner')
+    if merged.empty:
+        return pd.DataFrame(columns=['route_id', 'direction_id', 'position', 'stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+
+    counts = (merged.groupby(['route_id', 'direction_id', 'pattern_id'])
+              .agg(trips=('trip_id', 'size'), first_trip=('trip_id', 'min')).reset_index())
+    chosen = (counts.sort_values(['trips', 'first_trip'], ascending=[False, True])
+              .drop_duplicates(['route_id', 'direction_id']))
+
+    lengths = np.array([len(patterns[pattern_id]) for pattern_id in chosen['pattern_id']], dtype=np.int64)
+    shapes = pd.DataFrame({
+        'route_id': np.repeat(chosen['route_id'].to_numpy(), lengths),
+        'direction_id': np.repeat(chosen['direction_id'].to_numpy(), lengths),
+        'position': np.concatenate([np.arange(length) for length in lengths]) if len(lengths) else [],
+        'stop_id': [stop_id for pattern_id in chosen['pattern_id'] for stop_id in patterns[pattern_id]],
+    })
+
+    stops = stops[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']].copy()
+    stops['stop_id'] = stops['stop_id'].astype(str)
+    stops['stop_lat'] = pd.to_numeric(stops['stop_lat'], errors='coerce')
+    stops['stop_lon'] = pd.to_numeric(stops['stop_lon'], errors='coerce')
+    shapes = shapes.merge(stops.drop_duplicates('stop_id'), on='stop_id', how='left')
+    return shapes.sort_values(['route_id', 'direction_id', 'position'], ignore_index=True)
+
+
+# Ingest stage next to the route statistics: fills route_shapes so /stops and /route_shape read one route
+# with a primary key range scan, already in order and with the coordinates, no trip or stop_times involved.
+# If the dataframes are not available (streaming import) the tables are read back from the database
+def build_route_shapes(engine, dataframes=None):
+    start = time.perf_counter()
+    dataframes = dataframes or {}
+
+    def load(table_name, columns):
+        df = dataframes.get(table_name)
+        if df is not None:
+            return df if set(columns).issubset(df.columns) else None
+        try:
+            return pd.read_sql(f'SELECT {", ".join(columns)} FROM {table_name}', engine)
+        except Exception as e:
+            logger.warning(f"Can't read {table_name} for route shapes: {e}")
+            return None
+
+    stop_time_columns = ['trip_id', 'stop_sequence', 'stop_id']
+    if 'stop_times' in dataframes:
+        stop_times_chunks = [dataframes['stop_times'][stop_time_columns]]
+    else:
+        stop_times_chunks = pd.read_sql(f'SELECT {", ".join(stop_time_columns)} FROM stop_times ORDER BY trip_id, stop_sequence',
+                                        engine, chunksize=READ_CHUNK_SIZE)
+
+    trips = load('trips', ['trip_id', 'route_id', 'direction_id'])
+    stops = load('stops', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+    if trips is None or stops is None:
+        logger.warning("No trips or stops found, route shapes not created")
+        return 0
+
+    trip_pattern, patterns = trip_patterns(stop_times_chunks)
+    shapes = representative_shapes(trips, trip_pattern, patterns, stops)
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM route_shapes")
+        rows = insert_chunk(conn, 'route_shapes', shapes)
+
+    routes = shapes[['route_id', 'direction_id']].drop_duplicates().shape[0]
+    logger.info(f"Route shapes of {routes} routes/directions ({len(patterns)} stop patterns, {rows} stops) "
+                f"computed in {time.perf_counter() - start:.2f}s")
+    return rows
+
+
+# Google's encoded polyline format (precision 1e-5): deltas of the coordinates, 5 bits per character.
+# Decoded on the map by google.maps.geometry.encoding.decodePath
+def encode_polyline(lats, lons):
+    points = np.column_stack([np.round(np.asarray(lats, dtype=float) * 1e5), np.round(np.asarray(lons, dtype=float) * 1e5)])
+    deltas = np.diff(points.astype(np.int64), axis=0, prepend=0).ravel()
+    encoded = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        encoded.append(chr(value + 63))
+    return ''.join(encoded)
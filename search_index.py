@@ -0,0 +1,138 @@
+import logging
+import re
+import time
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+# Tables the index is built from, an incremental update touching them has to rebuild it
+SEARCH_SOURCES = {'stops', 'routes'}
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# One row per stop and per route. unicode61 with remove_diacritics folds case and accents ("Sao" finds "São"),
+# the prefix indexes make the 1-3 letter prefixes typed in the search box a lookup instead of a scan
+CREATE_SEARCH_INDEX = """
+    CREATE VIRTUAL TABLE search_index USING fts5(
+        kind UNINDEXED, ref_id UNINDEXED, name, extra,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3'
+    )
+"""
+
+# bm25 weights for kind, ref_id, name, extra: a hit in the stop name/route short name counts more than in the long name
+RANK = 'bm25(search_index, 0.0, 0.0, 10.0, 1.0)'
+
+SEARCH_STOPS = f"""
+    SELECT stops.stop_id, stops.stop_name, stops.stop_lat, stops.stop_lon
+    FROM search_index JOIN stops ON stops.stop_id = search_index.ref_id
+    WHERE search_index MATCH :query AND search_index.kind = 'stop'
+    ORDER BY {RANK}, length(stops.stop_name), stops.stop_name
+    LIMIT :limit OFFSET :offset
+"""
+
+SEARCH_ROUTES = f"""
+    SELECT routes.route_id, routes.route_short_name, routes.route_long_name
+    FROM search_index JOIN routes ON routes.route_id = search_index.ref_id
+    WHERE search_index MATCH :query AND search_index.kind = 'route'
+    ORDER BY {RANK}, length(routes.route_short_name), routes.route_short_name
+    LIMIT :limit OFFSET :offset
+"""
+
+# Same order as above with the id as last tie breaker, for cursor pagination and streaming: the sort key of every
+# row is returned with it and a page starts after the key of the last row of the previous one (keyset pagination,
+# every page costs the same however deep it is, unlike OFFSET)
+SEARCH_STOPS_AFTER = f"""
+    SELECT * FROM (
+        SELECT stops.stop_id, stops.stop_name, stops.stop_lat, stops.stop_lon,
+               {RANK} AS score, length(stops.stop_name) AS name_length
+        FROM search_index JOIN stops ON stops.stop_id = search_index.ref_id
+        WHERE search_index MATCH :query AND search_index.kind = 'stop'
+    )
+    WHERE (score, name_length, stop_name, stop_id) > (:score, :name_length, :name, :ref_id)
+    ORDER BY score, name_length, stop_name, stop_id
+"""
+
+SEARCH_ROUTES_AFTER = f"""
+    SELECT * FROM (
+        SELECT routes.route_id, routes.route_short_name, routes.route_long_name,
+               {RANK} AS score, length(routes.route_short_name) AS name_length
+        FROM search_index JOIN routes ON routes.route_id = search_index.ref_id
+        WHERE search_index MATCH :query AND search_index.kind = 'route'
+    )
+    WHERE (score, name_length, route_short_name, route_id) > (:score, :name_length, :name, :ref_id)
+    ORDER BY score, name_length, route_short_name, route_id
+"""
+
+# Sort key before the first row
+FIRST_KEY = [float('-inf'), -1, '', '']
+
+
+# (Re)builds the FTS5 table from stops and routes, False if this sqlite has no FTS5 (the server then uses LIKE)
+def build_search_index(engine):
+    if engine.dialect.name != 'sqlite':
+        return False
+    tables = set(inspect(engine).get_table_names())
+    start = time.perf_counter()
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS search_index")
+        try:
+            conn.exec_driver_sql(CREATE_SEARCH_INDEX)
+        except OperationalError as e:
+            logger.warning(f"No search index, this SQLite has no FTS5: {e}")
+            return False
+        if 'stops' in tables:
+            conn.exec_driver_sql("INSERT INTO search_index (kind, ref_id, name, extra) "
+                                 "SELECT 'stop', stop_id, stop_name, '' FROM stops WHERE stop_name IS NOT NULL")
+        if 'routes' in tables:
+            conn.exec_driver_sql("INSERT INTO search_index (kind, ref_id, name, extra) "
+                                 "SELECT 'route', route_id, coalesce(route_short_name, ''), coalesce(route_long_name, '') FROM routes")
+        conn.exec_driver_sql("INSERT INTO search_index (search_index) VALUES ('optimize')")
+        rows = conn.exec_driver_sql("SELECT count(*) FROM search_index").scalar()
+
+    logger.info(f"Search index built with {rows} names in {time.perf_counter() - start:.2f}s")
+    return True
+
+
+# For databases converted before the index existed
+def ensure_search_index(engine):
+    if inspect(engine).has_table('search_index'):
+        return False
+    return build_search_index(engine)
+
+
+# What the user typed as an FTS5 query: every word must match as a prefix, quoted so punctuation
+# and FTS operators (AND, NEAR, "-", "*"...) in stop names are just text. None when there's no word at all
+def match_query(query):
+    words = re.findall(r'\w+', query or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_stops(session, query, limit, offset=0):
+    return session.execute(text(SEARCH_STOPS), {'query': query, 'limit': limit, 'offset': offset}).all()
+
+
+def search_routes(session, query, limit, offset=0):
+    return session.execute(text(SEARCH_ROUTES), {'query': query, 'limit': limit, 'offset': offset}).all()
+
+
+# Statement and parameters of the matches after key (FIRST_KEY for the first page), kind 'stop' or 'route'.
+# Without a limit it's every match, for streaming
+def search_after(kind, query, key=FIRST_KEY, limit=None):
+    sql = SEARCH_STOPS_AFTER if kind == 'stop' else SEARCH_ROUTES_AFTER
+    params = dict(zip(('score', 'name_length', 'name', 'ref_id'), key), query=query)
+    if limit is not None:
+        sql += ' LIMIT :limit'
+        params['limit'] = limit
+    return text(sql), params
+
+
+# Sort key of a row of search_after, what the next page starts after
+def search_key(kind, row):
+    if kind == 'stop':
+        return [row.score, row.name_length, row.stop_name, row.stop_id]
+    return [row.score, row.name_length, row.route_short_name, row.route_id]
@@ -1,14 +1,30 @@
-from flask import Flask, render_template, request, jsonify, current_app
+from flask import Flask, render_template, request, jsonify, current_app, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_caching import Cache
-from sqlalchemy import func, create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import func, inspect, literal_column, select, tuple_
+from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 import logging
 import os
 import ujson
 from config import GOOGLE_MAPS_API_KEY
+from gtfs_time import parse_times
+from service_calendar import get_service_calendar, to_days, NO_DATE
+from analytics import get_trip_table, compute_network_stats, network_stats_records
+from headways import get_departures, HEADWAY_COLUMNS
+from response_cache import database_fingerprint, DEFAULT_SIZE
+from route_patterns import encode_polyline
+from columnar import get_columnar_feed
+from serving import FeedRegistry, UnknownFeed, init_app, request_parquet_dir, DEFAULT_THREADS, MAX_OPEN_FEEDS
+from search_index import match_query, search_stops, search_routes, search_after, search_key, FIRST_KEY, DEFAULT_LIMIT, MAX_LIMIT
+import instrumentation
+from instrumentation import stage
+from streaming import stream_rows, ndjson_response, json_list_response, encode_cursor, decode_cursor, InvalidCursor, MAX_PAGE_SIZE
+from spatial import stops_in_box, stops_near
+import numpy as np
+import pandas as pd
 
 # Debugging line to check the value of DATABASE_URL
 database_url = os.getenv('DATABASE_URL')
@@ -21,6 +37,36 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+# SQL count/time and named stages of every request: Server-Timing header, /metrics, GTFS_SLOW_QUERY_MS slow query log
+instrumentation.init_app(app)
+
+# Requests read the database of their feed (?feed=<id>) through a FeedRegistry (serving.py): the DATABASE_URL one
+# by default, GTFS_FEEDS=id=path,id=path and the .db files of GTFS_FEEDS_DIR as the others, opened when first asked
+# for. Read-only pooled connections when started with python -m serving, and /reload swaps the default database
+# without changing it under the requests still running
+feeds = FeedRegistry(database_url,
+                     feeds=dict(item.split('=', 1) for item in os.getenv('GTFS_FEEDS', '').split(',') if '=' in item),
+                     feeds_dir=os.getenv('GTFS_FEEDS_DIR'),
+                     max_open=int(os.getenv('GTFS_MAX_OPEN_FEEDS', MAX_OPEN_FEEDS)),
+                     state_file=os.getenv('GTFS_SERVER_STATE'),
+                     # Optional parquet export of the default database (python -m columnar feed.db folder), used by the
+                     # analytics of that database only
+                     parquet_dir=os.getenv('GTFS_PARQUET_DIR'),
+                     read_only=os.getenv('GTFS_READ_ONLY') == '1',
+                     pool_size=int(os.getenv('GTFS_POOL_SIZE', DEFAULT_THREADS)),
+                     immutable=os.getenv('GTFS_IMMUTABLE', '1') == '1')
+init_app(app, db, feeds)
+# Cross-feed queries run one feed per thread
+feed_executor = ThreadPoolExecutor(max_workers=int(os.getenv('GTFS_FEED_THREADS', 8)))
+
+# Responses of the slow endpoints are cached in memory (GTFS_CACHE_SIZE entries, least recently used go first),
+# set GTFS_CACHE_DIR to keep them on disk across restarts
+app.config['CACHE_TYPE'] = 'response_cache.LRUCache'
+app.config['CACHE_THRESHOLD'] = int(os.getenv('GTFS_CACHE_SIZE', DEFAULT_SIZE))
+app.config['CACHE_DIR'] = os.getenv('GTFS_CACHE_DIR')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 0
+cache = Cache(app)
+
 
 # Set up JSON encoder and decoder
 app.json_encoder = ujson.dumps
@@ -82,80 +128,295 @@ class StopTime(db.Model):
     shape_dist_traveled = db.Column(db.String)
     timepoint = db.Column(db.Integer)
 
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Precomputed by analytics.py during the conversion, databases converted elsewhere won't have it
+class RouteStat(db.Model):
+    __tablename__ = 'route_stats'
+    route_id = db.Column(db.String, primary_key=True)
+    direction_id = db.Column(db.Integer, primary_key=True)
+    trips_monday = db.Column(db.Integer)
+    trips_tuesday = db.Column(db.Integer)
+    trips_wednesday = db.Column(db.Integer)
+    trips_thursday = db.Column(db.Integer)
+    trips_friday = db.Column(db.Integer)
+    trips_saturday = db.Column(db.Integer)
+    trips_sunday = db.Column(db.Integer)
+    avg_time_monday = db.Column(db.Float)
+    avg_time_tuesday = db.Column(db.Float)
+    avg_time_wednesday = db.Column(db.Float)
+    avg_time_thursday = db.Column(db.Float)
+    avg_time_friday = db.Column(db.Float)
+    avg_time_saturday = db.Column(db.Float)
+    avg_time_sunday = db.Column(db.Float)
+
+
+# Endpoint + sorted query parameters + the database the answer came from
+def response_cache_key():
+    params = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items(multi=True)))
+    return f'{request.path}?{params}@{database_fingerprint(db.session.get_bind())}'
+
+
+# Errors are not cached, views return them as (response, status) tuples
+def is_cacheable(response):
+    return not isinstance(response, tuple) and response.status_code == 200
+
+
+# Precomputed by route_patterns.py during the conversion, like route_stats
+class RouteShape(db.Model):
+    __tablename__ = 'route_shapes'
+    route_id = db.Column(db.String, primary_key=True)
+    direction_id = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    stop_id = db.Column(db.String)
+    stop_name = db.Column(db.String)
+    stop_lat = db.Column(db.Float)
+    stop_lon = db.Column(db.Float)
+
+
+# Optional, precomputed by headways.py when converting with --headways
+class StopHeadway(db.Model):
+    __tablename__ = 'stop_headways'
+    stop_id = db.Column(db.String, primary_key=True)
+    route_id = db.Column(db.String, primary_key=True)
+    day = db.Column(db.String, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+    departures = db.Column(db.Integer)
+    avg_headway = db.Column(db.Float)
+    min_headway = db.Column(db.Float)
+    max_headway = db.Column(db.Float)
+
+
+def has_table(table_name):
+    return inspect(db.session.get_bind()).has_table(table_name)
+
+
+def has_column(table_name, column_name):
+    if not has_table(table_name):
+        return False
+    return any(column['name'] == column_name for column in inspect(db.session.get_bind()).get_columns(table_name))
+
+
 @app.route('/')
 def index():
     return render_template('index.html', api_key=GOOGLE_MAPS_API_KEY)
 
-# Simple search, gets all the routes and stops and returns it
+def stop_record(stop):
+    return {'stop_id': stop.stop_id, 'stop_name': stop.stop_name, 'stop_lat': float(stop.stop_lat), 'stop_lon': float(stop.stop_lon)}
+
+
+def route_record(route):
+    return {'route_id': route.route_id, 'route_short_name': route.route_short_name, 'route_long_name': route.route_long_name}
+
+
+SEARCH_RECORDS = {'stop': stop_record, 'route': route_record}
+
+
+# One page of stops and routes matching query in the database of session, as the /search answer.
+# Converted databases have a full text index (see search_index.py), matching every word as a prefix and ignoring
+# case and accents; others (or an empty query) fall back to LIKE, still with the limit so it never returns everything
+def search_database(session, query, limit, offset):
+    # One more row than asked tells if there's another page
+    fts_query = match_query(query)
+    if fts_query and inspect(session.get_bind()).has_table('search_index'):
+        stops = search_stops(session, fts_query, limit + 1, offset)
+        routes = search_routes(session, fts_query, limit + 1, offset)
+    else:
+        stops = (session.query(Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon)
+                 .filter(Stop.stop_name.ilike(f'%{query}%'))
+                 .order_by(Stop.stop_name).limit(limit + 1).offset(offset).all())
+        routes = (session.query(Route.route_id, Route.route_short_name, Route.route_long_name)
+                  .filter(Route.route_short_name.ilike(f'%{query}%'))
+                  .order_by(Route.route_short_name).limit(limit + 1).offset(offset).all())
+
+    return {'stops': [stop_record(stop) for stop in stops[:limit]], 'routes': [route_record(route) for route in routes[:limit]],
+            'limit': limit, 'offset': offset, 'has_more': {'stops': len(stops) > limit, 'routes': len(routes) > limit}}
+
+
+# Matches of one kind ('stop' or 'route') after key, in the order of the cursor pages: FTS rank with the index,
+# name and id with LIKE. Returns (statement, params, function giving the key of a row)
+def search_statement(kind, query, fts_query, key, limit=None):
+    if fts_query:
+        statement, params = search_after(kind, fts_query, key, limit)
+        return statement, params, lambda row: search_key(kind, row)
+
+    if kind == 'stop':
+        columns, name, ref_id = (Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon), Stop.stop_name, Stop.stop_id
+    else:
+        columns, name, ref_id = (Route.route_id, Route.route_short_name, Route.route_long_name), Route.route_short_name, Route.route_id
+    statement = (select(*columns).where(name.ilike(f'%{query}%'), tuple_(name, ref_id) > tuple_(*key))
+                 .order_by(name, ref_id))
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement, {}, lambda row: [row[1], row[0]]
+
+
+# Cursor pagination of /search: every page starts after the last stop and route of the previous one, so deep pages
+# cost the same as the first. The cursor keeps both positions (None once a kind has no more matches) and which
+# ordering it belongs to
+def search_page(session, query, limit, cursor):
+    fts_query = match_query(query)
+    fts = bool(fts_query) and inspect(session.get_bind()).has_table('search_index')
+    first_key = FIRST_KEY if fts else ['', '']
+    position = decode_cursor(cursor) if cursor else {'fts': fts, 'stop': first_key, 'route': first_key}
+    if not isinstance(position, dict) or position.get('fts') != fts:
+        raise InvalidCursor('This cursor belongs to another search')
+    # Both positions, each None or a key of this ordering, or the page would silently come back empty
+    for kind in ('stop', 'route'):
+        key = position.get(kind, ())
+        if key is not None and not (isinstance(key, list) and len(key) == len(first_key)):
+            raise InvalidCursor(f'Invalid cursor {cursor!r}')
+
+    page, next_position = {}, {'fts': fts}
+    for kind in ('stop', 'route'):
+        rows, next_position[kind] = [], None
+        if position.get(kind) is not None:
+            statement, params, row_key = search_statement(kind, query, fts_query if fts else None, position[kind], limit + 1)
+            rows = session.execute(statement, params).all()
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_position[kind] = row_key(rows[-1])
+        page[f'{kind}s'] = [SEARCH_RECORDS[kind](row) for row in rows]
+
+    more = next_position['stop'] is not None or next_position['route'] is not None
+    return {**page, 'limit': limit, 'next_cursor': encode_cursor(next_position) if more else None}
+
+
+# Every match (stops first, then routes, at most limit of each when given) one per line, read from the database
+# as the response is sent
+def search_stream(engine, query, limit=None):
+    fts_query = match_query(query)
+    fts = bool(fts_query) and inspect(engine).has_table('search_index')
+    for kind in ('stop', 'route'):
+        statement, params, _ = search_statement(kind, query, fts_query if fts else None, FIRST_KEY if fts else ['', ''], limit)
+        for row in stream_rows(engine, statement, params):
+            yield {'kind': kind, **SEARCH_RECORDS[kind](row)}
+
+
+def search_limits(data):
+    limit = min(max(int(data.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    offset = max(int(data.get('offset', 0)), 0)
+    return limit, offset
+
+
+# Search for stops and routes by name, ranked and paginated: {"query": ..., "limit": 50, "offset": 0}.
+# "cursor": null instead of offset gives cursor pages (pass next_cursor back for the next one),
+# "format": "ndjson" streams every match, or the first limit of each kind
 @app.route('/search', methods=['POST'])
 def search():
-    data = request.get_json()
-    query = data.get('query')
-    stops = Stop.query.filter(Stop.stop_name.ilike(f'%{query}%')).all()
-    routes = Route.query.filter(Route.route_short_name.ilike(f'%{query}%')).all()
-    stops_data = [{'stop_id': stop.stop_id, 'stop_name': stop.stop_name, 'stop_lat': float(stop.stop_lat), 'stop_lon': float(stop.stop_lon)} for stop in stops]
-    routes_data = [{'route_id': route.route_id, 'route_short_name': route.route_short_name, 'route_long_name': route.route_long_name} for route in routes]
-    return jsonify({'stops': stops_data, 'routes': routes_data})
+    data = request.get_json() or {}
+    query = data.get('query') or ''
+    try:
+        limit, offset = search_limits(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+
+    if data.get('format') == 'ndjson':
+        return ndjson_response(search_stream(db.session.get_bind(), query, limit if 'limit' in data else None))
+    if 'cursor' in data:
+        try:
+            return jsonify(search_page(db.session, query, limit, data['cursor']))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(search_database(db.session, query, limit, offset))
+
+
+# Feeds this server can answer for, the ids every endpoint takes as ?feed=
+@app.route('/feeds', methods=['GET'])
+def list_feeds():
+    return jsonify([{'feed': feed_id, 'open': feeds.is_open(feed_id)} for feed_id in feeds.feed_ids()])
+
 
+def search_feed(feed_id, query, limit, offset):
+    with feeds.using(feed_id) as engine, Session(engine) as session:
+        return search_database(session, query, limit, offset)
 
-# This function it's used if the user selects another database while the server it's running,
-# it will remove the existing one, reload and launch a new browser window
+
+# /search on several feeds at once, one feed per thread of feed_executor: {"query": ..., "feeds": [ids] (default
+# all of them), "limit": 50, "offset": 0}. Answers every feed with its own page, feeds that failed go in errors
+@app.route('/search_all', methods=['POST'])
+def search_all():
+    data = request.get_json() or {}
+    try:
+        limit, offset = search_limits(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    feed_ids = data.get('feeds') or feeds.feed_ids()
+    if not isinstance(feed_ids, list):
+        return jsonify({'error': 'feeds must be a list of feed ids'}), 400
+
+    query = data.get('query') or ''
+    futures = {feed_id: feed_executor.submit(search_feed, feed_id, query, limit, offset) for feed_id in dict.fromkeys(feed_ids)}
+    results, errors = [], {}
+    for feed_id, future in futures.items():
+        try:
+            results.append({'feed': feed_id, **future.result()})
+        except UnknownFeed:
+            errors[feed_id] = 'Unknown feed'
+        except Exception as e:
+            logger.error(f"Error searching feed {feed_id}: {e}", exc_info=True)
+            errors[feed_id] = 'An error occurred while searching this feed'
+    return jsonify({'query': query, 'feeds': results, 'errors': errors})
+
+
+# This function it's used if the user selects another database while the server it's running.
+# The new database is opened and checked before the swap, requests already running finish on the old one
 @app.route('/reload', methods=['POST'])
 def reload_config():
     data = request.json
     db_path = data.get('db_path')
     if db_path:
-        new_db_uri = f'sqlite:///{db_path}'
-        
-        with app.app_context():
-            # Update the database URI in the app config
-            app.config['SQLALCHEMY_DATABASE_URI'] = new_db_uri
-            
-            
-            db.session.remove()
-            
-            # Dispose of the current engine
-            db.engine.dispose()
-            
-            # Create a new engine
-            engine = create_engine(new_db_uri)
-            
-            # Reconfigure the session and bind the new engine to the metadata
-            db.session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
-            db.metadata.bind = engine
-            
-            db.create_all()
+        if not os.path.exists(db_path):
+            return jsonify({"error": f"Database {db_path} not found"}), 404
+        new_db_uri = f'sqlite:///{os.path.abspath(db_path)}'
+        old_engine = feeds.default.current.engine
+        try:
+            feeds.default.swap(new_db_uri)
+        except Exception as e:
+            logger.error(f"Could not open {db_path}: {e}")
+            return jsonify({"error": f"Could not open {db_path}"}), 400
+        app.config['SQLALCHEMY_DATABASE_URI'] = new_db_uri
+
+        # The keys of the new database are different anyway, this just frees the memory the old one used
+        cache.cache.clear_database(old_engine)
         
         return jsonify({"message": "Database reloaded successfully"}), 200
     else:
         return jsonify({"error": "No db_path provided"}), 400
 
+# Stops of a route in order, as (stop_id, stop_name, lat, lon) rows: from route_shapes when the database has it,
+# otherwise the stops of the first trip of the route/direction in one query, ordered by stop_sequence
+def route_stop_rows(route_id, direction_id):
+    if has_table('route_shapes'):
+        return (db.session.query(RouteShape.stop_id, RouteShape.stop_name, RouteShape.stop_lat, RouteShape.stop_lon)
+                .filter(RouteShape.route_id == route_id, RouteShape.direction_id == direction_id)
+                .order_by(RouteShape.position)
+                .all())
+
+    first_trip_id = (db.session.query(func.min(Trip.trip_id))
+                     .filter(Trip.route_id == route_id, Trip.direction_id == direction_id)
+                     .scalar_subquery())
+    return (db.session.query(Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon)
+            .join(StopTime, Stop.stop_id == StopTime.stop_id)
+            .filter(StopTime.trip_id == first_trip_id)
+            .order_by(StopTime.stop_sequence)
+            .all())
+
+
 #This gets a list of stops associated with the route_id sent
+# We choose only one direction supposing the number should be more or less the same on both
 @app.route('/stops', methods=['GET'])
+@cache.cached(make_cache_key=response_cache_key, response_filter=is_cacheable)
 def get_stops():
     route_id = request.args.get('route_id')
     if not route_id:
         return jsonify({'error': 'Missing route_id parameter'}), 400
 
     try:
-        # Find the first trip_id for the given route_id and direction_id
-        # We choose only one direction supposing the number should be more or less the same on both
-        first_trip = (db.session.query(Trip)
-                      .filter(Trip.route_id == route_id, Trip.direction_id == 0)
-                      .order_by(Trip.trip_id)
-                      .first())
-
-        if not first_trip:
+        stops = route_stop_rows(route_id, 0)
+        if not stops:
             return jsonify({'error': 'No trips found for the given route_id and direction_id'}), 404
 
-        first_trip_id = first_trip.trip_id
-
-        # Query stops associated with the first trip_id
-        stops = (db.session.query(Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon)
-                 .join(StopTime, Stop.stop_id == StopTime.stop_id)
-                 .filter(StopTime.trip_id == first_trip_id)
-                 .all())
-
         stop_list = [{
             'stop_id': stop.stop_id,
             'stop_name': stop.stop_name,
@@ -169,110 +430,229 @@ def get_stops():
         return jsonify({'error': f'An error occurred while retrieving stops: {e}'}), 500
 
 
+# Same stops as /stops as parallel arrays, what the map needs to draw a route:
+# format=arrays (default) gives lat/lon arrays, format=polyline the coordinates as a Google encoded polyline
+@app.route('/route_shape', methods=['GET'])
+@cache.cached(make_cache_key=response_cache_key, response_filter=is_cacheable)
+def route_shape():
+    route_id = request.args.get('route_id')
+    if not route_id:
+        return jsonify({'error': 'Missing route_id parameter'}), 400
+    direction_id = request.args.get('direction_id', 0, type=int)
+    shape_format = request.args.get('format', 'arrays')
+    if shape_format not in ('arrays', 'polyline'):
+        return jsonify({'error': 'format must be arrays or polyline'}), 400
+
+    try:
+        stops = route_stop_rows(route_id, direction_id)
+        if not stops:
+            return jsonify({'error': 'No trips found for the given route_id and direction_id'}), 404
+
+        lats = np.array([stop.stop_lat for stop in stops], dtype=float)
+        lons = np.array([stop.stop_lon for stop in stops], dtype=float)
+        shape = {
+            'route_id': route_id,
+            'direction_id': direction_id,
+            'stop_ids': [stop.stop_id for stop in stops],
+            'stop_names': [stop.stop_name for stop in stops],
+        }
+        if shape_format == 'polyline':
+            shape['polyline'] = encode_polyline(lats, lons)
+        else:
+            # Stops without coordinates are sent as null, JSON has no NaN
+            shape['lat'] = [None if np.isnan(lat) else lat for lat in lats.tolist()]
+            shape['lon'] = [None if np.isnan(lon) else lon for lon in lons.tolist()]
+        return jsonify(shape)
+
+    except Exception as e:
+        logger.error(f"Error retrieving the shape of route {route_id}: {e}", exc_info=True)
+        return jsonify({'error': 'An error occurred while retrieving the route shape'}), 500
+
+
+# Limits of the spatial endpoints, a viewport zoomed out over a whole country doesn't get every stop of the feed
+BBOX_LIMIT = 1000
+MAX_BBOX_LIMIT = 5000
+DEFAULT_RADIUS = 500
+MAX_RADIUS = 5000
+NEARBY_LIMIT = 50
+
+
+def stop_records(stops, distance=False):
+    records = [{'stop_id': stop.stop_id, 'stop_name': stop.stop_name, 'lat': stop.stop_lat, 'lng': stop.stop_lon}
+               for stop in stops.itertuples(index=False)]
+    if distance:
+        for record, value in zip(records, stops['distance'].round(1).tolist()):
+            record['distance'] = value
+    return records
+
+
+# Stops inside the visible part of the map: ?min_lat&min_lon&max_lat&max_lon&limit=1000 (at most 5000).
+# Looked up in the R*Tree of the stops (spatial.py), truncated tells the map there are more stops than the limit
+@app.route('/stops_in_bbox', methods=['GET'])
+@cache.cached(make_cache_key=response_cache_key, response_filter=is_cacheable)
+def get_stops_in_bbox():
+    box = [request.args.get(name, type=float) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+    if any(value is None for value in box):
+        return jsonify({'error': 'min_lat, min_lon, max_lat and max_lon are required numbers'}), 400
+    min_lat, min_lon, max_lat, max_lon = box
+    if min_lat > max_lat or min_lon > max_lon:
+        return jsonify({'error': 'min_lat/min_lon must be lower than max_lat/max_lon'}), 400
+    limit = min(max(request.args.get('limit', BBOX_LIMIT, type=int), 1), MAX_BBOX_LIMIT)
+
+    try:
+        stops = stops_in_box(db.session, min_lat, min_lon, max_lat, max_lon)
+        return jsonify({'stops': stop_records(stops.head(limit)), 'truncated': len(stops) > limit})
+    except Exception as e:
+        logger.error(f"Error retrieving the stops in {box}: {e}", exc_info=True)
+        return jsonify({'error': 'An error occurred while retrieving the stops'}), 500
+
+
+# Stops within radius meters (default 500, at most 5000) of ?lat&lon, nearest first with their distance in meters
+@app.route('/stops_nearby', methods=['GET'])
+@cache.cached(make_cache_key=response_cache_key, response_filter=is_cacheable)
+def get_stops_nearby():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'error': 'lat and lon are required coordinates'}), 400
+    radius = min(max(request.args.get('radius', DEFAULT_RADIUS, type=float), 0), MAX_RADIUS)
+    limit = min(max(request.args.get('limit', NEARBY_LIMIT, type=int), 1), MAX_BBOX_LIMIT)
+
+    try:
+        stops = stops_near(db.session, lat, lon, radius)
+        return jsonify({'stops': stop_records(stops.head(limit), distance=True), 'radius': radius})
+    except Exception as e:
+        logger.error(f"Error retrieving the stops near {lat},{lon}: {e}", exc_info=True)
+        return jsonify({'error': 'An error occurred while retrieving the stops'}), 500
+
+
 # Here we analyze the data related to the route_id received, it can probably be 
 # optimized more splitting it in multiple parts for better code understanding
 @app.route('/route_info', methods=['GET'])
+@cache.cached(make_cache_key=response_cache_key, response_filter=is_cacheable)
 def route_info():
     route_id = request.args.get('route_id')
     if not route_id:
         return jsonify({'error': 'Missing route_id parameter'}), 400
 
     try:
+        # Converted databases already have the numbers, one primary key lookup and we're done
+        if has_table('route_stats'):
+            stats = db.session.get(RouteStat, (route_id, 0))
+            if stats:
+                return jsonify({
+                    'days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                    'tripsByDay': [getattr(stats, f'trips_{day}') for day in DAYS],
+                    'avgRouteTime': [getattr(stats, f'avg_time_{day}') for day in DAYS]
+                })
+
+        # With a parquet export of the feed (GTFS_PARQUET_DIR) the numbers of every route are computed once,
+        # vectorized over the columnar files, and then looked up
+        parquet_dir = request_parquet_dir()
+        if parquet_dir:
+            stats = get_columnar_feed(parquet_dir).route_stats()
+            if (route_id, 0) in stats.index:
+                stats = stats.loc[(route_id, 0)]
+                return jsonify({
+                    'days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                    'tripsByDay': [int(stats[f'trips_{day}']) for day in DAYS],
+                    'avgRouteTime': [float(stats[f'avg_time_{day}']) for day in DAYS]
+                })
+
+        # Converted databases have the times already in seconds, otherwise we select the strings and parse them below
+        has_seconds = has_column('stop_times', 'arrival_secs')
+        if has_seconds:
+            arrival_column = literal_column('stop_times.arrival_secs')
+            departure_column = literal_column('stop_times.departure_secs')
+        else:
+            arrival_column, departure_column = StopTime.arrival_time, StopTime.departure_time
+
         # Fetch distinct trips and stop times
-        stop_times = db.session.query(
-            Trip.trip_id,
-            StopTime.arrival_time,
-            StopTime.departure_time,
-            StopTime.stop_sequence,
-            Trip.service_id
-        ).join(Trip, StopTime.trip_id == Trip.trip_id).filter(
-            Trip.route_id == route_id,
-            Trip.direction_id == 0
-        ).order_by(
-            Trip.trip_id,
-            StopTime.stop_sequence
-        ).all()
+        with stage('stop_times'):
+            stop_times = db.session.query(
+                Trip.trip_id,
+                arrival_column,
+                departure_column,
+                StopTime.stop_sequence,
+                Trip.service_id
+            ).join(Trip, StopTime.trip_id == Trip.trip_id).filter(
+                Trip.route_id == route_id,
+                Trip.direction_id == 0
+            ).order_by(
+                Trip.trip_id,
+                StopTime.stop_sequence
+            ).all()
 
         if not stop_times:
             return jsonify({'error': 'No stop times found for the given route_id'}), 404
 
         trip_times = defaultdict(lambda: {'start_time': None, 'end_time': None})
         service_ids = {}
-        # every time it finds a time where hours are 24+ it converts it 
-        # So 25 becomes 01, 26-02 and so on
-        def parse_time(time_str):
-            hours, minutes, seconds = map(int, time_str.split(':'))
-    
-            if hours >= 24:
-                days = hours // 24
-                hours = hours % 24
-                return datetime.strptime(f"{hours:02d}:{minutes:02d}:{seconds:02d}", '%H:%M:%S') + timedelta(days=days)
+
+        # Times are seconds from the start of the service day, so 25:00:00 is just 90000 and needs no special case
+        with stage('parse_times'):
+            if has_seconds:
+                arrivals = np.array([row[1] if row[1] is not None else -1 for row in stop_times], dtype=np.int64)
+                departures = np.array([row[2] if row[2] is not None else -1 for row in stop_times], dtype=np.int64)
+                valid = (arrivals >= 0) & (departures >= 0)
             else:
-                return datetime.strptime(time_str, '%H:%M:%S')
+                arrivals, arrivals_valid = parse_times([row[1] for row in stop_times])
+                departures, departures_valid = parse_times([row[2] for row in stop_times])
+                valid = arrivals_valid & departures_valid
 
-        for trip_id, arrival_time, departure_time, stop_sequence, service_id in stop_times:
-            service_ids[trip_id] = service_id
-            try:
-                arrival_obj = parse_time(arrival_time)
-                departure_obj = parse_time(departure_time)
+        with stage('trip_loop'):
+            for (trip_id, _, _, stop_sequence, service_id), arrival, departure, is_valid in zip(stop_times, arrivals.tolist(), departures.tolist(), valid.tolist()):
+                service_ids[trip_id] = service_id
+                if not is_valid:
+                    logger.error(f'Error parsing time for trip_id {trip_id}')
+                    continue
 
                 if trip_times[trip_id]['start_time'] is None or stop_sequence == 1:
-                    trip_times[trip_id]['start_time'] = arrival_obj
-                trip_times[trip_id]['end_time'] = departure_obj
-            except ValueError as e:
-                logger.error(f'Error parsing time for trip_id {trip_id}: {e}')
-                continue
-
-        # Process working days from calendar and calendar_dates
-        working_days = defaultdict(lambda: defaultdict(list))
-
-        for service_id in set(service_ids.values()):
-            calendar = Calendar.query.filter_by(service_id=service_id).first()
-            if calendar:
-                for day, active in enumerate([calendar.monday, calendar.tuesday, calendar.wednesday, calendar.thursday, calendar.friday, calendar.saturday, calendar.sunday]):
-                    if active:
-                        working_days[service_id][day].append(service_id)
-            else:
-                calendar_dates = CalendarDate.query.filter_by(service_id=service_id).all()
-                for cd in calendar_dates:
-                    date = datetime.strptime(str(cd.date), '%Y%m%d')
-                    day = date.weekday()
-                    if cd.exception_type == 1:
-                        working_days[service_id][day].append(service_id)
-
-        # Trips by day of the week
-        trips_by_day_dict = {str(i): 0 for i in range(7)}
-
-        for trip_id in trip_times.keys():
-            service_id = service_ids[trip_id]
-            if service_id in working_days:
-                for day in working_days[service_id]:
-                    trips_by_day_dict[str(day)] += 1
-
-        trips_by_day_list = [trips_by_day_dict[str(i)] for i in range(7)]
-
-        # Average route times by day of the week
-        avg_route_time_by_day = defaultdict(list)
-        for trip_id, times in trip_times.items():
-            start_time = times['start_time']
-            end_time = times['end_time']
-            if start_time and end_time:
-                if end_time < start_time:
-                    end_time += timedelta(days=1)
-                route_time = (end_time - start_time).total_seconds() / 60
+                    trip_times[trip_id]['start_time'] = arrival
+                trip_times[trip_id]['end_time'] = departure
 
+        # Active weekdays of all the services of the route at once, from the calendar cached for this database
+        # (calendar flags inside start_date/end_date, minus removed dates, plus added dates)
+        with stage('calendar'):
+            route_services = list(set(service_ids.values()))
+            active_weekdays = get_service_calendar(db.session.get_bind()).active_weekdays(route_services)
+            working_days = {service_id: [day for day in range(7) if active[day]] for service_id, active in zip(route_services, active_weekdays)}
+
+        with stage('aggregate'):
+            # Trips by day of the week
+            trips_by_day_dict = {str(i): 0 for i in range(7)}
+
+            for trip_id in trip_times.keys():
                 service_id = service_ids[trip_id]
                 if service_id in working_days:
                     for day in working_days[service_id]:
-                        avg_route_time_by_day[day].append(route_time)
-
-        avg_route_times = [sum(times) / len(times) if times else 0.0 for times in [avg_route_time_by_day[day] for day in range(7)]]
-
-        return jsonify({
-            'days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
-            'tripsByDay': trips_by_day_list,
-            'avgRouteTime': avg_route_times
-        })
+                        trips_by_day_dict[str(day)] += 1
+
+            trips_by_day_list = [trips_by_day_dict[str(i)] for i in range(7)]
+
+            # Average route times by day of the week
+            avg_route_time_by_day = defaultdict(list)
+            for trip_id, times in trip_times.items():
+                start_time = times['start_time']
+                end_time = times['end_time']
+                if start_time is not None and end_time is not None:
+                    if end_time < start_time:
+                        end_time += 86400
+                    route_time = (end_time - start_time) / 60
+
+                    service_id = service_ids[trip_id]
+                    if service_id in working_days:
+                        for day in working_days[service_id]:
+                            avg_route_time_by_day[day].append(route_time)
+
+            avg_route_times = [sum(times) / len(times) if times else 0.0 for times in [avg_route_time_by_day[day] for day in range(7)]]
+
+        with stage('json'):
+            return jsonify({
+                'days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                'tripsByDay': trips_by_day_list,
+                'avgRouteTime': avg_route_times
+            })
 
     except Exception as e:
         logger.error(f"Error retrieving route info for route {route_id}: {e}", exc_info=True)
@@ -280,10 +660,131 @@ def route_info():
 
 
 
+# Every route, streamed from the database as a JSON list (same document as before, in route_id order).
+# ?limit=100 gives pages of at most 1000 routes ({"routes": [...], "next_cursor": ...}, ?cursor= for the next one),
+# ?format=ndjson one route per line, after cursor and up to limit when given. A limit below 1 is a 400
 @app.route('/routes')
 def get_routes():
-    routes = Route.query.all()
-    return jsonify([{'route_id': route.route_id, 'route_short_name': route.route_short_name, 'route_long_name': route.route_long_name} for route in routes])
+    response_format = request.args.get('format', 'json')
+    if response_format not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        if limit < 1:
+            return jsonify({'error': 'limit must be at least 1'}), 400
+
+    statement = select(Route.route_id, Route.route_short_name, Route.route_long_name).order_by(Route.route_id)
+    if cursor:
+        try:
+            statement = statement.where(Route.route_id > decode_cursor(cursor))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+
+    if response_format == 'ndjson' or (limit is None and cursor is None):
+        if limit is not None:
+            statement = statement.limit(limit)
+        routes = map(route_record, stream_rows(db.session.get_bind(), statement))
+        return ndjson_response(routes) if response_format == 'ndjson' else json_list_response(routes)
+
+    limit = min(DEFAULT_LIMIT if limit is None else limit, MAX_PAGE_SIZE)
+    routes = db.session.execute(statement.limit(limit + 1)).all()
+    next_cursor = encode_cursor(routes[limit - 1].route_id) if len(routes) > limit else None
+    return jsonify({'routes': [route_record(route) for route in routes[:limit]], 'next_cursor': next_cursor})
+
+
+# Minutes between consecutive departures by stop, route and hour: ?day=monday (default) or ?date=YYYYMMDD,
+# optionally only one stop_id/route_id, by_route=0 to pool all the routes of a stop, min_gap=30 to keep only the
+# hours with a gap of at least 30 minutes. With a stop_id the answer is one JSON object, otherwise the whole network
+# is streamed as NDJSON. Weekdays come from stop_headways when the database has it, the rest is computed from the
+# departures of the database, loaded once and kept in memory
+@app.route('/headways', methods=['GET'])
+def stop_headways():
+    stop_id = request.args.get('stop_id')
+    route_id = request.args.get('route_id')
+    date = request.args.get('date')
+    day = (request.args.get('day') or 'monday').lower()
+    by_route = request.args.get('by_route', '1') not in ('0', 'false')
+    min_gap = request.args.get('min_gap', type=float)
+    if date is not None:
+        if len(date) != 8 or to_days([date])[0] == NO_DATE:
+            return jsonify({'error': 'date must be YYYYMMDD'}), 400
+        day = date
+    elif day not in DAYS:
+        return jsonify({'error': f'day must be one of {", ".join(DAYS)}'}), 400
+
+    try:
+        if date is None and by_route and has_table('stop_headways') and db.session.query(StopHeadway.stop_id).first():
+            query = db.session.query(*[getattr(StopHeadway, column) for column in HEADWAY_COLUMNS]).filter(StopHeadway.day == day)
+            if stop_id:
+                query = query.filter(StopHeadway.stop_id == stop_id)
+            if route_id:
+                query = query.filter(StopHeadway.route_id == route_id)
+            if min_gap is not None:
+                query = query.filter(StopHeadway.max_headway >= min_gap)
+            rows = pd.DataFrame(query.order_by(StopHeadway.stop_id, StopHeadway.route_id, StopHeadway.hour).all(), columns=HEADWAY_COLUMNS)
+        else:
+            engine = db.session.get_bind()
+            with stage('departures'):
+                departures, calendar = get_departures(engine), get_service_calendar(engine)
+            with stage('headways'):
+                rows = departures.headways(calendar, day, by_route, stop_id, route_id)
+            if min_gap is not None:
+                rows = rows[rows['max_headway'] >= min_gap]
+    except Exception as e:
+        logger.error(f"Error computing headways: {e}", exc_info=True)
+        return jsonify({'error': 'An error occurred while computing headways'}), 500
+
+    with stage('records'):
+        rows = rows.round({'avg_headway': 2, 'min_headway': 2, 'max_headway': 2})
+        records = rows.astype(object).where(rows.notna(), None).to_dict('records')
+    if stop_id:
+        with stage('json'):
+            return jsonify({'stop_id': stop_id, 'day': day, 'headways': records})
+
+    def generate():
+        for record in records:
+            yield ujson.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# Numbers of every route of the network in one go, one JSON object per line (NDJSON) so clients can start
+# reading before the whole network is sent: trips by weekday (or trips on ?date=YYYYMMDD), average/median/90th
+# percentile trip duration in minutes and first/last departure. stop_times is scanned once per database
+# (or read from the parquet export with GTFS_PARQUET_DIR), every request after that is just the grouping
+@app.route('/network_stats', methods=['GET'])
+def network_stats():
+    date = request.args.get('date')
+    if date is not None and (len(date) != 8 or to_days([date])[0] == NO_DATE):
+        return jsonify({'error': 'date must be YYYYMMDD'}), 400
+
+    try:
+        with stage('trip_table'):
+            parquet_dir = request_parquet_dir()
+            if parquet_dir:
+                feed = get_columnar_feed(parquet_dir)
+                trips, calendar = feed.trip_table(), feed.service_calendar()
+            else:
+                engine = db.session.get_bind()
+                trips, calendar = get_trip_table(engine), get_service_calendar(engine)
+            routes = pd.read_sql(db.session.query(Route.route_id, Route.route_short_name, Route.route_long_name).statement,
+                                 db.session.connection())
+        with stage('network_stats'):
+            records = network_stats_records(compute_network_stats(trips, calendar, date), routes)
+    except Exception as e:
+        logger.error(f"Error computing network statistics: {e}", exc_info=True)
+        return jsonify({'error': 'An error occurred while computing network statistics'}), 500
+
+    def generate():
+        for record in records:
+            yield ujson.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 
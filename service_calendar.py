@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import logging
+import os
+import threading
+from sqlalchemy import inspect
+
+logger = logging.getLogger(__name__)
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# calendar_dates exception types
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+# Dates are kept as days since 1970-01-01 (a thursday), so the weekday (monday=0) is (day + 3) % 7
+EPOCH_WEEKDAY = 3
+NO_DATE = np.iinfo(np.int64).min
+
+
+def to_days(dates):
+    dates = pd.to_datetime(pd.Series(dates).astype(str), format='%Y%m%d', errors='coerce')
+    return dates.to_numpy(dtype='datetime64[D]').astype(np.int64)
+
+
+def weekday_of(days):
+    return (np.asarray(days) + EPOCH_WEEKDAY) % 7
+
+
+# calendar + calendar_dates of a whole feed in a few numpy arrays:
+# - one weekday bitmask (bit 0 = monday) and a start/end date for every service in calendar
+# - all the calendar_dates exceptions as a sorted array of (service index, date) keys with their type
+# Every question is answered for many service_ids at once, with no query and no python loop per service
+class ServiceCalendar:
+    def __init__(self, calendar=None, calendar_dates=None):
+        calendar = calendar if calendar is not None else pd.DataFrame(columns=['service_id'] + DAYS + ['start_date', 'end_date'])
+        calendar_dates = calendar_dates if calendar_dates is not None else pd.DataFrame(columns=['service_id', 'date', 'exception_type'])
+
+        calendar = calendar.assign(service_id=calendar['service_id'].astype(str)).drop_duplicates('service_id')
+        calendar_dates = calendar_dates.assign(service_id=calendar_dates['service_id'].astype(str))
+
+        self.service_ids = np.array(sorted(set(calendar['service_id']) | set(calendar_dates['service_id'])), dtype=object)
+        self.index = {service_id: i for i, service_id in enumerate(self.service_ids)}
+        count = len(self.service_ids)
+
+        # Services only in calendar_dates have an empty mask and no date range
+        self.weekday_mask = np.zeros(count, dtype=np.uint8)
+        self.start_day = np.full(count, NO_DATE, dtype=np.int64)
+        self.end_day = np.full(count, NO_DATE, dtype=np.int64)
+        if not calendar.empty:
+            positions = self.positions(calendar['service_id'])
+            flags = calendar[DAYS].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.int64) > 0
+            self.weekday_mask[positions] = (flags * (1 << np.arange(7))).sum(axis=1).astype(np.uint8)
+            self.start_day[positions] = to_days(calendar['start_date'])
+            self.end_day[positions] = to_days(calendar['end_date'])
+
+        # Invalid dates (NaT) come out as the minimum int64, the same value as NO_DATE
+        keys = np.zeros(0, dtype=np.int64)
+        types = np.zeros(0, dtype=np.int8)
+        if not calendar_dates.empty:
+            days = to_days(calendar_dates['date'])
+            exception_types = pd.to_numeric(calendar_dates['exception_type'], errors='coerce').fillna(0).to_numpy(dtype=np.int8)
+            valid = (days != NO_DATE) & np.isin(exception_types, (SERVICE_ADDED, SERVICE_REMOVED))
+            keys = self.make_keys(self.positions(calendar_dates['service_id'])[valid], days[valid])
+            types = exception_types[valid]
+            order = np.argsort(keys, kind='stable')
+            keys, types = keys[order], types[order]
+        self.exception_keys = keys
+        self.exception_types = types
+
+    @classmethod
+    def from_engine(cls, engine):
+        tables = set(inspect(engine).get_table_names())
+        calendar = pd.read_sql('SELECT * FROM calendar', engine) if 'calendar' in tables else None
+        calendar_dates = pd.read_sql('SELECT * FROM calendar_dates', engine) if 'calendar_dates' in tables else None
+        return cls(calendar, calendar_dates)
+
+    @staticmethod
+    def make_keys(positions, days):
+        return (np.asarray(positions, dtype=np.int64) << 32) + np.asarray(days, dtype=np.int64)
+
+    # Index of every service_id in our arrays, -1 for the unknown ones
+    def positions(self, service_ids):
+        return np.array([self.index.get(str(service_id), -1) for service_id in service_ids], dtype=np.int64)
+
+    # Exception type for every (service, day) pair, 0 if there's none
+    def exceptions_on(self, positions, days):
+        if self.exception_keys.size == 0:
+            return np.zeros(len(positions), dtype=np.int8)
+        keys = self.make_keys(positions, days)
+        found = np.searchsorted(self.exception_keys, keys).clip(max=self.exception_keys.size - 1)
+        return np.where(self.exception_keys[found] == keys, self.exception_types[found], 0)
+
+    # True for every service running on the given date (YYYYMMDD, as int or string)
+    def active_on(self, service_ids, date):
+        positions = self.positions(service_ids)
+        known = positions >= 0
+        safe = np.where(known, positions, 0)
+        day = to_days([date])[0]
+        days = np.full(len(positions), day, dtype=np.int64)
+
+        in_range = (self.start_day[safe] <= day) & (day <= self.end_day[safe])
+        on_weekday = (self.weekday_mask[safe] >> weekday_of(day)) & 1 == 1
+        exceptions = self.exceptions_on(safe, days)
+        active = (in_range & on_weekday & (exceptions != SERVICE_REMOVED)) | (exceptions == SERVICE_ADDED)
+        return active & known
+
+    # Boolean matrix (service, weekday): True if the service runs on at least one date with that weekday.
+    # A weekday of calendar counts only if it falls inside start_date/end_date at least once and
+    # not all of those dates are removed in calendar_dates, added dates switch their weekday on
+    def active_weekdays(self, service_ids):
+        positions = self.positions(service_ids)
+        known = positions >= 0
+        count = len(self.service_ids)
+
+        occurrences = self.weekday_occurrences()
+        removed = np.zeros((count, 7), dtype=np.int64)
+        added = np.zeros((count, 7), dtype=bool)
+        if self.exception_keys.size:
+            exception_positions = self.exception_keys >> 32
+            exception_days = self.exception_keys - (exception_positions << 32)
+            weekdays = weekday_of(exception_days)
+            in_range = (self.start_day[exception_positions] <= exception_days) & (exception_days <= self.end_day[exception_positions])
+            is_removed = (self.exception_types == SERVICE_REMOVED) & in_range
+            np.add.at(removed, (exception_positions[is_removed], weekdays[is_removed]), 1)
+            is_added = self.exception_types == SERVICE_ADDED
+            added[exception_positions[is_added], weekdays[is_added]] = True
+
+        flags = ((self.weekday_mask[:, None] >> np.arange(7)) & 1) == 1
+        weekly = flags & (occurrences > removed)
+        matrix = weekly | added
+
+        result = np.zeros((len(positions), 7), dtype=bool)
+        result[known] = matrix[positions[known]]
+        return result
+
+    # How many times each weekday falls between start_date and end_date of every service
+    def weekday_occurrences(self):
+        has_range = (self.start_day != NO_DATE) & (self.end_day != NO_DATE) & (self.end_day >= self.start_day)
+        start = np.where(has_range, self.start_day, 0)
+        length = np.where(has_range, self.end_day - self.start_day + 1, 0)
+        full_weeks, rest = np.divmod(length, 7)
+        # weekday d gets an extra day if it's among the first `rest` days after start
+        offset = (np.arange(7)[None, :] - weekday_of(start)[:, None]) % 7
+        return full_weeks[:, None] + (offset < rest[:, None])
+
+    # Same as active_weekdays but as a dataframe indexed by service_id with a column per day
+    def weekday_frame(self, service_ids=None):
+        service_ids = self.service_ids if service_ids is None else np.asarray(service_ids, dtype=object)
+        return pd.DataFrame(self.active_weekdays(service_ids), index=pd.Index(service_ids, name='service_id'), columns=DAYS)
+
+
+# One ServiceCalendar per database file, rebuilt only when the file changes
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def database_key(engine):
+    path = engine.url.database
+    mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+    return str(engine.url), mtime
+
+
+# Every per-database cache (a dict keyed by database_key and its lock), so what was kept for a database
+# can be dropped when the server closes it
+_database_caches = [(_cache, _cache_lock)]
+
+
+def register_database_cache(cache, lock):
+    _database_caches.append((cache, lock))
+
+
+def forget_database(engine):
+    url = str(engine.url)
+    for cache, lock in _database_caches:
+        with lock:
+            for key in [key for key in cache if key[0] == url]:
+                del cache[key]
+
+
+def get_service_calendar(engine):
+    key = database_key(engine)
+    with _cache_lock:
+        calendar = _cache.get(key)
+    if calendar is None:
+        calendar = ServiceCalendar.from_engine(engine)
+        with _cache_lock:
+            # Old versions of the same file are not needed anymore
+            for old_key in [old_key for old_key in _cache if old_key[0] == key[0]]:
+                del _cache[old_key]
+            _cache[key] = calendar
+        logger.info(f"Service calendar loaded for {key[0]}: {len(calendar.service_ids)} services")
+    return calendar
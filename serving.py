@@ -0,0 +1,449 @@
+import argparse
+import contextlib
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from flask import request, has_request_context, jsonify
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from service_calendar import forget_database
+
+logger = logging.getLogger(__name__)
+
+# The WSGI servers are optional: gunicorn runs several worker processes (not on Windows), waitress a pool of
+# threads in one process. Without either we fall back to the threaded werkzeug server
+try:
+    import gunicorn.app.base
+    HAS_GUNICORN = True
+except ImportError:
+    HAS_GUNICORN = False
+
+try:
+    import waitress
+    HAS_WAITRESS = True
+except ImportError:
+    HAS_WAITRESS = False
+
+DEFAULT_THREADS = 8
+MMAP_SIZE = int(os.getenv('GTFS_MMAP_SIZE', 256 * 1024 * 1024))
+ENVIRON_KEY = 'gtfs.database'
+SWITCH_KEY = 'gtfs.switch'
+ON_CLOSE_KEY = 'gtfs.database_on_close'
+# Feeds kept open at the same time, the least recently used idle one is closed past this
+MAX_OPEN_FEEDS = 16
+DEFAULT_FEED = 'default'
+FEED_FILE_EXTENSION = '.db'
+# Feed ids are file names, never paths
+VALID_FEED_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+# Page cache of every connection in KiB (negative is KiB for SQLite), mmap already shares the file between them
+CACHE_SIZE_KB = 16384
+
+
+def sqlite_path(url):
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        return None
+    return os.path.abspath(url.database)
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Pool of read-only connections to a converted database. immutable=1 tells SQLite the file can't change, so it
+# skips locking and change detection on every query; the engine URL stays the plain sqlite:///path the caches
+# (database_key, database_fingerprint) take the file from, the URI only goes to sqlite3.connect.
+# Every connection maps the file (mmap_size), so the pages are shared by all the threads and workers through the OS
+def read_only_engine(db_path, pool_size=DEFAULT_THREADS, immutable=True, mmap_size=MMAP_SIZE):
+    uri = f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro{'&immutable=1' if immutable else ''}"
+
+    def connect():
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    engine = create_engine(f'sqlite:///{db_path}', creator=connect, poolclass=QueuePool,
+                           pool_size=pool_size, max_overflow=pool_size)
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+    return engine
+
+
+# One database being served: its engine, the file state it was opened with, the requests still using it and the
+# parquet export of that same database if there is one
+class ServedDatabase:
+    def __init__(self, url, read_only=False, pool_size=DEFAULT_THREADS, immutable=True, parquet_dir=None):
+        self.url = url
+        self.parquet_dir = parquet_dir
+        self.path = sqlite_path(url)
+        self.stat = file_stat(self.path) if self.path else None
+        if self.path and read_only:
+            if self.stat is None:
+                raise FileNotFoundError(f"Database {self.path} not found")
+            self.engine = read_only_engine(self.path, pool_size, immutable)
+        else:
+            self.engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size) \
+                if self.path else create_engine(url)
+        self.requests = 0
+        self.retired = False
+
+    # Fails here, before the swap, if the file isn't a database we can read
+    def check(self):
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("SELECT count(*) FROM sqlite_master" if self.path else "SELECT 1").scalar()
+
+    def changed(self):
+        return self.path is not None and file_stat(self.path) != self.stat
+
+
+# The database the server answers from. A request takes the current one in acquire() and keeps it until release(),
+# so a swap never changes the database under a running request: new requests go to the new one and the old engine
+# is disposed when its last request ends.
+# With immutable read-only connections a file changed in place (an incremental update) is reopened the same way.
+# With several worker processes the path of the current database is also written to state_file, every worker
+# checks it at the start of a request and follows the swap.
+# parquet_dir is the export of the database at url only, a database swapped in later doesn't get it
+class DatabaseSwitch:
+    def __init__(self, url, read_only=False, pool_size=DEFAULT_THREADS, immutable=True, state_file=None, parquet_dir=None):
+        self.read_only = read_only
+        self.pool_size = pool_size
+        self.immutable = immutable
+        self.state_file = state_file
+        self.parquet_dirs = {url: parquet_dir} if parquet_dir else {}
+        self.lock = threading.Lock()
+        # Requests between finding this switch in a FeedRegistry and acquiring its database, it can't be closed then
+        self.pins = 0
+        # Held while a change found by refresh() is followed, the other requests don't open the file again
+        self.refresh_lock = threading.Lock()
+        self.state = None
+        if state_file:
+            url = self.read_state() or url
+            self.state = file_stat(state_file)
+        self.current = self.open(url)
+
+    def open(self, url):
+        database = ServedDatabase(url, self.read_only, self.pool_size, self.immutable, self.parquet_dirs.get(url))
+        database.check()
+        return database
+
+    def read_state(self):
+        try:
+            with open(self.state_file) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def write_state(self, url):
+        # Written next to it and renamed, a worker never reads half a path
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            f.write(url)
+        os.replace(f.name, self.state_file)
+
+    # Replaces the current database, url is opened and checked first so a bad file leaves the old one in place
+    def swap(self, url, publish=True):
+        database = self.open(url)
+        with self.lock:
+            old, self.current = self.current, database
+            old.retired = True
+            idle = old.requests == 0
+        if idle:
+            old.engine.dispose()
+        if publish and self.state_file:
+            self.write_state(url)
+            self.state = file_stat(self.state_file)
+        logger.info(f"Now serving {url}")
+
+    # Two stats per request, the state file and the database; the rest only runs when one of them changed
+    def refresh(self):
+        state_changed = self.state_file is not None and file_stat(self.state_file) != self.state
+        file_changed = self.read_only and self.immutable and self.current.changed()
+        if not (state_changed or file_changed):
+            return
+        with self.refresh_lock:
+            if self.state_file and file_stat(self.state_file) != self.state:
+                self.state = file_stat(self.state_file)
+                url = self.read_state()
+                if url and url != self.current.url:
+                    self.swap(url, publish=False)
+                    return
+            if self.read_only and self.immutable and self.current.changed():
+                logger.info(f"{self.current.path} changed on disk, reopening it")
+                self.swap(self.current.url, publish=False)
+
+    def acquire(self):
+        self.refresh()
+        with self.lock:
+            database = self.current
+            database.requests += 1
+        return database
+
+    def release(self, database):
+        with self.lock:
+            database.requests -= 1
+            idle = database.retired and database.requests == 0
+        if idle:
+            database.engine.dispose()
+
+    def dispose(self):
+        self.current.engine.dispose()
+
+
+class UnknownFeed(LookupError):
+    pass
+
+
+# Many converted databases served by one server, every request names its feed (?feed=<id>, default feed without).
+# The feeds are:
+#  - 'default': the database of DATABASE_URL, the one /reload replaces
+#  - the ids given explicitly, {'id': 'path/to/feed.db'}
+#  - every <id>.db file of feeds_dir, looked up at the first request so new files are served without a restart
+# A feed is opened (as a DatabaseSwitch, so everything in it applies per feed) the first time it's asked for.
+# Past max_open feeds the least recently used one no request is using is closed, with what the per-database
+# caches kept for it. parquet_dir is the parquet export of the default database, the other feeds have none
+class FeedRegistry:
+    def __init__(self, default_url, feeds=None, feeds_dir=None, max_open=MAX_OPEN_FEEDS, state_file=None, parquet_dir=None,
+                 **options):
+        self.paths = dict(feeds or {})
+        self.feeds_dir = feeds_dir
+        self.max_open = max(max_open, 1)
+        self.options = options
+        self.lock = threading.Lock()
+        self.open_feeds = OrderedDict()
+        # The default feed is opened right away and never closed
+        self.default = DatabaseSwitch(default_url, state_file=state_file, parquet_dir=parquet_dir, **options)
+
+    def feed_ids(self):
+        ids = set(self.paths)
+        if self.feeds_dir and os.path.isdir(self.feeds_dir):
+            ids.update(name[:-len(FEED_FILE_EXTENSION)] for name in os.listdir(self.feeds_dir)
+                       if name.endswith(FEED_FILE_EXTENSION) and VALID_FEED_ID.match(name[:-len(FEED_FILE_EXTENSION)]))
+        return [DEFAULT_FEED] + sorted(ids - {DEFAULT_FEED})
+
+    def feed_path(self, feed_id):
+        if feed_id in self.paths:
+            return self.paths[feed_id]
+        if self.feeds_dir and VALID_FEED_ID.match(feed_id):
+            path = os.path.join(self.feeds_dir, feed_id + FEED_FILE_EXTENSION)
+            if os.path.exists(path):
+                return path
+        raise UnknownFeed(feed_id)
+
+    def is_open(self, feed_id):
+        return feed_id == DEFAULT_FEED or feed_id in self.open_feeds
+
+    # Must be called with the lock held, None if the feed isn't open
+    def lookup(self, feed_id):
+        if not feed_id or feed_id == DEFAULT_FEED:
+            return self.default
+        switch = self.open_feeds.get(feed_id)
+        if switch is not None:
+            self.open_feeds.move_to_end(feed_id)
+        return switch
+
+    # The switch of feed_id, pinned (the caller unpins it) so it isn't closed before the request acquired it.
+    # A feed is opened and checked outside of the lock, a slow file doesn't hold the requests to the other feeds;
+    # if another request opened it meanwhile that one is kept
+    def pin(self, feed_id):
+        with self.lock:
+            switch = self.lookup(feed_id)
+            if switch is not None:
+                switch.pins += 1
+                return switch
+        opened = DatabaseSwitch(f'sqlite:///{os.path.abspath(self.feed_path(feed_id))}', **self.options)
+        with self.lock:
+            switch = self.lookup(feed_id)
+            if switch is None:
+                switch = self.open_feeds[feed_id] = opened
+                logger.info(f"Feed {feed_id} opened ({len(self.open_feeds)} open)")
+            switch.pins += 1
+            self.evict()
+        if switch is not opened:
+            opened.dispose()
+        return switch
+
+    # Must be called with the lock held
+    def evict(self):
+        for feed_id, switch in list(self.open_feeds.items()):
+            if len(self.open_feeds) <= self.max_open:
+                break
+            if switch.pins == 0 and switch.current.requests == 0:
+                del self.open_feeds[feed_id]
+                forget_database(switch.current.engine)
+                switch.dispose()
+                logger.info(f"Feed {feed_id} closed")
+
+    # (switch, database) for a request to feed_id. Only the lookup holds the registry lock, the switch acquires
+    # (and maybe reopens) its database outside of it while pinned
+    def acquire(self, feed_id=None):
+        switch = self.pin(feed_id)
+        try:
+            return switch, switch.acquire()
+        finally:
+            with self.lock:
+                switch.pins -= 1
+
+    # Engine of a feed outside of a request (cross-feed queries), given back when the block ends
+    @contextlib.contextmanager
+    def using(self, feed_id):
+        switch, database = self.acquire(feed_id)
+        try:
+            yield database.engine
+        finally:
+            switch.release(database)
+
+    def dispose(self):
+        with self.lock:
+            for switch in self.open_feeds.values():
+                switch.dispose()
+            self.open_feeds.clear()
+        self.default.dispose()
+
+
+# Session bound to whatever database the running request acquired
+class SwitchSession(Session):
+    def __init__(self, feeds, **kwargs):
+        super().__init__(**kwargs)
+        self.feeds = feeds
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        database = request.environ.get(ENVIRON_KEY) if has_request_context() else None
+        return database.engine if database is not None else self.feeds.default.current.engine
+
+
+def switch_session(feeds):
+    return scoped_session(sessionmaker(class_=SwitchSession, feeds=feeds))
+
+
+# The feed a request asks for: ?feed=<id>, or "feed" in the JSON body of a POST
+def request_feed():
+    feed_id = request.args.get('feed')
+    if feed_id is None and request.is_json:
+        body = request.get_json(silent=True)
+        feed_id = body.get('feed') if isinstance(body, dict) else None
+    return feed_id or DEFAULT_FEED
+
+
+# Parquet export of the database the running request acquired, None if it has none
+def request_parquet_dir():
+    database = request.environ.get(ENVIRON_KEY) if has_request_context() else None
+    return database.parquet_dir if database is not None else None
+
+
+# Registers the feeds on a Flask app: every request acquires the database of its feed in before_request and gives
+# it back when the response is closed, after the last line of a streamed response. Teardown runs before that (Flask
+# calls it when the view returns and again at the end of the stream), it only releases requests that never got a
+# response. The database is kept in the WSGI environ, it belongs to the request whatever app context it runs in
+def init_app(app, db, feeds):
+    db.session = switch_session(feeds)
+
+    @app.before_request
+    def acquire_database():
+        feed_id = request_feed()
+        try:
+            request.environ[SWITCH_KEY], request.environ[ENVIRON_KEY] = feeds.acquire(feed_id)
+        except UnknownFeed:
+            return jsonify({'error': f'Unknown feed {feed_id}'}), 404
+
+    @app.after_request
+    def release_on_close(response):
+        switch, database = request.environ.get(SWITCH_KEY), request.environ.get(ENVIRON_KEY)
+        if database is not None and not request.environ.get(ON_CLOSE_KEY):
+            request.environ[ON_CLOSE_KEY] = True
+            response.call_on_close(lambda: switch.release(database))
+        return response
+
+    @app.teardown_request
+    def release_database(exc):
+        # The connection goes back to the pool of the engine it came from before that engine can be disposed
+        db.session.remove()
+        if not request.environ.get(ON_CLOSE_KEY) and request.environ.get(ENVIRON_KEY) is not None:
+            request.environ[SWITCH_KEY].release(request.environ.pop(ENVIRON_KEY))
+
+
+def run_gunicorn(host, port, workers, threads):
+    class Application(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            # Running requests get this long to finish when the server stops
+            self.cfg.set('graceful_timeout', 30)
+
+        def load(self):
+            from server import app
+            return app
+
+    Application().run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m serving', description="Serve a converted GTFS database in production mode")
+    parser.add_argument('db_path', help="sqlite database created by the conversion")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes, needs gunicorn (default: one per core)")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help="threads per worker (default: %(default)s)")
+    parser.add_argument('--mutable', action='store_true',
+                        help="don't open the database as immutable, for files written while they are served")
+    parser.add_argument('--feeds-dir', help="folder of other converted databases, served as ?feed=<file name without .db>")
+    parser.add_argument('--max-open-feeds', type=int, default=MAX_OPEN_FEEDS,
+                        help="feeds kept open per worker (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not os.path.exists(args.db_path):
+        logger.error(f"Database {args.db_path} not found")
+        return 1
+
+    # server.py reads these at import, in every worker
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db_path)}'
+    os.environ['GTFS_READ_ONLY'] = '1'
+    os.environ['GTFS_IMMUTABLE'] = '0' if args.mutable else '1'
+    os.environ['GTFS_POOL_SIZE'] = str(args.threads)
+    os.environ['GTFS_MAX_OPEN_FEEDS'] = str(args.max_open_feeds)
+    if args.feeds_dir:
+        os.environ['GTFS_FEEDS_DIR'] = os.path.abspath(args.feeds_dir)
+    os.environ['GTFS_SERVER_STATE'] = os.path.join(tempfile.gettempdir(), f'gtfs_server_{args.port}.state')
+    if os.path.exists(os.environ['GTFS_SERVER_STATE']):
+        os.remove(os.environ['GTFS_SERVER_STATE'])
+
+    workers = max(args.workers, 1)
+    if workers > 1 and HAS_GUNICORN and sys.platform != 'win32':
+        logger.info(f"Serving {args.db_path} with gunicorn, {workers} workers x {args.threads} threads")
+        run_gunicorn(args.host, args.port, workers, args.threads)
+        return 0
+
+    from server import app
+    if HAS_WAITRESS:
+        logger.info(f"Serving {args.db_path} with waitress, {args.threads} threads")
+        waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        logger.warning("Neither gunicorn nor waitress is installed, using the threaded development server")
+        app.run(host=args.host, port=args.port, threaded=True, debug=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import logging
+import threading
+import time
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from service_calendar import database_key, register_database_cache
+
+logger = logging.getLogger(__name__)
+
+# Tables the index is built from, an incremental update touching them has to rebuild it
+SPATIAL_SOURCES = {'stops'}
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+# One box per stop (a point, min = max) with the stop_id as auxiliary column, so a lookup never depends on rowids.
+# R*Tree keeps 32 bit floats, boxes come back a few centimeters larger: results are filtered again on the real values
+CREATE_STOPS_RTREE = """
+    CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon, +stop_id)
+"""
+
+STOPS_IN_BOX = """
+    SELECT stops.stop_id, stops.stop_name, stops.stop_lat, stops.stop_lon
+    FROM stops_rtree JOIN stops ON stops.stop_id = stops_rtree.stop_id
+    WHERE stops_rtree.max_lat >= :min_lat AND stops_rtree.min_lat <= :max_lat
+      AND stops_rtree.max_lon >= :min_lon AND stops_rtree.min_lon <= :max_lon
+"""
+
+
+# (Re)builds the R*Tree of the stops, False if this sqlite has no R*Tree (the server then uses StopGrid)
+def build_stop_index(engine):
+    if engine.dialect.name != 'sqlite' or not inspect(engine).has_table('stops'):
+        return False
+    start = time.perf_counter()
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS stops_rtree")
+        try:
+            conn.exec_driver_sql(CREATE_STOPS_RTREE)
+        except OperationalError as e:
+            logger.warning(f"No spatial index, this SQLite has no R*Tree: {e}")
+            return False
+        # CAST for databases converted when the coordinates were still text
+        conn.exec_driver_sql("""
+            INSERT INTO stops_rtree (min_lat, max_lat, min_lon, max_lon, stop_id)
+            SELECT CAST(stop_lat AS REAL), CAST(stop_lat AS REAL), CAST(stop_lon AS REAL), CAST(stop_lon AS REAL), stop_id
+            FROM stops WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL AND stop_lat != '' AND stop_lon != ''
+        """)
+        rows = conn.exec_driver_sql("SELECT count(*) FROM stops_rtree").scalar()
+
+    logger.info(f"Spatial index built for {rows} stops in {time.perf_counter() - start:.2f}s")
+    return True
+
+
+# For databases converted before the index existed
+def ensure_stop_index(engine):
+    if inspect(engine).has_table('stops_rtree'):
+        return False
+    return build_stop_index(engine)
+
+
+# Box around a point, radius in meters
+def radius_box(lat, lon, radius):
+    lat_delta = radius / METERS_PER_DEGREE
+    lon_delta = radius / (METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6))
+    return lat - lat_delta, lon - lon_delta, lat + lat_delta, lon + lon_delta
+
+
+# Great circle distance in meters from one point to arrays of points
+def haversine(lat, lon, lats, lons):
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def frame_in_box(stops, min_lat, min_lon, max_lat, max_lon):
+    lats, lons = stops['stop_lat'].to_numpy(dtype=float), stops['stop_lon'].to_numpy(dtype=float)
+    inside = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+    return stops[inside]
+
+
+# In-memory alternative for databases without stops_rtree: the stops sorted by latitude, a box is a binary search
+# on the latitude and a vectorized filter on the longitude of that band
+class StopGrid:
+    def __init__(self, stops):
+        stops = stops[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']].copy()
+        stops['stop_lat'] = pd.to_numeric(stops['stop_lat'], errors='coerce')
+        stops['stop_lon'] = pd.to_numeric(stops['stop_lon'], errors='coerce')
+        self.stops = stops.dropna(subset=['stop_lat', 'stop_lon']).sort_values('stop_lat', ignore_index=True)
+        self.lats = self.stops['stop_lat'].to_numpy()
+
+    @classmethod
+    def from_engine(cls, engine):
+        return cls(pd.read_sql('SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops', engine))
+
+    def in_box(self, min_lat, min_lon, max_lat, max_lon):
+        start = np.searchsorted(self.lats, min_lat, side='left')
+        end = np.searchsorted(self.lats, max_lat, side='right')
+        return frame_in_box(self.stops.iloc[start:end], min_lat, min_lon, max_lat, max_lon)
+
+
+_grids = {}
+_grids_lock = threading.Lock()
+register_database_cache(_grids, _grids_lock)
+
+
+def get_stop_grid(engine):
+    key = database_key(engine)
+    with _grids_lock:
+        grid = _grids.get(key)
+    if grid is None:
+        grid = StopGrid.from_engine(engine)
+        with _grids_lock:
+            for old_key in [old_key for old_key in _grids if old_key[0] == key[0]]:
+                del _grids[old_key]
+            _grids[key] = grid
+    return grid
+
+
+# Stops inside a box as a dataframe (stop_id, stop_name, stop_lat, stop_lon), through the R*Tree when the
+# database has one, otherwise through the in-memory StopGrid
+def stops_in_box(session, min_lat, min_lon, max_lat, max_lon):
+    engine = session.get_bind()
+    if inspect(engine).has_table('stops_rtree'):
+        rows = session.execute(text(STOPS_IN_BOX), {'min_lat': min_lat, 'min_lon': min_lon, 'max_lat': max_lat, 'max_lon': max_lon}).all()
+        stops = pd.DataFrame(rows, columns=['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+        stops['stop_lat'] = pd.to_numeric(stops['stop_lat'], errors='coerce')
+        stops['stop_lon'] = pd.to_numeric(stops['stop_lon'], errors='coerce')
+        return frame_in_box(stops, min_lat, min_lon, max_lat, max_lon)
+    return get_stop_grid(engine).in_box(min_lat, min_lon, max_lat, max_lon)
+
+
+# Stops within radius meters of a point, nearest first, with their distance
+def stops_near(session, lat, lon, radius):
+    stops = stops_in_box(session, *radius_box(lat, lon, radius)).copy()
+    stops['distance'] = haversine(lat, lon, stops['stop_lat'], stops['stop_lon'])
+    return stops[stops['distance'] <= radius].sort_values('distance', kind='stable')
@@ -2,6 +2,10 @@
     let map;
     let markers = [];
     let polylines = [];
+    let viewportMarkers = {};
+    let viewportRequest = null;
+    // The server can serve several feeds, the page works on the one in its own URL (/?feed=<id>)
+    const feed = new URLSearchParams(window.location.search).get('feed');
     let tripsByDayChart = null;
     let avgRouteTimeChart = null;
 
@@ -18,6 +22,7 @@ function initMap() {
             });
             console.log('map initialized');
 			map.resize;
+            map.addListener('idle', loadViewportStops);
         }
     }
 
@@ -42,6 +47,78 @@ function openTab(tabName) {
 
 
 
+// Adds the feed of the page to an endpoint URL
+function withFeed(url) {
+    if (!feed) {
+        return url;
+    }
+    return `${url}${url.includes('?') ? '&' : '?'}feed=${encodeURIComponent(feed)}`;
+}
+
+// Below this zoom the viewport covers too many stops, they are only shown when zoomed in
+const VIEWPORT_MIN_ZOOM = 14;
+
+// Every time the map stops moving, fetch the stops of the visible area only (/stops_in_bbox) and keep
+// a small grey marker per stop, markers that left the view are removed. A request still running when
+// the map moves again is aborted
+function loadViewportStops() {
+    if (viewportRequest) {
+        viewportRequest.abort();
+        viewportRequest = null;
+    }
+    const bounds = map.getBounds();
+    if (!bounds || map.getZoom() < VIEWPORT_MIN_ZOOM) {
+        clearViewportMarkers();
+        return;
+    }
+    const sw = bounds.getSouthWest();
+    const ne = bounds.getNorthEast();
+    const params = new URLSearchParams({
+        min_lat: sw.lat().toFixed(5), min_lon: sw.lng().toFixed(5),
+        max_lat: ne.lat().toFixed(5), max_lon: ne.lng().toFixed(5),
+    });
+    viewportRequest = new AbortController();
+    fetch(withFeed(`/stops_in_bbox?${params}`), { signal: viewportRequest.signal })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`Server error: ${response.status}`);
+        }
+        return response.json();
+    })
+    .then(data => {
+        const visible = {};
+        data.stops.forEach(stop => {
+            visible[stop.stop_id] = viewportMarkers[stop.stop_id] || new google.maps.Marker({
+                position: { lat: stop.lat, lng: stop.lng },
+                map,
+                title: stop.stop_name,
+                icon: { path: google.maps.SymbolPath.CIRCLE, scale: 4, fillColor: '#666666', fillOpacity: 0.8, strokeWeight: 1 },
+            });
+        });
+        for (const [stopId, marker] of Object.entries(viewportMarkers)) {
+            if (!(stopId in visible)) {
+                marker.setMap(null);
+            }
+        }
+        viewportMarkers = visible;
+        if (data.truncated) {
+            console.log('Not every stop of the view is shown, zoom in to see them all');
+        }
+    })
+    .catch(error => {
+        if (error.name !== 'AbortError') {
+            console.error('Error fetching the stops of the view:', error);
+        }
+    });
+}
+
+function clearViewportMarkers() {
+    for (const marker of Object.values(viewportMarkers)) {
+        marker.setMap(null);
+    }
+    viewportMarkers = {};
+}
+
 function clearMarkers() {
     for (let marker of markers) {
         marker.setMap(null);
@@ -98,7 +175,7 @@ function drawLines(stops) {
 
 document.getElementById('statistics-search-btn').addEventListener('click', function() {
     const query = document.getElementById('statistics-search').value;
-    fetch('/search', {
+    fetch(withFeed('/search'), {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -116,7 +193,7 @@ document.getElementById('statistics-search-btn').addEventListener('click', funct
             listItem.textContent = `${route.route_short_name}`;
             listItem.addEventListener('click', function() {
 				document.getElementById('route-title').textContent = 'Route statistics for Route ' + route.route_short_name ;
-                fetch(`/route_info?route_id=${route.route_id}`)
+                fetch(withFeed(`/route_info?route_id=${route.route_id}`))
                     .then(response => response.json())
                     .then(routeInfo => {
                         const { days, tripsByDay, avgRouteTime } = routeInfo;
@@ -206,7 +283,7 @@ document.getElementById('statistics-search-btn').addEventListener('click', funct
 
 document.getElementById("search-button").addEventListener("click", () => {
     const query = document.getElementById("search-input").value;
-    fetch("/search", {
+    fetch(withFeed("/search"), {
         method: "POST",
         headers: {
             "Content-Type": "application/json",
@@ -242,27 +319,27 @@ document.getElementById("search-button").addEventListener("click", () => {
             listItem.addEventListener("click", () => {
                 clearMarkers();
                 clearPolylines();
-                fetch(`/stops?route_id=${route.route_id}`)
+                fetch(withFeed(`/route_shape?route_id=${encodeURIComponent(route.route_id)}`))
                 .then(response => {
                     if (!response.ok) {
                         throw new Error(`Server error: ${response.status}`);
                     }
                     return response.json();
                 })
-                .then(stops => {
-                    if (!Array.isArray(stops)) {
-                        console.error('Expected an array of stops but got:', stops);
+                .then(shape => {
+                    if (!Array.isArray(shape.lat)) {
+                        console.error('Expected the route shape arrays but got:', shape);
                         return;
                     }
-                    console.log('Retrieved stops:', stops);
+                    console.log('Retrieved route shape:', shape);
                     let path = [];
-                    stops.forEach(stop => {
-                        const position = { lat: Number(stop.lat), lng: Number(stop.lng) };
-                        if (Number.isFinite(position.lat) && Number.isFinite(position.lng)) {
-                            addMarker(position, stop.stop_name);
+                    shape.lat.forEach((lat, i) => {
+                        const position = { lat: Number(lat), lng: Number(shape.lon[i]) };
+                        if (lat !== null && Number.isFinite(position.lat) && Number.isFinite(position.lng)) {
+                            addMarker(position, shape.stop_names[i]);
                             path.push(position);
                         } else {
-                            console.error('Invalid stop position:', position);
+                            console.error('Invalid stop position:', shape.stop_ids[i]);
                         }
                     });
                     drawLines(path);
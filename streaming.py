@@ -0,0 +1,64 @@
+import base64
+import json
+import ujson
+from flask import Response, stream_with_context
+
+# Rows fetched from the cursor at a time while streaming, the memory of a streamed response doesn't depend on the
+# size of the result
+BATCH_SIZE = 1000
+# Largest page of the paginated endpoints
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# Cursors are opaque to the clients: the sort key of the last row sent, as url-safe base64 of JSON.
+# json and not ujson here, the floats (FTS scores) have to come back exactly as they were
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f'Invalid cursor {cursor!r}') from e
+
+
+# Rows of statement read BATCH_SIZE at a time from the database cursor. It opens its own connection, the session of
+# the request is closed when the view returns while the response is still being sent
+def stream_rows(engine, statement, params=None):
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=BATCH_SIZE).execute(statement, params or {})
+        for row in result:
+            yield row
+
+
+# Records joined in chunks of BATCH_SIZE, one write per chunk instead of one per row
+def chunks(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == BATCH_SIZE:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def ndjson_response(records):
+    lines = (ujson.dumps(record) + '\n' for record in records)
+    return Response(stream_with_context(chunks(lines)), mimetype='application/x-ndjson')
+
+
+# A JSON list written as it goes, the same document jsonify would give for list(records)
+def json_list_response(records):
+    def generate():
+        yield '['
+        for position, record in enumerate(records):
+            yield (',' if position else '') + ujson.dumps(record)
+        yield ']'
+
+    return Response(stream_with_context(chunks(generate())), mimetype='application/json')
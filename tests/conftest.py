@@ -0,0 +1,59 @@
+import io
+import os
+import sqlite3
+import sys
+import zipfile
+import pytest
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_feed import build_feed
+
+
+def write_zip(zip_path, feed):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_name, df in feed.items():
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False)
+            zip_file.writestr(file_name, buffer.getvalue())
+    return zip_path
+
+
+# Every row of a table, in a stable order, to compare two databases
+def table_rows(db_path, table_name):
+    with sqlite3.connect(db_path) as conn:
+        return sorted(map(repr, conn.execute(f'SELECT * FROM "{table_name}"').fetchall()))
+
+
+@pytest.fixture
+def feed():
+    return build_feed(routes=4, trips=6, stops=8)
+
+
+# server.py configured from the environment at import: a converted synthetic feed as the main database, a
+# second one as feed "other" and the main one without its search and spatial indexes as feed "plain" (the LIKE
+# and grid fallbacks), imported once for the whole session
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    from gtfs_processor import process_gtfs_file
+    directory = tmp_path_factory.mktemp('server')
+    paths = {}
+    for name, routes in (('main', 8), ('other', 3)):
+        paths[name] = str(directory / f'{name}.db')
+        assert process_gtfs_file(write_zip(directory / f'{name}.zip', build_feed(routes=routes, trips=6, stops=8)), paths[name])
+    paths['plain'] = str(directory / 'plain.db')
+    with sqlite3.connect(paths['main']) as source, sqlite3.connect(paths['plain']) as target:
+        source.backup(target)
+        target.execute("DROP TABLE search_index")
+        target.execute("DROP TABLE stops_rtree")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('DATABASE_URL', f"sqlite:///{paths['main']}")
+        patch.setenv('GTFS_FEEDS', f"other={paths['other']},plain={paths['plain']}")
+        import server
+    return server
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
@@ -0,0 +1,80 @@
+import sqlite3
+import pandas as pd
+import pytest
+import checkpoint
+from conftest import write_zip, table_rows
+from gtfs_processor import process_gtfs_file
+
+CHUNK_SIZE = 50
+TABLES = ['stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates', 'route_stats', 'route_shapes']
+
+
+def ledger_rows(db_path, step):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f"SELECT rows FROM {checkpoint.LEDGER_TABLE} WHERE step = ?", (step,)).fetchone()[0]
+
+
+# A row repeating the primary key of an earlier one, in the fourth chunk of stop_times
+@pytest.mark.parametrize('streaming', [False, True])
+def test_failed_chunk_is_not_committed(tmp_path, feed, streaming):
+    stop_times = feed['stop_times.txt']
+    feed['stop_times.txt'] = pd.concat([stop_times.iloc[:170], stop_times.iloc[:1], stop_times.iloc[170:]], ignore_index=True)
+    db_path = str(tmp_path / 'feed.db')
+    assert not process_gtfs_file(write_zip(tmp_path / 'feed.zip', feed), db_path, streaming=streaming, chunk_size=CHUNK_SIZE)
+
+    with sqlite3.connect(db_path) as conn:
+        committed = conn.execute("SELECT count(*) FROM stop_times").fetchone()[0]
+    assert committed == ledger_rows(db_path, 'stop_times') == 150
+
+
+# checkpoint.insert_chunk recording the chunks of one table it inserts, failing after fail_after of them
+def counting_insert(monkeypatch, inserted, fail_after=None, table='stop_times'):
+    insert_chunk = checkpoint.insert_chunk
+
+    def insert(conn, table_name, chunk, *args, **kwargs):
+        if table_name == table:
+            if len(inserted) == fail_after:
+                raise RuntimeError('disk full')
+            inserted.append(len(chunk))
+        return insert_chunk(conn, table_name, chunk, *args, **kwargs)
+
+    monkeypatch.setattr(checkpoint, 'insert_chunk', insert)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_resume_after_failed_chunk(tmp_path, feed, monkeypatch, streaming):
+    zip_path = write_zip(tmp_path / 'feed.zip', feed)
+    db_path = str(tmp_path / 'feed.db')
+
+    with monkeypatch.context() as patch:
+        counting_insert(patch, [], fail_after=3)
+        assert not process_gtfs_file(zip_path, db_path, streaming=streaming, chunk_size=CHUNK_SIZE)
+    assert ledger_rows(db_path, 'stop_times') == 3 * CHUNK_SIZE
+
+    # The second run only inserts what the first one didn't commit
+    inserted = []
+    with monkeypatch.context() as patch:
+        counting_insert(patch, inserted)
+        assert process_gtfs_file(zip_path, db_path, streaming=streaming, chunk_size=CHUNK_SIZE)
+    assert sum(inserted) == len(feed['stop_times.txt']) - 3 * CHUNK_SIZE
+
+    assert process_gtfs_file(zip_path, str(tmp_path / 'clean.db'), streaming=streaming)
+    for table_name in TABLES:
+        assert table_rows(db_path, table_name) == table_rows(tmp_path / 'clean.db', table_name), table_name
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (checkpoint.LEDGER_TABLE,)).fetchone()[0] == 0
+
+
+# Tables committed by the first run aren't parsed again, the steps after the inserts read them from the database
+@pytest.mark.parametrize('streaming', [False, True])
+def test_resume_with_headways(tmp_path, feed, monkeypatch, streaming):
+    zip_path = write_zip(tmp_path / 'feed.zip', feed)
+    db_path = str(tmp_path / 'feed.db')
+    with monkeypatch.context() as patch:
+        counting_insert(patch, [], fail_after=0, table='calendar_dates')
+        assert not process_gtfs_file(zip_path, db_path, streaming=streaming, headways=True)
+    assert process_gtfs_file(zip_path, db_path, streaming=streaming, headways=True)
+
+    assert process_gtfs_file(zip_path, str(tmp_path / 'clean.db'), streaming=streaming, headways=True)
+    for table_name in TABLES + ['stop_headways']:
+        assert table_rows(db_path, table_name) == table_rows(tmp_path / 'clean.db', table_name), table_name
@@ -0,0 +1,42 @@
+import sqlite3
+import pandas as pd
+import pytest
+from conftest import write_zip, table_rows
+from gtfs_processor import process_gtfs_file
+
+
+def count(db_path, table_name):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f'SELECT count(*) FROM "{table_name}"').fetchone()[0]
+
+
+# First trip of the feed again an hour later, with the same running times
+def add_later_copy(feed, trip_id):
+    stop_times, trips = feed['stop_times.txt'], feed['trips.txt']
+    copy = stop_times[stop_times['trip_id'] == trips['trip_id'].iloc[0]].assign(trip_id=trip_id)
+    for column in ('arrival_time', 'departure_time'):
+        later = pd.to_timedelta(copy[column]) + pd.Timedelta(hours=1)
+        copy[column] = later.dt.components.apply(lambda c: f'{c.hours:02d}:{c.minutes:02d}:{c.seconds:02d}', axis=1)
+    feed['stop_times.txt'] = pd.concat([stop_times, copy], ignore_index=True)
+    feed['trips.txt'] = pd.concat([trips, trips.iloc[:1].assign(trip_id=trip_id)], ignore_index=True)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_compact_view_matches_stop_times(tmp_path, feed, streaming):
+    add_later_copy(feed, 'later')
+    stop_times = feed['stop_times.txt']
+    # An intermediate stop without times, on another trip
+    other = stop_times.index[stop_times['trip_id'] == stop_times['trip_id'].iloc[-20]][1]
+    stop_times.loc[other, ['arrival_time', 'departure_time']] = None
+    zip_path = write_zip(tmp_path / 'feed.zip', feed)
+
+    full_path, compact_path = tmp_path / 'full.db', tmp_path / 'compact.db'
+    assert process_gtfs_file(zip_path, str(full_path), streaming=streaming)
+    assert process_gtfs_file(zip_path, str(compact_path), streaming=streaming, compact=True)
+    assert table_rows(compact_path, 'stop_times') == table_rows(full_path, 'stop_times')
+
+    # Patterns don't depend on the times, the copy reuses the offsets of the first trip
+    sequences = stop_times.sort_values('stop_sequence').groupby('trip_id')['stop_id'].agg(tuple).drop_duplicates()
+    assert count(compact_path, 'patterns') == sum(map(len, sequences))
+    assert count(compact_path, 'pattern_times') == len(feed['trips.txt']) - 1
+    assert count(compact_path, 'pattern_trips') == len(feed['trips.txt'])
@@ -0,0 +1,44 @@
+import sqlite3
+import pytest
+from conftest import write_zip
+from gtfs_processor import process_gtfs_file, read_csv_file
+
+
+def count(db_path, table_name):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(f'SELECT count(*) FROM "{table_name}"').fetchone()[0]
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('tables', [['stops', 'routes'], ['trips', 'routes'], ['stop_times']])
+def test_conversion_of_some_tables(tmp_path, feed, streaming, tables):
+    db_path = tmp_path / 'feed.db'
+    assert process_gtfs_file(write_zip(tmp_path / 'feed.zip', feed), str(db_path), streaming=streaming, tables=tables)
+    for table_name in tables:
+        assert count(db_path, table_name) == len(feed[f'{table_name}.txt'])
+    assert count(db_path, 'route_stats') == 0
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_conversion_with_empty_stop_times(tmp_path, feed, streaming):
+    feed['stop_times.txt'] = feed['stop_times.txt'].iloc[:0]
+    db_path = tmp_path / 'feed.db'
+    assert process_gtfs_file(write_zip(tmp_path / 'feed.zip', feed), str(db_path), streaming=streaming, headways=True)
+    assert count(db_path, 'trips') == len(feed['trips.txt'])
+    assert count(db_path, 'route_shapes') == 0
+
+
+# Ids are read as written ("0012" stays "0012") with both parsers, also when a value doesn't fit its declared type
+# (direction_id): only that column is left as text
+@pytest.mark.parametrize('csv_engine', ['c', 'pyarrow'])
+@pytest.mark.parametrize('direction, directions', [('1', [0, 1, 1]), ('north', ['0', 'north', '1'])])
+def test_ids_keep_leading_zeros(tmp_path, csv_engine, direction, directions):
+    if csv_engine == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    file_path = tmp_path / 'trips.txt'
+    file_path.write_text('route_id,service_id,trip_id,direction_id,shape_id\n'
+                         f'0012,1,0001,0,\n0012,1,0002,{direction},\n0013,2,0003,1,\n')
+    trips = read_csv_file(str(file_path), 'trips.txt', csv_engine)
+    assert trips['trip_id'].astype(str).tolist() == ['0001', '0002', '0003']
+    assert trips['route_id'].astype(str).tolist() == ['0012', '0012', '0013']
+    assert trips['direction_id'].tolist() == directions
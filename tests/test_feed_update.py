@@ -0,0 +1,45 @@
+import pandas as pd
+import feed_update
+from conftest import write_zip, table_rows
+from gtfs_processor import process_gtfs_file
+
+TABLES = ['agency', 'stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates', 'route_stats', 'route_shapes']
+
+
+def test_incremental_update_matches_full_rebuild(tmp_path, feed):
+    db_path = str(tmp_path / 'incremental.db')
+    assert process_gtfs_file(write_zip(tmp_path / 'old.zip', feed), db_path)
+
+    stop_times = feed['stop_times.txt']
+    stop_times.loc[stop_times.index[:20], 'arrival_time'] = '25:10:00'
+    feed['stop_times.txt'] = stop_times.drop(stop_times.index[40:50])
+    feed['stops.txt'].loc[0, 'stop_name'] = 'Renamed stop'
+    feed['calendar_dates.txt'] = feed['calendar_dates.txt'].iloc[1:]
+    new_zip = write_zip(tmp_path / 'new.zip', feed)
+
+    assert process_gtfs_file(new_zip, db_path, incremental=True)
+    assert process_gtfs_file(new_zip, str(tmp_path / 'full.db'))
+    for table_name in TABLES:
+        assert table_rows(db_path, table_name) == table_rows(tmp_path / 'full.db', table_name), table_name
+
+
+# The stop_times rows changed are deleted first, a failing insert must bring them back
+def test_failed_incremental_update_changes_nothing(tmp_path, feed, monkeypatch):
+    db_path = str(tmp_path / 'incremental.db')
+    assert process_gtfs_file(write_zip(tmp_path / 'old.zip', feed), db_path)
+    before = {table_name: table_rows(db_path, table_name) for table_name in TABLES}
+
+    stop_times = feed['stop_times.txt']
+    stop_times.loc[stop_times.index[:20], 'arrival_time'] = '25:10:00'
+    insert_chunk = feed_update.insert_chunk
+
+    # Every row twice, the second copy breaks the primary key inside insert_chunk
+    def insert(conn, table_name, chunk, *args, **kwargs):
+        if table_name == 'stop_times':
+            chunk = pd.concat([chunk, chunk])
+        return insert_chunk(conn, table_name, chunk, *args, **kwargs)
+
+    monkeypatch.setattr(feed_update, 'insert_chunk', insert)
+    assert not process_gtfs_file(write_zip(tmp_path / 'new.zip', feed), db_path, incremental=True)
+    for table_name in TABLES:
+        assert table_rows(db_path, table_name) == before[table_name], table_name
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from gtfs_time import parse_times, times_to_seconds, format_times, add_seconds_columns
+
+
+@pytest.mark.parametrize('value, seconds', [
+    ('00:00:00', 0),
+    ('08:05:09', 8 * 3600 + 5 * 60 + 9),
+    ('5:00:00', 5 * 3600),
+    (' 7:30:00 ', 7 * 3600 + 30 * 60),
+    ('24:00:00', 24 * 3600),
+    ('25:10:00', 25 * 3600 + 10 * 60),
+    ('47:59:59', 47 * 3600 + 59 * 60 + 59),
+    ('100:00:00', 100 * 3600),
+])
+def test_valid_times(value, seconds):
+    parsed, valid = parse_times([value])
+    assert valid.tolist() == [True]
+    assert parsed.tolist() == [seconds]
+
+
+@pytest.mark.parametrize('value', [None, np.nan, '', '25:60:00', '12:00:60', '12:5:00', '12:00', 'ab:cd:ef',
+                                   '1 2:00:00', '1000:00:00', '-1:00:00'])
+def test_invalid_times(value):
+    parsed, valid = parse_times([value])
+    assert valid.tolist() == [False]
+    assert parsed.tolist() == [0]
+
+
+def test_times_to_seconds_keeps_the_index():
+    times = pd.Series(['23:59:00', '24:01:00', None], index=[10, 20, 30])
+    seconds = times_to_seconds(times)
+    assert seconds.index.tolist() == [10, 20, 30]
+    assert seconds.iloc[:2].tolist() == [86340.0, 86460.0]
+    assert np.isnan(seconds.iloc[2])
+
+
+def test_format_times_doesnt_wrap_hours():
+    assert format_times([0, 3661, 25 * 3600 + 10 * 60, 100 * 3600]) == ['00:00:00', '01:01:01', '25:10:00', '100:00:00']
+    values = ['05:00:00', '24:00:00', '26:30:15']
+    assert format_times(parse_times(values)[0]) == values
+
+
+def test_add_seconds_columns():
+    stop_times = pd.DataFrame({'arrival_time': ['25:10:00', None, 'bad'], 'departure_time': ['25:11:00', '5:00:00', None]})
+    add_seconds_columns(stop_times)
+    assert stop_times['arrival_secs'].tolist() == [90600, pd.NA, pd.NA]
+    assert stop_times['departure_secs'].tolist() == [90660, 18000, pd.NA]
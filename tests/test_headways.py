@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from headways import Departures, HEADWAY_COLUMNS
+from service_calendar import ServiceCalendar, DAYS
+
+# January 2024 starts on a monday
+CALENDAR = pd.DataFrame([
+    ['WEEK', 1, 1, 1, 1, 1, 0, 0, '20240101', '20240131'],
+    ['SAT', 0, 0, 0, 0, 0, 1, 0, '20240101', '20240131'],
+], columns=['service_id'] + DAYS + ['start_date', 'end_date'])
+
+CALENDAR_DATES = pd.DataFrame([['WEEK', 20240103, 2]], columns=['service_id', 'date', 'exception_type'])
+
+STOPS = pd.DataFrame({'stop_id': ['S1', 'S2']})
+
+TRIPS = pd.DataFrame([
+    ['A1', 'A', 'WEEK'], ['A2', 'A', 'WEEK'], ['A3', 'A', 'WEEK'], ['A4', 'A', 'WEEK'], ['A5', 'A', 'WEEK'],
+    ['A6', 'A', 'WEEK'], ['B1', 'B', 'WEEK'], ['W1', 'A', 'SAT'],
+], columns=['trip_id', 'route_id', 'service_id'])
+
+STOP_TIMES = pd.DataFrame([
+    ['A1', 'S1', '08:00:00', '08:00:00'],
+    ['A2', 'S1', '08:10:00', '08:10:00'],
+    ['A3', 'S1', '08:40:00', '08:40:00'],
+    # Arrival only, still a departure
+    ['A6', 'S1', '08:50:00', None],
+    ['A4', 'S1', '09:00:00', '09:00:00'],
+    # After midnight, hour 24
+    ['A5', 'S1', '24:30:00', '24:30:00'],
+    ['B1', 'S1', '08:05:00', '08:05:00'],
+    ['W1', 'S1', '08:20:00', '08:20:00'],
+    # No time at all (not a timepoint), an unknown stop and an unknown trip
+    ['A1', 'S2', None, None],
+    ['A2', 'X', '08:15:00', '08:15:00'],
+    ['Z9', 'S1', '08:15:00', '08:15:00'],
+], columns=['trip_id', 'stop_id', 'arrival_time', 'departure_time'])
+
+
+@pytest.fixture
+def calendar():
+    return ServiceCalendar(CALENDAR, CALENDAR_DATES)
+
+
+@pytest.fixture
+def departures():
+    return Departures.from_frames([STOP_TIMES.iloc[:5], STOP_TIMES.iloc[5:]], TRIPS, STOPS)
+
+
+def rows(headways):
+    return [tuple(None if isinstance(value, float) and np.isnan(value) else value for value in row)
+            for row in headways[HEADWAY_COLUMNS].itertuples(index=False)]
+
+
+# Gaps belong to the hour of the departure they start from, the last departure of the day has none
+def test_headways_by_route(departures, calendar):
+    assert rows(departures.headways(calendar, 'monday')) == [
+        ('S1', 'A', 8, 4, 15.0, 10.0, 30.0),
+        ('S1', 'A', 9, 1, 930.0, 930.0, 930.0),
+        ('S1', 'A', 24, 1, None, None, None),
+        ('S1', 'B', 8, 1, None, None, None),
+    ]
+
+
+def test_headways_of_all_routes(departures, calendar):
+    assert rows(departures.headways(calendar, 'monday', by_route=False, stop_id='S1'))[0] == ('S1', '*', 8, 5, 12.0, 5.0, 30.0)
+
+
+@pytest.mark.parametrize('day, expected', [
+    ('saturday', [('S1', 'A', 8, 1, None, None, None)]),
+    ('sunday', []),
+    # Removed by calendar_dates
+    ('20240103', []),
+    ('20240106', [('S1', 'A', 8, 1, None, None, None)]),
+])
+def test_headways_follow_the_calendar(departures, calendar, day, expected):
+    assert rows(departures.headways(calendar, day)) == expected
+
+
+def test_headways_filters(departures, calendar):
+    assert [row[1] for row in rows(departures.headways(calendar, 'monday', route_id='B'))] == ['B']
+    assert rows(departures.headways(calendar, 'monday', stop_id='S2')) == []
+    assert rows(departures.headways(calendar, 'monday', stop_id='missing')) == []
+
+
+# The same departures read back from a database, as the server and the streaming import do
+def test_departures_from_engine(departures, calendar, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'feed.db'}")
+    for table_name, df in (('stops', STOPS), ('trips', TRIPS), ('stop_times', STOP_TIMES)):
+        df.to_sql(table_name, engine, index=False)
+    for day in ('monday', 'saturday'):
+        assert rows(Departures.from_engine(engine).headways(calendar, day)) == rows(departures.headways(calendar, day))
+    engine.dispose()
@@ -0,0 +1,80 @@
+import re
+import time
+from instrumentation import Profile, profiling, profiled, stage, current_profile
+
+
+def metric(client, name, **labels):
+    label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    prefix = f'{name}{{{label_text}}} ' if label_text else f'{name} '
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+
+def server_timing(response):
+    return {name: (float(duration), rest) for name, duration, rest in
+            re.findall(r'(\w+);dur=([\d.]+)((?:;desc="[^"]*")?)', response.headers['Server-Timing'])}
+
+
+def test_profile_server_timing():
+    with profiling() as profile:
+        assert current_profile() is profile
+        with stage('parse'):
+            time.sleep(0.01)
+        with stage('parse'):
+            pass
+    assert current_profile() is None
+    assert profile.stage_calls['parse'] == 2 and profile.stages['parse'] >= 0.01
+    assert re.fullmatch(r'sql;dur=0\.00;desc="0 statements", parse;dur=\d+\.\d\d, total;dur=\d+\.\d\d', profile.server_timing())
+
+
+# Every call gets its own profile, the caller's isn't touched
+def test_profiled_calls():
+    @profiled
+    def convert():
+        with stage('insert'):
+            pass
+        return current_profile()
+
+    with profiling() as outer:
+        inner = convert()
+    assert isinstance(inner, Profile) and inner is not outer
+    assert list(inner.stages) == ['insert'] and not outer.stages
+    assert convert.__wrapped__() is None
+
+
+# The header has the SQL of the request, /metrics counts it once the response is closed
+def test_request_metrics(client):
+    labels = {'endpoint': '/stops_nearby', 'status': '200'}
+    requests, statements = metric(client, 'gtfs_requests_total', **labels), metric(client, 'gtfs_sql_statements_total', endpoint='/stops_nearby')
+    response = client.get('/stops_nearby?lat=45.2&lon=9.2&radius=1234', buffered=True)
+    timing = server_timing(response)
+    response.close()
+
+    assert set(timing) >= {'sql', 'total'} and timing['total'][0] >= timing['sql'][0]
+    sql_count = int(re.search(r'(\d+) statements', timing['sql'][1]).group(1))
+    assert sql_count >= 1
+    assert metric(client, 'gtfs_requests_total', **labels) == requests + 1
+    assert metric(client, 'gtfs_sql_statements_total', endpoint='/stops_nearby') == statements + sql_count
+    assert metric(client, 'gtfs_request_duration_seconds_count', endpoint='/stops_nearby') >= 1
+
+
+def test_errors_are_counted_by_status(client):
+    labels = {'endpoint': '/stops_nearby', 'status': '400'}
+    before = metric(client, 'gtfs_requests_total', **labels)
+    client.get('/stops_nearby?lat=95&lon=9', buffered=True).close()
+    assert metric(client, 'gtfs_requests_total', **labels) == before + 1
+
+
+# A streamed response is counted when its last line is sent, with the statements run while streaming
+def test_streamed_response_metrics(client):
+    labels = {'endpoint': '/search', 'status': '200'}
+    requests, statements = metric(client, 'gtfs_requests_total', **labels), metric(client, 'gtfs_sql_statements_total', endpoint='/search')
+    response = client.post('/search', json={'query': 'Stop', 'format': 'ndjson'})
+    sent = int(re.search(r'(\d+) statements', server_timing(response)['sql'][1]).group(1))
+    assert metric(client, 'gtfs_requests_total', **labels) == requests
+    assert len(response.get_data(as_text=True).splitlines()) >= 64
+    response.close()
+    assert metric(client, 'gtfs_requests_total', **labels) == requests + 1
+    assert metric(client, 'gtfs_sql_statements_total', endpoint='/search') > statements + sent
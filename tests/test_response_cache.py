@@ -0,0 +1,19 @@
+from sqlalchemy import create_engine
+from response_cache import LRUCache, database_fingerprint
+
+
+def test_clear_database_keeps_other_feeds(tmp_path):
+    engines = {}
+    for name in ('main', 'main2', 'other'):
+        (tmp_path / f'{name}.db').write_bytes(b'')
+        engines[name] = create_engine(f'sqlite:///{tmp_path / name}.db')
+    cache = LRUCache()
+    for name, engine in engines.items():
+        cache.set(f'flask_cache_/stops?@{database_fingerprint(engine)}', name)
+    # A previous version of main.db, keyed with another modification time
+    cache.set(f'flask_cache_/stops?@{tmp_path / "main.db"}:1:0', 'old main')
+
+    cache.clear_database(engines['main'])
+
+    remaining = [cache.get(key) for key in list(cache._entries)]
+    assert sorted(remaining) == ['main2', 'other']
@@ -0,0 +1,145 @@
+import json
+import sqlite3
+import pytest
+from spatial import haversine
+
+
+@pytest.mark.parametrize('limit', ['0', '-3', 'abc'])
+def test_routes_rejects_invalid_limits(client, limit):
+    for format in ('json', 'ndjson'):
+        response = client.get(f'/routes?limit={limit}&format={format}')
+        assert response.status_code == 400
+        assert 'limit' in response.get_json()['error']
+
+
+def test_routes_pages(client):
+    routes, cursor = [], None
+    while True:
+        page = client.get('/routes?limit=3' + (f'&cursor={cursor}' if cursor else '')).get_json()
+        assert len(page['routes']) <= 3
+        routes += page['routes']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert [route['route_id'] for route in routes] == sorted(route['route_id'] for route in client.get('/routes').get_json())
+    assert len(routes) == 8
+
+
+def search(client, **body):
+    response = client.post('/search', json=body)
+    assert response.status_code == 200, response.get_json()
+    return response
+
+
+def search_cursor_pages(client, **body):
+    stops, routes, cursor = [], [], None
+    while True:
+        page = search(client, cursor=cursor, **body).get_json()
+        assert len(page['stops']) <= body['limit'] and len(page['routes']) <= body['limit']
+        stops += page['stops']
+        routes += page['routes']
+        cursor = page['next_cursor']
+        if cursor is None:
+            return stops, routes
+
+
+def stream_matches(client, **body):
+    lines = search(client, format='ndjson', **body).get_data(as_text=True).splitlines()
+    matches = [json.loads(line) for line in lines]
+    return ([{k: v for k, v in match.items() if k != 'kind'} for match in matches if match['kind'] == kind]
+            for kind in ('stop', 'route'))
+
+
+# Cursor pages follow the order of the stream, every match once, with the index and with the LIKE fallback
+@pytest.mark.parametrize('feed', ['default', 'plain'])
+@pytest.mark.parametrize('query', ['Stop', 'stop 1', '1'])
+def test_search_cursor_pages(client, feed, query):
+    stops, routes = search_cursor_pages(client, query=query, limit=7, feed=feed)
+    assert (stops, routes) == tuple(stream_matches(client, query=query, feed=feed))
+    assert len({stop['stop_id'] for stop in stops}) == len(stops)
+    assert len({route['route_id'] for route in routes}) == len(routes)
+    assert stops or routes
+    if query == 'Stop':
+        assert len(stops) == 64
+
+
+def test_search_offset_pages(client):
+    stops, offset = [], 0
+    while True:
+        page = search(client, query='Stop', limit=10, offset=offset).get_json()
+        stops += page['stops']
+        if not page['has_more']['stops']:
+            break
+        offset += 10
+    assert sorted(stop['stop_id'] for stop in stops) == sorted({stop['stop_id'] for stop in stops})
+    assert len(stops) == 64
+
+
+# The index ignores case and accents and matches every word as a prefix
+def test_search_ignores_accents(client):
+    accented = search(client, query='Città', limit=100).get_json()['stops']
+    assert len(accented) == 64
+    assert search(client, query='CITTA', limit=100).get_json()['stops'] == accented
+    assert len(search(client, query='cit sto', limit=100).get_json()['stops']) == 64
+
+
+def test_search_rejects_foreign_cursors(client):
+    # Not base64 JSON, and {"fts": true} without the positions
+    for cursor in ('garbage', 'eyJmdHMiOiB0cnVlfQ'):
+        response = client.post('/search', json={'query': 'Stop', 'cursor': cursor})
+        assert response.status_code == 400
+    # An index cursor can't continue on a feed without the index
+    cursor = search(client, query='Stop', limit=5, cursor=None).get_json()['next_cursor']
+    response = client.post('/search', json={'query': 'Stop', 'limit': 5, 'cursor': cursor, 'feed': 'plain'})
+    assert response.status_code == 400 and 'another search' in response.get_json()['error']
+
+
+def all_stops(server):
+    with sqlite3.connect(server.feeds.default.current.path) as conn:
+        return conn.execute("SELECT stop_id, stop_lat, stop_lon FROM stops").fetchall()
+
+
+BOXES = [(45.0, 9.0, 45.2, 9.2), (45.2, 9.15, 45.3, 9.3), (44.0, 8.0, 46.0, 10.0), (10.0, 10.0, 11.0, 11.0)]
+
+
+# The R*Tree and the grid fallback of the feed without it find exactly the stops inside the box
+@pytest.mark.parametrize('feed', ['default', 'plain'])
+@pytest.mark.parametrize('box', BOXES)
+def test_stops_in_bbox(server, client, feed, box):
+    min_lat, min_lon, max_lat, max_lon = box
+    expected = {stop_id for stop_id, lat, lon in all_stops(server) if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon}
+    response = client.get(f'/stops_in_bbox?min_lat={min_lat}&min_lon={min_lon}&max_lat={max_lat}&max_lon={max_lon}&feed={feed}')
+    page = response.get_json()
+    assert {stop['stop_id'] for stop in page['stops']} == expected and not page['truncated']
+
+
+@pytest.mark.parametrize('feed', ['default', 'plain'])
+def test_stops_in_bbox_truncated(client, feed):
+    page = client.get(f'/stops_in_bbox?min_lat=44&min_lon=8&max_lat=46&max_lon=10&limit=5&feed={feed}').get_json()
+    assert len(page['stops']) == 5 and page['truncated']
+
+
+# Around every stop, and far from all of them: the stops within radius, nearest first, with their distance
+@pytest.mark.parametrize('feed', ['default', 'plain'])
+@pytest.mark.parametrize('radius', [0, 1000, 5000])
+def test_stops_nearby(server, client, feed, radius):
+    stops = all_stops(server)
+    centers = [(lat + 0.001, lon - 0.001) for _, lat, lon in stops[::4]] + [(10.0, 10.0)]
+    found = 0
+    for lat, lon in centers:
+        distances = haversine(lat, lon, [stop[1] for stop in stops], [stop[2] for stop in stops])
+        expected = sorted((distance, stop[0]) for stop, distance in zip(stops, distances) if distance <= radius)
+        page = client.get(f'/stops_nearby?lat={lat}&lon={lon}&radius={radius}&limit=1000&feed={feed}').get_json()
+        assert page['radius'] == radius
+        assert [stop['stop_id'] for stop in page['stops']] == [stop_id for _, stop_id in expected]
+        assert [stop['distance'] for stop in page['stops']] == [round(distance, 1) for distance, _ in expected]
+        found += len(expected)
+    # Every stop taken as a center is about 140m from it
+    assert found >= len(centers) - 1 if radius else found == 0
+
+
+@pytest.mark.parametrize('url', ['/stops_in_bbox?min_lat=45.3&min_lon=9&max_lat=45.1&max_lon=9.3',
+                                 '/stops_in_bbox?min_lat=45.1&min_lon=9',
+                                 '/stops_nearby?lat=95&lon=9', '/stops_nearby?lon=9'])
+def test_spatial_rejects_invalid_coordinates(client, url):
+    assert client.get(url).status_code == 400
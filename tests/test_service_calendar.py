@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+from service_calendar import ServiceCalendar, DAYS
+
+# January 2024 starts on a monday
+CALENDAR = pd.DataFrame([
+    ['WEEK', 1, 1, 1, 1, 1, 0, 0, '20240101', '20240131'],
+    # Its only saturday is removed below
+    ['SAT', 0, 0, 0, 0, 0, 1, 0, '20240106', '20240112'],
+], columns=['service_id'] + DAYS + ['start_date', 'end_date'])
+
+CALENDAR_DATES = pd.DataFrame([
+    ['WEEK', 20240103, 2],
+    # Added on a saturday after the end of its date range
+    ['WEEK', 20240203, 1],
+    ['SAT', 20240106, 2],
+    # Only in calendar_dates
+    ['EXTRA', 20240107, 1],
+    ['EXTRA', 20240108, 3],
+    ['EXTRA', 'not a date', 1],
+], columns=['service_id', 'date', 'exception_type'])
+
+
+@pytest.fixture
+def calendar():
+    return ServiceCalendar(CALENDAR, CALENDAR_DATES)
+
+
+@pytest.mark.parametrize('date, active', [
+    (20240102, ['WEEK']),
+    ('20240103', []),
+    (20240104, ['WEEK']),
+    (20240106, []),
+    (20240107, ['EXTRA']),
+    (20240108, ['WEEK']),
+    (20231229, []),
+    (20240131, ['WEEK']),
+    (20240201, []),
+    (20240203, ['WEEK']),
+])
+def test_active_on(calendar, date, active):
+    service_ids = ['WEEK', 'SAT', 'EXTRA', 'UNKNOWN']
+    result = calendar.active_on(service_ids, date)
+    assert [service_id for service_id, running in zip(service_ids, result) if running] == active
+
+
+def test_weekday_frame(calendar):
+    frame = calendar.weekday_frame(['WEEK', 'SAT', 'EXTRA', 'UNKNOWN'])
+    running = {service_id: [day for day in DAYS if row[day]] for service_id, row in frame.iterrows()}
+    assert running == {
+        'WEEK': ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday'],
+        'SAT': [],
+        'EXTRA': ['sunday'],
+        'UNKNOWN': [],
+    }
+
+
+def test_removed_weekday_only_if_every_date_is_removed():
+    dates = pd.DataFrame([['WEEK', 20240101, 2], ['WEEK', 20240108, 2]], columns=['service_id', 'date', 'exception_type'])
+    assert ServiceCalendar(CALENDAR, dates).weekday_frame(['WEEK']).loc['WEEK', 'monday']
+    every_monday = pd.DataFrame([['WEEK', day, 2] for day in (20240101, 20240108, 20240115, 20240122, 20240129)],
+                                columns=['service_id', 'date', 'exception_type'])
+    assert not ServiceCalendar(CALENDAR, every_monday).weekday_frame(['WEEK']).loc['WEEK', 'monday']
+
+
+def test_without_calendar_dates():
+    calendar = ServiceCalendar(CALENDAR)
+    assert calendar.active_on(['WEEK', 'SAT'], 20240106).tolist() == [False, True]
+    assert calendar.weekday_frame().loc['SAT'].tolist() == [False] * 5 + [True, False]
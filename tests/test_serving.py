@@ -0,0 +1,218 @@
+import os
+import sqlite3
+import threading
+import pytest
+from serving import FeedRegistry, DatabaseSwitch, UnknownFeed
+
+
+def make_database(path, value=1):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS feed (value INTEGER)")
+        conn.execute("DELETE FROM feed")
+        conn.execute("INSERT INTO feed VALUES (?)", (value,))
+    return str(path)
+
+
+def value(database):
+    with database.engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT value FROM feed").scalar()
+
+
+@pytest.fixture
+def registry(tmp_path):
+    feeds = {name: make_database(tmp_path / f'{name}.db', position) for position, name in enumerate('abc', start=2)}
+    registry = FeedRegistry(f"sqlite:///{make_database(tmp_path / 'main.db')}", feeds=feeds, read_only=True)
+    yield registry
+    registry.dispose()
+
+
+# A feed stuck reopening its file doesn't hold the requests to the other feeds
+def test_slow_refresh_doesnt_block_other_feeds(registry, monkeypatch):
+    switch, database = registry.acquire('a')
+    switch.release(database)
+
+    entered, proceed = threading.Event(), threading.Event()
+    refresh = DatabaseSwitch.refresh
+
+    def slow_refresh(self):
+        if self is switch:
+            entered.set()
+            proceed.wait(10)
+        refresh(self)
+
+    def request(feed_id, results):
+        switch, database = registry.acquire(feed_id)
+        results.append(value(database))
+        switch.release(database)
+
+    monkeypatch.setattr(DatabaseSwitch, 'refresh', slow_refresh)
+    slow, other = [], []
+    threads = [threading.Thread(target=request, args=('a', slow)), threading.Thread(target=request, args=('b', other))]
+    threads[0].start()
+    assert entered.wait(5)
+    threads[1].start()
+    threads[1].join(5)
+    done = not threads[1].is_alive()
+    proceed.set()
+    for thread in threads:
+        thread.join()
+    assert done and other == [3] and slow == [2]
+
+
+def record_disposals(monkeypatch, database, disposed):
+    monkeypatch.setattr(database.engine, 'dispose', lambda: disposed.append(database))
+
+
+# A running request keeps the database it acquired, the old engine is disposed when its last request ends
+def test_swap_waits_for_running_requests(tmp_path, monkeypatch):
+    switch = DatabaseSwitch(f"sqlite:///{make_database(tmp_path / 'old.db', 1)}", read_only=True)
+    running = switch.acquire()
+    disposed = []
+    record_disposals(monkeypatch, running, disposed)
+
+    switch.swap(f"sqlite:///{make_database(tmp_path / 'new.db', 2)}")
+    assert running.retired and disposed == [] and value(running) == 1
+    database = switch.acquire()
+    assert value(database) == 2
+    switch.release(database)
+
+    switch.release(running)
+    assert disposed == [running]
+    switch.dispose()
+
+
+def test_swap_to_a_bad_file_keeps_the_current_database(tmp_path):
+    switch = DatabaseSwitch(f"sqlite:///{make_database(tmp_path / 'feed.db', 1)}", read_only=True)
+    served = switch.current
+    (tmp_path / 'broken.db').write_bytes(b'not a database' * 100)
+    for url in (f"sqlite:///{tmp_path / 'missing.db'}", f"sqlite:///{tmp_path / 'broken.db'}"):
+        with pytest.raises(Exception):
+            switch.swap(url)
+        assert switch.current is served and not served.retired
+    database = switch.acquire()
+    assert value(database) == 1
+    switch.release(database)
+    switch.dispose()
+
+
+# Immutable connections don't see a file changed in place, the next request reopens it
+def test_refresh_reopens_a_file_changed_in_place(tmp_path):
+    path = make_database(tmp_path / 'feed.db', 1)
+    switch = DatabaseSwitch(f'sqlite:///{path}', read_only=True)
+    served = switch.acquire()
+    assert value(served) == 1
+    switch.release(served)
+
+    make_database(path, 2)
+    # Coarse file system timestamps could keep the same mtime
+    os.utime(path, ns=(served.stat[0] + 10**9,) * 2)
+    database = switch.acquire()
+    assert database is not served and served.retired
+    assert value(database) == 2
+    switch.release(database)
+    # Not changed since, not reopened again
+    assert switch.acquire() is database
+    switch.release(database)
+    switch.dispose()
+
+
+# A swap in one worker is written to the state file, the others follow it at their next request
+def test_workers_follow_a_swap_through_the_state_file(tmp_path):
+    state_file = str(tmp_path / 'server.state')
+    url = f"sqlite:///{make_database(tmp_path / 'old.db', 1)}"
+    workers = [DatabaseSwitch(url, read_only=True, state_file=state_file) for _ in range(2)]
+    workers[0].swap(f"sqlite:///{make_database(tmp_path / 'new.db', 2)}")
+
+    database = workers[1].acquire()
+    assert value(database) == 2
+    workers[1].release(database)
+    # A worker started later opens what the state file says
+    late = DatabaseSwitch(url, read_only=True, state_file=state_file)
+    assert value(late.current) == 2
+    for switch in workers + [late]:
+        switch.dispose()
+
+
+def request(registry, feed_id):
+    switch, database = registry.acquire(feed_id)
+    try:
+        return value(database)
+    finally:
+        switch.release(database)
+
+
+def test_least_recently_used_feed_is_closed(tmp_path):
+    feeds = {name: make_database(tmp_path / f'{name}.db', position) for position, name in enumerate('abc', start=2)}
+    registry = FeedRegistry(f"sqlite:///{make_database(tmp_path / 'main.db')}", feeds=feeds, max_open=2, read_only=True)
+    assert [request(registry, feed_id) for feed_id in ('a', 'b', 'a', 'c')] == [2, 3, 2, 4]
+    assert list(registry.open_feeds) == ['a', 'c']
+    # The default feed doesn't count and is never closed
+    assert request(registry, None) == 1 and request(registry, 'default') == 1
+    assert request(registry, 'b') == 3
+    assert list(registry.open_feeds) == ['c', 'b']
+    registry.dispose()
+
+
+# A feed with a running request isn't closed, the registry goes past max_open until the request ends
+def test_feed_in_use_is_not_closed(registry):
+    registry.max_open = 1
+    switch, database = registry.acquire('a')
+    assert request(registry, 'b') == 3
+    assert list(registry.open_feeds) == ['a', 'b']
+    switch.release(database)
+    assert request(registry, 'c') == 4
+    assert list(registry.open_feeds) == ['c']
+
+
+# Between the lookup and acquire() the switch is pinned, other requests opening feeds don't close it under it
+def test_pinned_feed_is_not_closed(registry, monkeypatch):
+    registry.max_open = 1
+    switch, database = registry.acquire('a')
+    switch.release(database)
+
+    entered, proceed = threading.Event(), threading.Event()
+    refresh = DatabaseSwitch.refresh
+
+    def slow_refresh(self):
+        if self is switch:
+            entered.set()
+            proceed.wait(10)
+        refresh(self)
+
+    monkeypatch.setattr(DatabaseSwitch, 'refresh', slow_refresh)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(request(registry, 'a')))
+    thread.start()
+    assert entered.wait(5)
+    assert request(registry, 'b') == 3 and request(registry, 'c') == 4
+    assert 'a' in registry.open_feeds
+    proceed.set()
+    thread.join()
+    assert results == [2]
+
+
+def test_unknown_feed(registry, tmp_path):
+    for feed_id in ('missing', '../main', 'main'):
+        with pytest.raises(UnknownFeed):
+            registry.acquire(feed_id)
+    assert list(registry.open_feeds) == []
+
+
+# Files added to feeds_dir are served without a restart
+def test_feeds_dir_is_looked_up_at_each_request(tmp_path):
+    feeds_dir = tmp_path / 'feeds'
+    feeds_dir.mkdir()
+    registry = FeedRegistry(f"sqlite:///{make_database(tmp_path / 'main.db')}", feeds_dir=str(feeds_dir), read_only=True)
+    with pytest.raises(UnknownFeed):
+        registry.acquire('late')
+    make_database(feeds_dir / 'late.db', 5)
+    assert registry.feed_ids() == ['default', 'late']
+    assert request(registry, 'late') == 5
+    registry.dispose()
+
+
+def test_requests_choose_their_feed(client):
+    assert len(client.get('/routes').get_json()) == 8
+    assert len(client.get('/routes?feed=other').get_json()) == 3
+    response = client.get('/routes?feed=missing')
+    assert response.status_code == 404 and 'missing' in response.get_json()['error']
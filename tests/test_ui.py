@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import pytest
+from conftest import write_zip
+from gtfs_processor import process_gtfs_file
+from serving import DatabaseSwitch
+
+pytest.importorskip('tkinter')
+pytest.importorskip('requests')
+from ui import App
+
+
+# A database served as immutable is never written in place: the prepared copy replaces it and the server reopens it
+def test_prepare_database_replaces_the_file(tmp_path, feed):
+    db_path = str(tmp_path / 'feed.db')
+    assert process_gtfs_file(write_zip(tmp_path / 'feed.zip', feed), db_path)
+    with sqlite3.connect(db_path) as conn:
+        for statement in ("DROP TABLE search_index", "DROP TABLE stops_rtree", "DROP INDEX idx_trips_route_direction"):
+            conn.execute(statement)
+    switch = DatabaseSwitch(f'sqlite:///{db_path}', read_only=True)
+    served, inode = switch.current, os.stat(db_path).st_ino
+
+    assert App.needs_preparing(db_path)
+    App.prepare_database(db_path)
+    assert os.stat(db_path).st_ino != inode
+    assert not App.needs_preparing(db_path)
+    assert sorted(os.listdir(tmp_path)) == ['feed.db', 'feed.zip']
+
+    database = switch.acquire()
+    assert database is not served
+    switch.release(database)
+    switch.dispose()
+
+    # Nothing missing, nothing written
+    modified = os.stat(db_path).st_mtime_ns
+    App.prepare_database(db_path)
+    assert os.stat(db_path).st_mtime_ns == modified
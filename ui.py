@@ -2,9 +2,17 @@ import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 from gtfs_processor import process_gtfs_file
+from database import build_indexes, missing_indexes, has_statistics
+from search_index import ensure_search_index
+from spatial import ensure_stop_index
+from sqlalchemy import create_engine, inspect
+from contextlib import closing
 import threading
 import os
+import sqlite3
+import tempfile
 import subprocess
+import sys
 import webbrowser
 import time
 import requests
@@ -15,7 +23,7 @@ class App:
     def __init__(self, root):
         self.root = root
         self.root.title("GTFS Traffic Analysis")
-        self.root.geometry("600x400")
+        self.root.geometry("600x480")
         self.root.configure(bg="#f0f0f0")
         
         self.setup_styles()
@@ -39,6 +47,9 @@ class App:
 
         self.create_upload_section(main_frame, "Upload GTFS Zip", self.upload_gtfs_file,
                                    "Choose a GTFS zip file to be uploaded and converted into a database")
+
+        self.create_upload_section(main_frame, "Update Database", self.update_gtfs_file,
+                                   "Choose a newer GTFS zip and a database converted from an older one, only what changed will be written")
         
         self.progress_bar = ttk.Progressbar(main_frame, mode='indeterminate', style='TProgressbar')
         self.progress = tk.StringVar()
@@ -73,13 +84,42 @@ class App:
     def upload_gtfs_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("Zip files", "*.zip")])
         if file_path:
-            self.show_progress_bar()
-            threading.Thread(target=self.process_gtfs_file, args=(file_path,)).start()
+            db_path = self.ask_database_path()
+            if db_path:
+                self.show_progress_bar()
+                threading.Thread(target=self.process_gtfs_file, args=(file_path, db_path)).start()
+
+    def update_gtfs_file(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Zip files", "*.zip")])
+        if file_path:
+            db_path = filedialog.askopenfilename(filetypes=[("Database files", "*.db")])
+            if db_path:
+                self.show_progress_bar()
+                threading.Thread(target=self.process_gtfs_file, args=(file_path, db_path, True)).start()
 
-    def process_gtfs_file(self, file_path):
+    # Before creating the file we ask for a name and check if there's one already
+    # (process_gtfs_file replaces it, so we only need the confirmation here)
+    @staticmethod
+    def ask_database_path():
+        db_path = filedialog.asksaveasfilename(defaultextension=".db", filetypes=[("SQLite database files", "*.db")])
+
+        if not db_path:
+            print("Operation cancelled.")
+            return None
+
+        if os.path.exists(db_path):
+            if not messagebox.askyesno("Overwrite Confirmation", f"The file '{db_path}' already exists. Do you want to replace it?"):
+                print("Operation cancelled.")
+                return None
+
+        return db_path
+
+    def process_gtfs_file(self, file_path, db_path, incremental=False):
         try:
-            process_gtfs_file(file_path, self.update_progress)
-            messagebox.showinfo("Success", "GTFS data processed successfully!")
+            if process_gtfs_file(file_path, db_path, self.update_progress, incremental=incremental):
+                messagebox.showinfo("Success", "GTFS data processed successfully!")
+            else:
+                messagebox.showerror("Error", "Something went wrong while processing the GTFS file, check the terminal for details")
         except Exception as e:
             messagebox.showerror("Error", str(e))
         finally:
@@ -96,7 +136,53 @@ class App:
 
 
 
+    # True if the database lacks an index, the planner statistics, the search or the spatial index. Only reads the file
+    @staticmethod
+    def needs_preparing(db_path):
+        engine = create_engine(f'sqlite:///{db_path}')
+        try:
+            inspector = inspect(engine)
+            tables = set(inspector.get_table_names())
+            with engine.connect() as conn:
+                statistics = has_statistics(conn)
+            return bool(missing_indexes(inspector)) or not statistics or not {'search_index', 'stops_rtree'} <= tables
+        finally:
+            engine.dispose()
+
+    # Databases converted with older versions (or somewhere else) don't have the indexes the server needs
+    # (search and spatial index included), we add the missing ones before serving it. It's fast when they are already there.
+    # The server may have the file open as immutable (SQLite then assumes it never changes), so it's never written in place:
+    # a copy is prepared and renamed over it, the server sees a new file and reopens it
+    @staticmethod
+    def prepare_database(db_path):
+        try:
+            if not App.needs_preparing(db_path):
+                return
+        except Exception as e:
+            print(f"Could not read {db_path}: {e}")
+            return
+
+        fd, temp_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(db_path)))
+        os.close(fd)
+        try:
+            with closing(sqlite3.connect(db_path)) as source, closing(sqlite3.connect(temp_path)) as target:
+                source.backup(target)
+            engine = create_engine(f'sqlite:///{temp_path}')
+            try:
+                build_indexes(engine)
+                ensure_search_index(engine)
+                ensure_stop_index(engine)
+            finally:
+                engine.dispose()
+            os.replace(temp_path, db_path)
+        except Exception as e:
+            print(f"Could not add indexes to {db_path}: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
     def start_flask_server(self, db_path):
+        self.prepare_database(db_path)
         os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
         print(f"Setting DATABASE_URL to sqlite:///{db_path}")
     
@@ -115,7 +201,8 @@ class App:
         else:
             print("Starting Flask server...")
             global flask_process
-            flask_process = subprocess.Popen(['python', 'server.py'])
+            # Production mode (serving.py): read-only pooled connections, gunicorn/waitress when installed
+            flask_process = subprocess.Popen([sys.executable, '-m', 'serving', db_path])
 
     
     #the sleep time should be enough for the server to start, feel free to modify it